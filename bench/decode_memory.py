@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+#
+# Benchmark: tracemalloc peak while loading one 13-filter observation of full-resolution (1024x1024) Pancam frames.
+# Old path is requests.get -> .content -> bytearray -> np.asarray -> imdecode;
+# new path streams into one preallocated buffer and decodes that (image_utils.decodeResponse).
+# Both decode the same frames from a local server, one image at a time, so only the copying differs.
+# The per-frame line is the download overhead of one frame: peak over the body size, decoding at 1/8
+# scale so the decoded frame doesn't set the peak; i.e. extra copies of the body made while reading it.
+# Run from the root directory:
+#     marsrover-pipeline $ python3 -m bench.decode_memory
+#
+
+# Library imports
+import time
+import threading
+import tracemalloc
+import http.server
+import cv2
+import numpy as np
+import requests
+
+# marsrover-pipeline imports
+import missions.mer.image_utils as image_utils
+
+NUM_FILTERS = 13
+SIZE = 1024
+
+# Noisy-ish frame so the JPEG is a realistic size rather than a few KB.
+def makeJpeg(seed):
+	rng = np.random.RandomState(seed)
+	image = cv2.GaussianBlur(rng.randint(0, 255, (SIZE, SIZE), dtype=np.uint8), (5, 5), 0)
+	return cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 95])[1].tobytes()
+
+JPEGS = [makeJpeg(i) for i in range(NUM_FILTERS)]
+
+class ImageHandler(http.server.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def do_GET(self):
+		body = JPEGS[int(self.path.strip('/'))]
+		self.send_response(200)
+		self.send_header('Content-Type', 'image/jpeg')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+def oldLoad(session, url, flags=cv2.IMREAD_GRAYSCALE):
+	req = session.get(url)
+	return cv2.imdecode(np.asarray(bytearray(req.content), dtype='uint8'), flags)
+
+def newLoad(session, url, flags=cv2.IMREAD_GRAYSCALE):
+	with session.get(url, stream=True) as req:
+		return image_utils.decodeResponse(req, flags)
+
+# Peak traced bytes, and time, to load the whole observation; decoded frames are kept like obsImages does.
+def measure(load, session, prefix):
+	tracemalloc.start()
+	start = time.perf_counter()
+	obsImages = {}
+	for i in range(NUM_FILTERS):
+		obsImages[i] = load(session, prefix + str(i))
+	elapsed = time.perf_counter() - start
+	current, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	return peak, elapsed
+
+# Peak traced bytes over the body size, while loading a single frame at 1/8 scale.
+def measureFrame(load, session, url, size):
+	tracemalloc.start()
+	load(session, url, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	return peak - size
+
+if __name__ == '__main__':
+	server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	prefix = 'http://127.0.0.1:%d/' % server.server_port
+	session = requests.Session()
+
+	measure(newLoad, session, prefix) # Warm up the connection and OpenCV
+	oldPeak, oldTime = measure(oldLoad, session, prefix)
+	newPeak, newTime = measure(newLoad, session, prefix)
+	decoded = NUM_FILTERS * SIZE * SIZE
+	oldFrame = measureFrame(oldLoad, session, prefix + '0', len(JPEGS[0]))
+	newFrame = measureFrame(newLoad, session, prefix + '0', len(JPEGS[0]))
+	server.shutdown()
+
+	print("Observation: %d x %dx%d frames, %.1f MiB of JPEG, %.1f MiB decoded" % (NUM_FILTERS, SIZE, SIZE, sum(map(len, JPEGS)) / 2**20, decoded / 2**20))
+	print("Old copy path:  peak %.1f MiB (%.1f MiB over decoded), %.3f s" % (oldPeak / 2**20, (oldPeak - decoded) / 2**20, oldTime))
+	print("Streamed path:  peak %.1f MiB (%.1f MiB over decoded), %.3f s" % (newPeak / 2**20, (newPeak - decoded) / 2**20, newTime))
+	print("Download of one frame (%.0f KiB of JPEG): old %.0f KiB over the body, streamed %.0f KiB" % (len(JPEGS[0]) / 1024, oldFrame / 1024, newFrame / 1024))
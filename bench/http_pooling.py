@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+#
+# Benchmark: images per second pulled from a local HTTP server, plain requests.get vs pooled HttpClient.
+# The server speaks HTTP/1.1 keep-alive like S3 does, so the pooled client reuses one connection.
+# Run from the root directory:
+#     marsrover-pipeline $ python3 -m bench.http_pooling
+#
+
+# Library imports
+import os
+import time
+import threading
+import http.server
+import requests
+
+# marsrover-pipeline imports
+from metadata.http_client import HttpClient
+
+NUM_IMAGES = 300
+IMAGE_BYTES = 120 * 1024 # About a full-frame Pancam JPEG
+
+PAYLOAD = os.urandom(IMAGE_BYTES)
+
+class ImageHandler(http.server.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def do_GET(self):
+		self.send_response(200)
+		self.send_header('Content-Type', 'image/jpeg')
+		self.send_header('Content-Length', str(len(PAYLOAD)))
+		self.end_headers()
+		self.wfile.write(PAYLOAD)
+
+	def log_message(self, *args):
+		pass
+
+def startServer():
+	server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ImageHandler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+def imagesPerSecond(get, prefix):
+	start = time.perf_counter()
+	for i in range(NUM_IMAGES):
+		req = get(prefix + str(i) + '.jpg')
+		assert req.status_code == 200 and len(req.content) == IMAGE_BYTES
+	return NUM_IMAGES / (time.perf_counter() - start)
+
+if __name__ == '__main__':
+	server = startServer()
+	prefix = 'http://127.0.0.1:%d/oss/merb/' % server.server_port
+
+	plain = imagesPerSecond(requests.get, prefix)
+	client = HttpClient()
+	pooled = imagesPerSecond(client.get, prefix)
+	client.close()
+	server.shutdown()
+
+	print("Images fetched per run: %d x %d KiB" % (NUM_IMAGES, IMAGE_BYTES // 1024))
+	print("requests.get:           %.0f images/s" % plain)
+	print("Pooled HttpClient:      %.0f images/s" % pooled)
+	print("Speedup:                %.1fx" % (pooled / plain))
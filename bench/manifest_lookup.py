@@ -0,0 +1,45 @@
+#!/usr/bin/python3
+#
+# Benchmark: per-sol manifest lookup, linear scan (old getSolMetadata) vs SolIndex.
+# Run from the root directory:
+#     marsrover-pipeline $ python3 -m bench.manifest_lookup
+#
+
+# Library imports
+import time
+
+# marsrover-pipeline imports
+import missions.spacecraft as spacecraft
+from metadata.sol_index import SolIndex
+import bench.synthetic as synthetic
+
+NUM_SOLS = 5000
+
+# What getSolMetadata used to do for every call.
+def linearLookup(mf, solNum):
+	for sol in mf['sols']:
+		if sol['sol'] == solNum:
+			return sol
+	return {}
+
+if __name__ == '__main__':
+	mf = synthetic.makeManifest(spacecraft.MSL, NUM_SOLS)
+	lookups = list(range(NUM_SOLS)) # A full backfill: every sol, once.
+
+	start = time.perf_counter()
+	for sol in lookups:
+		linearLookup(mf, sol)
+	linear = time.perf_counter() - start
+
+	start = time.perf_counter()
+	idx = SolIndex(mf)
+	build = time.perf_counter() - start
+	for sol in lookups:
+		idx.get(sol)
+	indexed = time.perf_counter() - start
+
+	print("Sols in manifest:      %d" % len(mf['sols']))
+	print("Linear scan, %d lookups: %.4f s" % (len(lookups), linear))
+	print("Index build:           %.4f s" % build)
+	print("Index build + lookups: %.4f s" % indexed)
+	print("Speedup:               %.0fx" % (linear / indexed))
@@ -0,0 +1,54 @@
+#!/usr/bin/python3
+#
+# Benchmark: opening a local manifest, json (parse + index) vs the memory-mapped binary form.
+# Run from the root directory:
+#     marsrover-pipeline $ python3 -m bench.manifest_startup
+#
+
+# Library imports
+import os
+import json
+import time
+import tempfile
+
+# marsrover-pipeline imports
+import missions.spacecraft as spacecraft
+import metadata.manifest_store as manifest_store
+from metadata.sol_index import SolIndex
+import bench.synthetic as synthetic
+
+SIZES = [5000, 50000]
+REPEATS = 5
+
+def bestOf(fn):
+	best = None
+	for i in range(REPEATS):
+		start = time.perf_counter()
+		fn()
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+def openJson(path):
+	with open(path, 'r') as infile:
+		mf = json.load(infile)
+	return SolIndex(mf).get(1234)
+
+def openBinary(base):
+	top, idx = manifest_store.loadBinary(base)
+	return idx.get(1234)
+
+if __name__ == '__main__':
+	with tempfile.TemporaryDirectory() as tmp:
+		for numSols in SIZES:
+			mf = synthetic.makeManifest(spacecraft.MSL, numSols)
+			path = os.path.join(tmp, 'image_manifest%d.json' % numSols)
+			with open(path, 'w') as outfile:
+				outfile.write(json.dumps(mf, indent=2))
+			base = path[:-5]
+			manifest_store.writeBinary(base, mf, SolIndex(mf), (0, 0))
+			assert openJson(path) == openBinary(base)
+
+			jsonTime = bestOf(lambda: openJson(path))
+			binTime = bestOf(lambda: openBinary(base))
+			print("%6d sols: json %.1f ms (%.1f MiB), binary %.2f ms, %.0fx" % (numSols, jsonTime * 1000, os.path.getsize(path) / 2**20, binTime * 1000, jsonTime / binTime))
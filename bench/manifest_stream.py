@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+#
+# Benchmark: reading a very large remote manifest, all at once (req.json() + index) vs streamed
+# (json_stream + BinaryWriter). Reports peak memory and time until the first updated sol is known.
+# Each mode runs in its own process so peak RSS isn't shared between them.
+# Run from the root directory:
+#     marsrover-pipeline $ python3 -m bench.manifest_stream
+#
+
+# Library imports
+import os
+import sys
+import json
+import time
+import resource
+import tempfile
+import threading
+import subprocess
+import http.server
+
+# marsrover-pipeline imports
+import missions.spacecraft as spacecraft
+import metadata.util as util
+import metadata.json_stream as json_stream
+import metadata.manifest_store as manifest_store
+from metadata.http_client import HttpClient
+from metadata.sol_index import SolIndex
+import bench.synthetic as synthetic
+
+NUM_SOLS = 200000
+# Local manifest is as of halfway through, so the second half of the sols count as updated.
+SINCE = synthetic.makeTimestamp(NUM_SOLS // 2 * 86400)
+
+# Peak resident memory of this process, MiB. ru_maxrss carries over from the parent across exec,
+# so prefer VmHWM where there is a /proc.
+def peakRssMiB():
+	try:
+		with open('/proc/self/status', 'r') as infile:
+			for line in infile:
+				if line.startswith('VmHWM:'):
+					return int(line.split()[1]) / 1024
+	except OSError:
+		pass
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def runFull(url, tmp):
+	start = time.perf_counter()
+	mf = HttpClient().get(url).json()
+	idx = SolIndex(mf)
+	updated = idx.updatedSince(SINCE)
+	return time.perf_counter() - start, len(updated)
+
+def runStream(url, tmp):
+	start = time.perf_counter()
+	firstChanged = None
+	updated = 0
+	since = util.parseTime(SINCE)
+	req = HttpClient().get(url, stream=True)
+	writer = manifest_store.BinaryWriter(os.path.join(tmp, 'remote_manifest'))
+	top = {}
+	for key, value in json_stream.iterManifest(req.iter_content(65536)):
+		if key != 'sols':
+			top[key] = value
+			continue
+		if writer.add(value) > since:
+			updated += 1
+			if firstChanged is None:
+				firstChanged = time.perf_counter() - start
+	writer.finish(top)
+	return firstChanged, updated
+
+def startServer(rootDir):
+	handler = lambda *args: http.server.SimpleHTTPRequestHandler(*args, directory=rootDir)
+	http.server.SimpleHTTPRequestHandler.log_message = lambda *args: None
+	server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+if __name__ == '__main__':
+	if len(sys.argv) == 4: # Child: python3 -m bench.manifest_stream MODE URL TMP
+		mode, url, tmp = sys.argv[1:]
+		base = peakRssMiB()
+		start = time.perf_counter()
+		firstChanged, updated = {'full' : runFull, 'stream' : runStream}[mode](url, tmp)
+		print(json.dumps({'first_changed' : firstChanged, 'total' : time.perf_counter() - start,
+						'updated' : updated, 'peak_mib' : peakRssMiB() - base}))
+		sys.exit(0)
+
+	with tempfile.TemporaryDirectory() as tmp:
+		mf = synthetic.makeManifest(spacecraft.MSL, NUM_SOLS)
+		with open(os.path.join(tmp, 'image_manifest.json'), 'w') as outfile:
+			outfile.write(json.dumps(mf, indent=2))
+		size = os.path.getsize(os.path.join(tmp, 'image_manifest.json'))
+		del mf
+
+		server = startServer(tmp)
+		url = 'http://127.0.0.1:%d/image_manifest.json' % server.server_port
+		results = {}
+		for mode in ['full', 'stream']:
+			out = subprocess.run([sys.executable, '-m', 'bench.manifest_stream', mode, url, tmp], capture_output=True, check=True)
+			results[mode] = json.loads(out.stdout)
+		server.shutdown()
+
+	print("Manifest: %d sols, %.1f MiB" % (NUM_SOLS, size / 2**20))
+	for mode, r in results.items():
+		print("%-7s first updated sol after %6.0f ms, done in %6.0f ms, %d updated, peak memory +%.0f MiB"
+			% (mode + ':', r['first_changed'] * 1000, r['total'] * 1000, r['updated'], r['peak_mib']))
+	print("Peak memory: %.1fx less streamed" % (results['full']['peak_mib'] / max(results['stream']['peak_mib'], 1)))
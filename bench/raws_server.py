@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+#
+# Local stand-in for the raws buckets, for benchmarks: serves an in-memory {path : bytes} over
+# HTTP/1.1 keep-alive with Content-Length, ETag and Last-Modified like S3, answers conditional
+# requests with 304, and can add a fixed latency per request to look like a far-away bucket.
+# Paths that are callables are generated on first request (so a big sol's JPEGs needn't all be made up front).
+#
+
+# Library imports
+import time
+import hashlib
+import threading
+import http.server
+import email.utils
+
+class RawsServer:
+	# files: {path (no leading /) : bytes or callable returning bytes}; latency in seconds per request.
+	def __init__(self, files=None, latency=0.0):
+		self.files = files if files is not None else {}
+		self.latency = latency
+		self.lock = threading.Lock()
+		self.requests = 0
+		self.notModified = 0
+		self.bytesSent = 0
+		self.lastModified = email.utils.formatdate(time.time(), usegmt=True)
+
+		server = self
+		class Handler(http.server.BaseHTTPRequestHandler):
+			protocol_version = 'HTTP/1.1'
+			def do_GET(self):
+				server.handle(self)
+			def log_message(self, *args):
+				pass
+
+		self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+		self.httpd.daemon_threads = True
+		self.thread = None
+
+	@property
+	def prefix(self):
+		return 'http://127.0.0.1:%d/' % self.httpd.server_port
+
+	def start(self):
+		self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.httpd.shutdown()
+		self.httpd.server_close()
+
+	# Body and ETag for a path, or (None, None) if there's no such file.
+	def lookup(self, path):
+		with self.lock:
+			body = self.files.get(path)
+			if callable(body):
+				body = self.files[path] = body()
+		if body is None:
+			return None, None
+		return body, '"' + hashlib.md5(body).hexdigest() + '"'
+
+	def handle(self, req):
+		if self.latency:
+			time.sleep(self.latency)
+		body, etag = self.lookup(req.path.lstrip('/').split('?')[0])
+		with self.lock:
+			self.requests += 1
+
+		if body is None:
+			req.send_response(404)
+			req.send_header('Content-Length', '0')
+			req.end_headers()
+			return
+		if req.headers.get('If-None-Match') == etag:
+			with self.lock:
+				self.notModified += 1
+			req.send_response(304)
+			req.send_header('ETag', etag)
+			req.end_headers()
+			return
+
+		req.send_response(200)
+		req.send_header('Content-Type', 'image/jpeg' if req.path.upper().endswith('.JPG') else 'application/json')
+		req.send_header('Content-Length', str(len(body)))
+		req.send_header('ETag', etag)
+		req.send_header('Last-Modified', self.lastModified)
+		req.end_headers()
+		req.wfile.write(body)
+		with self.lock:
+			self.bytesSent += len(body)
+
+if __name__ == '__main__':
+	print("TESTING MODULE: raws_server.py")
+	import requests
+	s = RawsServer({'a.json' : b'{"x" : 1}', 'b.JPG' : lambda: b'\xff\xd8jpeg'}, latency=0.05).start()
+	session = requests.Session()
+	start = time.perf_counter()
+	r = session.get(s.prefix + 'a.json')
+	print(r.status_code, r.json(), r.headers['ETag'], time.perf_counter() - start >= 0.05)
+	print(session.get(s.prefix + 'a.json', headers={'If-None-Match' : r.headers['ETag']}).status_code)
+	print(session.get(s.prefix + 'b.JPG').content, session.get(s.prefix + 'missing').status_code)
+	print(s.requests, s.notModified, s.bytesSent)
+	s.stop()
+	print("DONE.")
@@ -0,0 +1,41 @@
+#!/usr/bin/python3
+#
+# Benchmark: startup cost of each entry point, from `python -X importtime` in a fresh interpreter.
+# For each module, reports the best total import time over a few runs, and which of the heavy
+# dependencies (numpy, OpenCV, requests, boto3) it pulled in. pipeline.check should load none of
+# the imaging or AWS stacks.
+# Run from the root directory:
+#     marsrover-pipeline $ python3 -m bench.startup
+#
+
+# Library imports
+import os
+import sys
+import subprocess
+
+ENTRY_POINTS = ['pipeline.check', 'metadata.manifest', 'metadata.sol_metadata', 'pipeline.backfill',
+				'missions.mer.pancam', 'pipeline.publisher']
+HEAVY = ['numpy', 'cv2', 'requests', 'boto3']
+REPEATS = 5
+
+# One fresh interpreter importing module. Returns ({module : cumulative microseconds}, wall seconds).
+def importTimes(module):
+	root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+						capture_output=True, text=True, cwd=root, check=True)
+	times = {}
+	for line in proc.stderr.splitlines():
+		# import time: self [us] | cumulative | imported package
+		if not line.startswith('import time:') or 'cumulative' in line:
+			continue
+		fields = line[len('import time:'):].split('|')
+		times[fields[2].strip()] = int(fields[1])
+	return times
+
+if __name__ == '__main__':
+	print("%-24s %10s   %s" % ('', 'import', 'heavy dependencies loaded'))
+	for module in ENTRY_POINTS:
+		runs = [importTimes(module) for i in range(REPEATS)]
+		best = min(runs, key=lambda times: times[module])
+		heavy = ['%s (%.0f ms)' % (dep, best[dep] / 1000) for dep in HEAVY if dep in best]
+		print("%-24s %7.0f ms   %s" % (module, best[module] / 1000, ', '.join(heavy) if heavy else '-'))
@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+#
+# Reproducible, offline benchmark suite.
+# Builds a synthetic mission (master + per-sol manifests, Pancam JPEGs with some partial frames) served
+# by a local raws server with configurable latency, then times:
+#	- end to end, as backfill runs it (Manifest -> SolMetadata -> Pancam -> products on disk):
+#	  cold (empty caches), rerun (state store says everything is current) and warm (products
+#	  regenerated from the HTTP and frame caches), with per-stage breakdowns from metadata/metrics.py
+#	- each stage on its own (manifest parse, image fetch, decode, partial check, composite, encode, ...)
+# Results go to a JSON file; --compare prints the ratio against an earlier one, so a regression
+# between versions shows up as a number rather than a feeling.
+#
+# Nothing touches the real buckets or ~/.marsroverio; everything lives in a temp directory.
+# Run from the root directory:
+#     marsrover-pipeline $ python3 -m bench.suite --out bench-results.json
+#     marsrover-pipeline $ python3 -m bench.suite --latency-ms 40 --compare bench-results.json
+#
+
+# Library imports
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+import cv2
+import numpy as np
+
+# marsrover-pipeline imports
+import missions.spacecraft as spacecraft
+import metadata.config as config
+import metadata.metrics as metrics
+import bench.synthetic as synthetic
+from bench.raws_server import RawsServer
+
+# A synthetic mission on a local server, with its own config.
+# The first half of the sols is in the local manifest already, so the second half counts as updated.
+class World:
+	def __init__(self, rootDir, mission='merb', numSols=20, obsPerSol=4, partialFrac=0.1, latency=0.0, seed=0):
+		self.rootDir = rootDir
+		self.server = RawsServer(latency=latency).start()
+		self.sc = dict(spacecraft.MISSIONS[mission], raws_prefix=self.server.prefix)
+		rng = random.Random(seed)
+
+		# A handful of distinct frames is plenty; making 1000s of JPEGs would dominate setup.
+		complete = [synthetic.makePancamJpeg(s) for s in range(8)]
+		partial = synthetic.makePancamJpeg(99, partial=True)
+		self.jpeg = complete[0]
+
+		self.remoteMf = synthetic.makeManifest(self.sc, numSols, missingFrac=0, seed=seed)
+		files = self.server.files
+		files[self.sc['image_manifest']] = json.dumps(self.remoteMf).encode('utf-8')
+		for entry in self.remoteMf['sols']:
+			solMd = synthetic.makeSolManifest(self.sc, entry['sol'], entry['last_manifest_update'], obsPerSol)
+			files['images/sol%d_image_manifest.json' % entry['sol']] = json.dumps(solMd).encode('utf-8')
+			for block in solMd.values():
+				for item in block if isinstance(block, list) else []:
+					for image in item.get('images', [item]):
+						body = partial if rng.random() < partialFrac else complete[rng.randrange(len(complete))]
+						files[image['url'][len(self.server.prefix):]] = body
+		self.solMd = solMd
+
+		local = dict(self.remoteMf, sols=self.remoteMf['sols'][:numSols // 2])
+		local['last_manifest_update'] = local['most_recent_image'] = local['sols'][-1]['last_manifest_update']
+		os.makedirs(os.path.join(rootDir, 'mf', mission))
+		os.makedirs(os.path.join(rootDir, 'img'))
+		with open(os.path.join(rootDir, 'mf', mission, 'image_manifest.json'), 'w') as outfile:
+			json.dump(local, outfile)
+
+		# Point the process at this world: its config, and its mission definition.
+		configPath = os.path.join(rootDir, 'marsroverio')
+		with open(configPath, 'w') as outfile:
+			json.dump({'manifest_path' : os.path.join(rootDir, 'mf') + '/', 'images_path' : os.path.join(rootDir, 'img') + '/'}, outfile)
+		config.CONFIG_PATH = configPath
+		config.reloadConfig()
+		spacecraft.MISSIONS[mission] = self.sc
+
+	def stop(self):
+		self.server.stop()
+
+# Best and mean of repeats of fn(), in seconds.
+def timeIt(fn, repeats):
+	times = []
+	for i in range(repeats):
+		start = time.perf_counter()
+		fn()
+		times.append(time.perf_counter() - start)
+	return {'best' : min(times), 'mean' : sum(times) / len(times), 'repeats' : repeats}
+
+# One backfill-style pass over the updated sols, in this process so every stage is measured.
+def endToEnd(world):
+	import metadata.manifest as manifest
+	import pipeline.backfill as backfill
+	registry = metrics.Metrics()
+	requestsBefore, bytesBefore = world.server.requests, world.server.bytesSent
+	start = time.perf_counter()
+	m = manifest.Manifest(world.sc)
+	m.getRemoteManifest()
+	m.findUpdatedSols()
+	products = 0
+	for sol in m.toUpdate:
+		result = backfill.processSol(world.sc['mission'], sol)
+		if not result['ok']:
+			raise RuntimeError('sol %d failed: %s' % (sol, result['error']))
+		products += result['products']
+		registry.merge(result['metrics'])
+	return {'seconds' : time.perf_counter() - start, 'sols' : len(m.toUpdate), 'products' : products,
+			'requests' : world.server.requests - requestsBefore, 'bytes_served' : world.server.bytesSent - bytesBefore,
+			'stages' : {name : {'count' : d['count'], 'sum' : d['sum']} for name, d in registry.snapshot()['stages'].items()},
+			'counters' : registry.snapshot()['counters']}
+
+def runEndToEnd(world):
+	import pipeline.state_store as state_store
+	results = {'e2e_cold' : endToEnd(world), 'e2e_rerun' : endToEnd(world)}
+	# Forget what was generated, so everything is rebuilt, but from warm caches.
+	state = state_store.StateStore()
+	for entry in world.remoteMf['sols']:
+		state.clearSol(world.sc['mission'], entry['sol'])
+	state.close()
+	results['e2e_warm'] = endToEnd(world)
+	return results
+
+# Each stage on its own.
+def runStages(world, repeats):
+	import metadata.http_client as http_client
+	import metadata.util as util
+	import missions.mer.image_utils as image_utils
+	import missions.mer.composite as composite
+	import pipeline.output_writer as output_writer
+	from metadata.sol_index import SolIndex
+
+	mfBytes = world.server.files[world.sc['image_manifest']]
+	mf = json.loads(mfBytes)
+	idx = SolIndex(mf)
+	since = mf['sols'][len(mf['sols']) // 2]['last_manifest_update']
+	solBytes = json.dumps(world.solMd).encode('utf-8')
+	frame = cv2.imdecode(np.frombuffer(world.jpeg, np.uint8), cv2.IMREAD_GRAYSCALE)
+	frames = {f : frame for f in synthetic.PANCAM_FILTERS}
+	compositor = composite.Compositor()
+	products = compositor.build(frames)
+	writer = output_writer.OutputWriter()
+	outPath = os.path.join(world.rootDir, 'stage_encode' + writer.extension)
+	client = http_client.HttpClient()
+	imageUrl = next(url for url, body in world.server.files.items() if url.endswith('.JPG'))
+
+	def fetch():
+		with client.get(world.server.prefix + imageUrl, stream=True) as req:
+			image_utils.decodeResponse(req)
+
+	stages = {'manifest_parse' : lambda: SolIndex(json.loads(mfBytes)),
+			'manifest_updated_since' : lambda: idx.updatedSince(since),
+			'manifest_cmptime' : lambda: [util.cmptime(e['last_manifest_update'], since) for e in mf['sols']],
+			'sol_manifest_parse' : lambda: json.loads(solBytes),
+			'image_fetch_decode' : fetch,
+			'image_decode' : lambda: cv2.imdecode(np.frombuffer(world.jpeg, np.uint8), cv2.IMREAD_GRAYSCALE),
+			'partial_check' : lambda: image_utils.checkPartial(frame),
+			'composite_all_products' : lambda: compositor.build(frames),
+			'encode_write_product' : lambda: writer.write(outPath, products['L257'])}
+	results = {name : timeIt(fn, repeats) for name, fn in stages.items()}
+	client.close()
+	writer.close()
+	return results
+
+def gitRevision():
+	try:
+		return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+							cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+# Seconds for every result, flattened: {name : seconds}
+def headline(results):
+	flat = {}
+	for name, r in results['end_to_end'].items():
+		flat[name] = r['seconds']
+	for name, r in results['stages'].items():
+		flat[name] = r['best']
+	return flat
+
+def compare(results, baseline, threshold=1.1):
+	now = headline(results)
+	then = headline(baseline)
+	if baseline['meta']['params'] != results['meta']['params']:
+		print("warning: baseline was run with different parameters:", baseline['meta']['params'])
+	print("%-24s %12s %12s %8s" % ('', 'baseline', 'now', 'ratio'))
+	for name in sorted(now):
+		if name not in then:
+			continue
+		ratio = now[name] / then[name] if then[name] else float('inf')
+		flag = '  SLOWER' if ratio > threshold else ('  faster' if ratio < 1 / threshold else '')
+		print("%-24s %10.2fms %10.2fms %7.2fx%s" % (name, then[name] * 1000, now[name] * 1000, ratio, flag))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Offline benchmark suite on a synthetic mission served locally.')
+	parser.add_argument('--mission', default='merb', choices=['merb', 'mera', 'msl'])
+	parser.add_argument('--sols', type=int, default=20, help='sols in the synthetic mission (half of them updated)')
+	parser.add_argument('--obs', type=int, default=4, help='observations (MER) / images per camera (MSL) per sol')
+	parser.add_argument('--partial-frac', type=float, default=0.1, help='fraction of frames that are partials')
+	parser.add_argument('--latency-ms', type=float, default=0, help='added latency per request to the local server')
+	parser.add_argument('--repeats', type=int, default=20, help='repeats for each stage on its own (best is reported)')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--out', default=None, help='write results to this JSON file')
+	parser.add_argument('--compare', default=None, help='JSON results of an earlier run to compare against')
+	args = parser.parse_args()
+
+	params = {k : v for k, v in vars(args).items() if k not in ('out', 'compare')}
+	with tempfile.TemporaryDirectory() as tmp:
+		world = World(tmp, args.mission, args.sols, args.obs, args.partial_frac, args.latency_ms / 1000, args.seed)
+		try:
+			results = {'meta' : {'git' : gitRevision(), 'python' : platform.python_version(), 'numpy' : np.__version__,
+								'opencv' : cv2.__version__, 'machine' : platform.machine(), 'cpus' : os.cpu_count(),
+								'time' : time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'params' : params},
+						'end_to_end' : runEndToEnd(world),
+						'stages' : runStages(world, args.repeats)}
+		finally:
+			world.stop()
+
+	for name, r in results['end_to_end'].items():
+		print("%-10s %7.0f ms  %3d sols  %4d products  %5d requests  %6.1f MiB served" % (name, r['seconds'] * 1000, r['sols'], r['products'], r['requests'], r['bytes_served'] / 2**20))
+	for name, r in results['stages'].items():
+		print("%-24s %9.3f ms" % (name, r['best'] * 1000))
+
+	if args.out is not None:
+		with open(args.out, 'w') as outfile:
+			json.dump(results, outfile, indent=2)
+	if args.compare is not None:
+		with open(args.compare, 'r') as infile:
+			compare(results, json.load(infile))
+	sys.exit(0)
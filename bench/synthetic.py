@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+#
+# Synthetic data for benchmarks, so they don't depend on the live NASA buckets.
+# Manifests are shaped like the real image_manifest.json and per-sol manifests (MER and MSL flavours),
+# and Pancam frames are real JPEGs, optionally cut off like a partial downlink.
+#
+
+# Library imports
+import random
+import datetime
+import cv2
+import numpy as np
+
+# Fixed base (MER-B landing) so runs are reproducible.
+BASE_TIME = datetime.datetime(2004, 1, 25)
+
+# Timestamp in the manifest format, secs after BASE_TIME.
+def makeTimestamp(secs):
+	t = BASE_TIME + datetime.timedelta(seconds=secs)
+	return t.strftime('%Y-%m-%dT%H:%M:%S.') + '%03dZ' % (t.microsecond // 1000)
+
+# Build a master image manifest with numSols sols.
+# A fraction of sols (missingFrac) is dropped, since the real manifests have holes too.
+def makeManifest(sc, numSols, missingFrac=0.02, seed=0):
+	rng = random.Random(seed)
+	sols = []
+	for sol in range(numSols):
+		if rng.random() < missingFrac:
+			continue
+		sols.append({'sol' : sol,
+					'num_images' : rng.randint(1, 400),
+					'last_manifest_update' : makeTimestamp(sol * 86400 + rng.randint(0, 86399) + rng.random()),
+					'url' : sc['raws_prefix'] + 'images/sol' + str(sol) + '_image_manifest.json'})
+
+	latest = sols[-1]
+	return {'latest_sol' : latest['sol'],
+			'last_manifest_update' : latest['last_manifest_update'],
+			'most_recent_image' : latest['last_manifest_update'],
+			'sols' : sols}
+
+# Pancam filters of a typical multispectral observation (L257 + L456 + L2R2 products possible)
+PANCAM_FILTERS = ('L2', 'L4', 'L5', 'L6', 'L7', 'R1', 'R2')
+
+# One Pancam observation block entry. Image ids follow the real scheme closely enough for Pancam:
+# serial (1 = Opportunity), instrument, sclk, ..., eye + filter, product type.
+def makePancamObs(sc, sol, index, filters=PANCAM_FILTERS):
+	serial = '1' if sc['mission'] == 'merb' else '2'
+	obsId = '%sP%09dEFF%02d%02dP23%02d' % (serial, 128000000 + sol * 1000 + index, sol % 100, index % 100, index % 100)
+	images = [{'imageid' : obsId + filt + 'M1',
+				'filter_number' : filt[1],
+				'url' : sc['raws_prefix'] + 'pancam/' + obsId + filt + 'M1.JPG'} for filt in filters]
+	return {'id' : obsId, 'images' : images}
+
+# Per-sol image manifest. MER: observation blocks (Pancam has numObs of them, other cameras one).
+# MSL: flat image lists per camera.
+def makeSolManifest(sc, sol, lastUpdate, numObs=4, filters=PANCAM_FILTERS):
+	md = {'sol' : sol, 'last_manifest_update' : lastUpdate}
+	if sc['spacecraft'] in ('MER1', 'MER2'):
+		for inst, key in sc['instruments'].items():
+			md[key] = []
+		md['pcam_images'] = [makePancamObs(sc, sol, i, filters) for i in range(numObs)]
+	else:
+		for inst, key in sc['instruments'].items():
+			md[key] = [{'imageid' : '%s_%d_%03d' % (inst, sol, i), 'url' : sc['raws_prefix'] + 'msss/%s_%d_%03d.JPG' % (inst, sol, i)}
+						for i in range(numObs)]
+	return md
+
+# A 1024x1024 grayscale Pancam-like JPEG (smooth terrain plus a little noise, so it compresses like the real thing).
+# partial=True blacks out the bottom half, as when only the first chunks of a frame have come down.
+def makePancamJpeg(seed, partial=False, size=1024):
+	rng = np.random.RandomState(seed)
+	y, x = np.mgrid[0:size, 0:size].astype(np.float32) / size
+	terrain = 90 + 60 * np.sin(6 * x + seed) * np.cos(4 * y) + 30 * y + rng.normal(0, 6, (size, size))
+	frame = np.clip(terrain, 1, 255).astype(np.uint8)
+	if partial:
+		frame[size // 2:] = 0
+	ok, encoded = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 90])
+	return encoded.tobytes()
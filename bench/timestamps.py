@@ -0,0 +1,56 @@
+#!/usr/bin/python3
+#
+# Benchmark: "which sols changed since T" on a 10k-sol manifest.
+# Old way is a string-slicing cmptime per sol; new way is parse once into SolIndex, then one vectorized compare.
+# Run from the root directory:
+#     marsrover-pipeline $ python3 -m bench.timestamps
+#
+
+# Library imports
+import time
+
+# marsrover-pipeline imports
+import missions.spacecraft as spacecraft
+import metadata.util as util
+from metadata.sol_index import SolIndex
+import bench.synthetic as synthetic
+
+NUM_SOLS = 10000
+REPEATS = 5
+
+# The original util.cmptime, kept here as the baseline.
+def slicingCmptime(lhs,rhs):
+	for a, b in ((0,4), (5,7), (8,10), (11,13), (14,16)):
+		if int(lhs[a:b]) > int(rhs[a:b]):
+			return True
+		elif int(lhs[a:b]) < int(rhs[a:b]):
+			return False
+	return float(lhs[17:-1]) > float(rhs[17:-1])
+
+def bestOf(fn):
+	best = None
+	for i in range(REPEATS):
+		start = time.perf_counter()
+		result = fn()
+		elapsed = time.perf_counter() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best, result
+
+if __name__ == '__main__':
+	mf = synthetic.makeManifest(spacecraft.MSL, NUM_SOLS)
+	since = mf['sols'][len(mf['sols']) * 9 // 10]['last_manifest_update'] # Last 10% changed
+
+	oldTime, oldResult = bestOf(lambda: [s['sol'] for s in mf['sols'] if slicingCmptime(s['last_manifest_update'], since)])
+	wrapTime, wrapResult = bestOf(lambda: [s['sol'] for s in mf['sols'] if util.cmptime(s['last_manifest_update'], since)])
+	buildTime, idx = bestOf(lambda: SolIndex(mf))
+	queryTime, newResult = bestOf(lambda: idx.updatedSince(since))
+
+	assert oldResult == wrapResult == newResult
+
+	print("Sols in manifest:             %d (%d changed)" % (len(mf['sols']), len(newResult)))
+	print("Slicing cmptime loop:         %.5f s" % oldTime)
+	print("cmptime wrapper loop:         %.5f s" % wrapTime)
+	print("SolIndex build (parse once):  %.5f s" % buildTime)
+	print("Vectorized updatedSince:      %.5f s" % queryTime)
+	print("Per-run speedup after load:   %.0fx" % (oldTime / queryTime))
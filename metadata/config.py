@@ -0,0 +1,39 @@
+#!/usr/bin/python3
+#
+# Loads the ~/.marsroverio config file once per process.
+# Everything that used to json.load() the config itself should call getConfig() instead.
+#
+
+# Library imports
+import os
+import json
+import threading
+
+CONFIG_PATH = os.path.expanduser('~/.marsroverio')
+
+conf = None
+confLock = threading.Lock()
+
+# Return the parsed config dict, reading the file on first use only.
+def getConfig():
+	global conf
+	if conf is None:
+		with confLock:
+			if conf is None:
+				with open(CONFIG_PATH,'r') as infile:
+					conf = json.load(infile)
+	return conf
+
+# Drop the cached config so the next getConfig() re-reads the file.
+def reloadConfig():
+	global conf
+	with confLock:
+		conf = None
+
+if __name__ == '__main__':
+	print("TESTING MODULE: config.py")
+	print(getConfig())
+	print(getConfig() is getConfig())
+	reloadConfig()
+	print(getConfig())
+	print("DONE.")
@@ -0,0 +1,304 @@
+#!/usr/bin/python3
+#
+# Conditional HTTP fetching with an on-disk response cache.
+# Remembers the ETag / Last-Modified of everything it downloads and sends If-None-Match /
+# If-Modified-Since next time; on a 304 the stored body is served from disk instead.
+# Most polling runs find nothing new upstream, so they cost a few hundred bytes instead of the
+# full manifests. Cache lives under manifest_path and is size-bounded with LRU eviction.
+#
+
+# Library imports
+import os
+import json
+import hashlib
+import threading
+import collections
+
+# marsrover-pipeline imports
+import metadata.config as config
+import metadata.http_client as http_client
+from metadata.metrics import registry as metrics
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024 # Way more than every sol manifest for a mission.
+
+# Looks enough like a requests.Response for the callers that used requests.get directly.
+class CachedResponse:
+	def __init__(self, status_code, content, fromCache=False):
+		self.status_code = status_code
+		self.content = content
+		self.fromCache = fromCache
+
+	def json(self):
+		return json.loads(self.content)
+
+class HttpCache:
+	def __init__(self, cacheDir, maxBytes=DEFAULT_MAX_BYTES, session=None):
+		self.cacheDir = cacheDir
+		self.maxBytes = maxBytes
+		self.http = session if session is not None else http_client.getSharedClient()
+		self.lock = threading.Lock()
+		self.hits = 0   # Served from disk after a 304
+		self.misses = 0 # Full download
+
+		if not os.path.isdir(self.cacheDir):
+			os.makedirs(self.cacheDir, exist_ok=True)
+
+		# LRU order of cached bodies: key -> size, least recently used first.
+		# Scan the directory once here; after that it's kept up to date in memory.
+		entries = []
+		for name in os.listdir(self.cacheDir):
+			if name.endswith('.body'):
+				st = os.stat(os.path.join(self.cacheDir, name))
+				entries.append((st.st_mtime, name[:-5], st.st_size))
+		entries.sort()
+		self.lru = collections.OrderedDict((key, size) for mtime, key, size in entries)
+		self.totalBytes = sum(self.lru.values())
+
+	def key(self, url):
+		return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+	def bodyPath(self, key):
+		return os.path.join(self.cacheDir, key + '.body')
+
+	def metaPath(self, key):
+		return os.path.join(self.cacheDir, key + '.meta')
+
+	# Return stored validators for a key, or {} if nothing usable is cached.
+	def loadMeta(self, key):
+		try:
+			with open(self.metaPath(key),'r') as infile:
+				return json.load(infile)
+		except (OSError, ValueError):
+			return {}
+
+	# Write to a temp file then rename, so readers (other processes too) never see half a file.
+	def atomicWrite(self, path, data, mode='wb'):
+		tmpPath = path + '.tmp' + str(os.getpid()) + '.' + str(threading.get_ident())
+		with open(tmpPath, mode) as outfile:
+			outfile.write(data)
+		os.replace(tmpPath, path)
+
+	# Conditional request headers for a url, from whatever's cached for it.
+	def validators(self, key, url):
+		meta = self.loadMeta(key)
+		headers = {}
+		if meta.get('url') == url and os.path.isfile(self.bodyPath(key)):
+			if meta.get('etag'):
+				headers['If-None-Match'] = meta['etag']
+			if meta.get('last_modified'):
+				headers['If-Modified-Since'] = meta['last_modified']
+		return headers
+
+	# GET a url, using the cache when the server says nothing changed.
+	# client overrides the cache's own HTTP client for this call.
+	# Returns a CachedResponse; status_code is 200 for both fresh and cached bodies.
+	def get(self, url, client=None):
+		http = client if client is not None else self.http
+		key = self.key(url)
+		headers = self.validators(key, url)
+
+		req = http.get(url, headers=headers)
+
+		if req.status_code == 304 and headers:
+			try:
+				with open(self.bodyPath(key),'rb') as infile:
+					content = infile.read()
+			except OSError:
+				# Evicted by someone else between the check and now; just fetch it fresh.
+				req = http.get(url)
+			else:
+				self.touch(key)
+				with self.lock:
+					self.hits += 1
+				metrics.count('http_cache_hits')
+				return CachedResponse(200, content, fromCache=True)
+
+		if req.status_code != 200:
+			return CachedResponse(req.status_code, None)
+
+		with self.lock:
+			self.misses += 1
+		metrics.count('http_cache_misses')
+		metrics.count('bytes_downloaded', len(req.content))
+
+		# Only worth storing if there's something to revalidate with next time.
+		etag = req.headers.get('ETag')
+		lastModified = req.headers.get('Last-Modified')
+		if etag or lastModified:
+			self.store(key, url, req.content, etag, lastModified)
+
+		return CachedResponse(200, req.content)
+
+	# Like get(), but without holding the body in memory: returns (status_code, iterator of body chunks).
+	# On a 304 the chunks come from the cached file; otherwise from the response, written through
+	# to the cache as they go (and only committed to it if the whole body arrives).
+	def stream(self, url, client=None, chunkSize=65536):
+		http = client if client is not None else self.http
+		key = self.key(url)
+		headers = self.validators(key, url)
+
+		req = http.get(url, headers=headers, stream=True)
+
+		if req.status_code == 304 and headers:
+			req.close()
+			try:
+				infile = open(self.bodyPath(key),'rb')
+			except OSError:
+				req = http.get(url, stream=True)
+			else:
+				self.touch(key)
+				with self.lock:
+					self.hits += 1
+				metrics.count('http_cache_hits')
+				return 200, self.iterFile(infile, chunkSize)
+
+		if req.status_code != 200:
+			req.close()
+			return req.status_code, None
+
+		with self.lock:
+			self.misses += 1
+		metrics.count('http_cache_misses')
+		return 200, self.iterAndStore(req, key, url, chunkSize)
+
+	def iterFile(self, infile, chunkSize):
+		with infile:
+			while True:
+				chunk = infile.read(chunkSize)
+				if not chunk:
+					return
+				yield chunk
+
+	def iterAndStore(self, req, key, url, chunkSize):
+		etag = req.headers.get('ETag')
+		lastModified = req.headers.get('Last-Modified')
+		if not (etag or lastModified):
+			with req:
+				for chunk in req.iter_content(chunkSize):
+					metrics.count('bytes_downloaded', len(chunk))
+					yield chunk
+			return
+
+		tmpPath = self.bodyPath(key) + '.tmp' + str(os.getpid()) + '.' + str(threading.get_ident())
+		size = 0
+		complete = False
+		try:
+			with req, open(tmpPath,'wb') as outfile:
+				for chunk in req.iter_content(chunkSize):
+					outfile.write(chunk)
+					size += len(chunk)
+					metrics.count('bytes_downloaded', len(chunk))
+					yield chunk
+			complete = True
+		finally:
+			if complete:
+				os.replace(tmpPath, self.bodyPath(key))
+				self.commit(key, url, size, etag, lastModified)
+			else:
+				try:
+					os.remove(tmpPath)
+				except OSError:
+					pass
+
+	def store(self, key, url, content, etag, lastModified):
+		self.atomicWrite(self.bodyPath(key), content)
+		self.commit(key, url, len(content), etag, lastModified)
+
+	# Body for key is in place; write its validators and account for it in the LRU.
+	def commit(self, key, url, size, etag, lastModified):
+		self.atomicWrite(self.metaPath(key), json.dumps({'url' : url, 'etag' : etag, 'last_modified' : lastModified}), 'w')
+
+		with self.lock:
+			self.totalBytes -= self.lru.pop(key, 0)
+			self.lru[key] = size
+			self.totalBytes += size
+		self.evict()
+
+	# Mark as recently used, on disk too so the order survives restarts.
+	def touch(self, key):
+		with self.lock:
+			if key in self.lru:
+				self.lru.move_to_end(key)
+		try:
+			os.utime(self.bodyPath(key))
+		except OSError:
+			pass
+
+	# Drop least recently used bodies until we're under the size cap.
+	def evict(self):
+		while True:
+			with self.lock:
+				if self.totalBytes <= self.maxBytes or len(self.lru) <= 1:
+					return
+				key, size = self.lru.popitem(last=False)
+				self.totalBytes -= size
+			for path in (self.bodyPath(key), self.metaPath(key)):
+				try:
+					os.remove(path)
+				except OSError:
+					pass
+
+sharedHttpCache = None
+sharedHttpCacheLock = threading.Lock()
+
+# The process-wide cache, under <manifest_path>/http_cache/.
+# Size cap comes from the optional 'http_cache_max_bytes' config key.
+def getSharedCache():
+	global sharedHttpCache
+	if sharedHttpCache is None:
+		with sharedHttpCacheLock:
+			if sharedHttpCache is None:
+				conf = config.getConfig()
+				sharedHttpCache = HttpCache(conf['manifest_path'] + 'http_cache/',
+											conf.get('http_cache_max_bytes', DEFAULT_MAX_BYTES))
+	return sharedHttpCache
+
+if __name__ == '__main__':
+	print("TESTING MODULE: http_cache.py")
+	import tempfile
+	import http.server
+
+	# Local stand-in for the bucket: serves a body with an ETag, 304s when it matches.
+	BODY = json.dumps({'sols' : list(range(1000))}).encode('utf-8')
+	ETAG = '"' + hashlib.md5(BODY).hexdigest() + '"'
+	sent = []
+	class Handler(http.server.BaseHTTPRequestHandler):
+		def do_GET(self):
+			if self.headers.get('If-None-Match') == ETAG:
+				sent.append(0)
+				self.send_response(304)
+				self.send_header('ETag', ETAG)
+				self.end_headers()
+				return
+			sent.append(len(BODY))
+			self.send_response(200)
+			self.send_header('ETag', ETAG)
+			self.send_header('Content-Length', str(len(BODY)))
+			self.end_headers()
+			self.wfile.write(BODY)
+		def log_message(self, *args):
+			pass
+
+	server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	url = 'http://127.0.0.1:%d/images/image_manifest.json' % server.server_port
+
+	with tempfile.TemporaryDirectory() as tmp:
+		c = HttpCache(tmp + '/http_cache/', maxBytes=2 * len(BODY), session=http_client.HttpClient())
+		r1 = c.get(url)
+		r2 = c.get(url)
+		print(r1.status_code, r1.fromCache, len(r1.json()['sols']))
+		print(r2.status_code, r2.fromCache, r2.content == BODY)
+		print(sent) # Second request should have sent no body
+		print(c.hits, c.misses)
+		status, chunks = c.stream(url, chunkSize=1000)
+		print(status, b''.join(chunks) == BODY, c.hits) # From disk after a 304
+
+		# Eviction: a third url pushes the total over the cap, oldest goes.
+		c.get(url + '?a')
+		c.get(url + '?b')
+		print(len(c.lru), c.totalBytes <= c.maxBytes, c.key(url) in c.lru)
+		print(HttpCache(tmp + '/http_cache/', session=c.http).totalBytes == c.totalBytes) # Rebuilt from disk
+
+	server.shutdown()
+	print("DONE.")
@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+#
+# Shared HTTP client with keep-alive connection pooling, timeouts and retry-with-backoff.
+# Plain requests.get opens a new TCP connection every call; pulling a sol's worth of frames
+# from the same bucket paid that handshake once per image.
+#
+# Settings come from the optional "http" block of ~/.marsroverio, e.g.:
+#	"http" : {
+#		"timeout" : 30, "retries" : 3, "backoff" : 0.5,
+#		"pool_connections" : 4, "pool_maxsize" : 10,
+#		"hosts" : {"merpublic.s3.amazonaws.com" : {"pool_maxsize" : 32, "timeout" : 60, "rate" : 20}}
+#	}
+# rate caps requests per second (per process, averaged; short bursts allowed) to keep within a host's limits.
+#
+
+# Library imports
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+from urllib3.util.retry import Retry
+
+# marsrover-pipeline imports
+import metadata.config as config
+
+DEFAULTS = {'timeout' : 30,        # Seconds, connect and read
+			'retries' : 3,         # Retries on connection errors and 5xx
+			'backoff' : 0.5,       # Backoff factor between retries (0.5, 1, 2, ... seconds)
+			'pool_connections' : 4,
+			'pool_maxsize' : 10,
+			'rate' : None}         # Requests per second; None for no limit
+
+# Token bucket: on average at most rate acquire()s a second, with bursts of up to burst.
+# Callers over the rate wait their turn (in order), rather than being refused.
+class RateLimiter:
+	def __init__(self, rate, burst=None):
+		self.rate = float(rate)
+		self.burst = float(burst if burst is not None else max(1.0, rate))
+		self.tokens = self.burst
+		self.last = time.monotonic()
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		with self.lock:
+			now = time.monotonic()
+			self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+			self.last = now
+			self.tokens -= 1 # Goes negative when over the rate: that's the wait owed
+			wait = -self.tokens / self.rate if self.tokens < 0 else 0
+		if wait > 0:
+			time.sleep(wait)
+
+class HttpClient:
+	def __init__(self, settings=None):
+		settings = settings if settings is not None else {}
+		self.settings = dict(DEFAULTS)
+		self.settings.update({k : v for k, v in settings.items() if k != 'hosts'})
+		self.hostTimeouts = {}
+		self.limiter = RateLimiter(self.settings['rate']) if self.settings['rate'] else None
+		self.hostLimiters = {}
+		self.session = requests.Session()
+
+		# Default pool for everything, then one per configured host.
+		adapter = self.makeAdapter(self.settings)
+		self.session.mount('http://', adapter)
+		self.session.mount('https://', adapter)
+		for host, hostSettings in settings.get('hosts', {}).items():
+			merged = dict(self.settings)
+			merged.update(hostSettings)
+			adapter = self.makeAdapter(merged)
+			self.session.mount('http://' + host + '/', adapter)
+			self.session.mount('https://' + host + '/', adapter)
+			self.hostTimeouts[host] = merged['timeout']
+			self.hostLimiters[host] = RateLimiter(merged['rate']) if merged['rate'] else None
+
+	def makeAdapter(self, settings):
+		retry = Retry(total=settings['retries'],
+					backoff_factor=settings['backoff'],
+					status_forcelist=(500, 502, 503, 504),
+					allowed_methods=('GET', 'HEAD'),
+					raise_on_status=False)
+		return HTTPAdapter(pool_connections=settings['pool_connections'],
+						pool_maxsize=settings['pool_maxsize'],
+						max_retries=retry)
+
+	def timeoutFor(self, url):
+		return self.hostTimeouts.get(urlsplit(url).hostname, self.settings['timeout'])
+
+	# Same as requests.get, but pooled, rate limited and with the configured timeout unless one is given.
+	def get(self, url, **kwargs):
+		host = urlsplit(url).hostname
+		limiter = self.hostLimiters[host] if host in self.hostLimiters else self.limiter
+		if limiter is not None:
+			limiter.acquire()
+		kwargs.setdefault('timeout', self.timeoutFor(url))
+		return self.session.get(url, **kwargs)
+
+	def close(self):
+		self.session.close()
+
+sharedClient = None
+sharedClientLock = threading.Lock()
+
+# The process-wide client, built from the config's "http" block.
+# Anything that takes a client argument falls back to this one.
+def getSharedClient():
+	global sharedClient
+	if sharedClient is None:
+		with sharedClientLock:
+			if sharedClient is None:
+				sharedClient = HttpClient(config.getConfig().get('http', {}))
+	return sharedClient
+
+if __name__ == '__main__':
+	print("TESTING MODULE: http_client.py")
+	c = HttpClient({'timeout' : 10, 'hosts' : {'merpublic.s3.amazonaws.com' : {'pool_maxsize' : 32, 'timeout' : 60}}})
+	print(c.timeoutFor('http://merpublic.s3.amazonaws.com/oss/merb/images/image_manifest.json'))
+	print(c.timeoutFor('http://msl-raws.s3.amazonaws.com/images/image_manifest.json'))
+	print(c.session.get_adapter('http://merpublic.s3.amazonaws.com/x')._pool_maxsize)
+	print(c.session.get_adapter('http://msl-raws.s3.amazonaws.com/x')._pool_maxsize)
+	limiter = RateLimiter(50, burst=5)
+	start = time.monotonic()
+	for i in range(30):
+		limiter.acquire()
+	print("30 calls at 50/s (burst 5) took about %.1f s" % (time.monotonic() - start))
+	req = c.get('http://merpublic.s3.amazonaws.com/oss/merb/images/image_manifest.json')
+	print(req.status_code)
+	c.close()
+	print("DONE.")
@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+#
+# Incremental parser for image manifests arriving in chunks (e.g. a streamed HTTP response).
+# json.loads/req.json() builds the whole object tree before we can look at a single sol; this walks the
+# top-level object and hands back each entry of the 'sols' array as soon as it has been received, so
+# only one sol entry (plus one chunk of input) is in memory at a time.
+# Uses the stdlib decoder for each value; no extra dependency.
+#
+
+# Library imports
+import re
+import json
+import codecs
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+decoder = json.JSONDecoder()
+
+# Walks a stream of str chunks, keeping only the unconsumed part of the current chunk(s) buffered.
+class ChunkReader:
+	def __init__(self, chunks):
+		self.chunks = iter(chunks)
+		self.buf = ''
+		self.pos = 0
+		self.eof = False
+
+	# Pull in another chunk. Returns False at end of input.
+	def more(self):
+		if self.eof:
+			return False
+		for chunk in self.chunks:
+			if chunk:
+				# Drop what's been consumed so the buffer doesn't grow with the document.
+				self.buf = self.buf[self.pos:] + chunk
+				self.pos = 0
+				return True
+		self.eof = True
+		return False
+
+	def skipSpace(self):
+		while True:
+			self.pos = WHITESPACE.match(self.buf, self.pos).end()
+			if self.pos < len(self.buf) or not self.more():
+				return
+
+	# Next non-whitespace character, without consuming it ('' at end of input)
+	def peek(self):
+		self.skipSpace()
+		return self.buf[self.pos:self.pos+1]
+
+	def expect(self, chars):
+		c = self.peek()
+		if c == '' or c not in chars:
+			raise ValueError('Malformed manifest: expected one of %r, got %r' % (chars, c))
+		self.pos += 1
+		return c
+
+	# Decode one complete json value at the current position.
+	# A value ending exactly at the end of the buffer might be cut short (a number, say), so only
+	# accept it if something follows it or the input is finished.
+	def value(self):
+		self.skipSpace()
+		while True:
+			try:
+				val, end = decoder.raw_decode(self.buf, self.pos)
+				if end < len(self.buf) or self.eof:
+					self.pos = end
+					return val
+			except json.JSONDecodeError:
+				if self.eof:
+					raise
+			if not self.more():
+				if self.pos >= len(self.buf):
+					raise ValueError('Malformed manifest: truncated')
+
+# Utf-8 bytes can be split across chunks, so decode with an incremental decoder.
+def textChunks(chunks):
+	utf8 = codecs.getincrementaldecoder('utf-8')()
+	for chunk in chunks:
+		if isinstance(chunk, bytes):
+			chunk = utf8.decode(chunk)
+		if chunk:
+			yield chunk
+	tail = utf8.decode(b'', final=True)
+	if tail:
+		yield tail
+
+# Walk a manifest document given as an iterable of str/bytes chunks.
+# Yields ('sols', entry) for each sol entry, in document order, and (key, value) for every other top-level field.
+def iterManifest(chunks):
+	r = ChunkReader(textChunks(chunks))
+	r.expect('{')
+	if r.peek() == '}':
+		return
+	while True:
+		key = r.value()
+		r.expect(':')
+		if key == 'sols' and r.peek() == '[':
+			r.expect('[')
+			if r.peek() == ']':
+				r.expect(']')
+			else:
+				while True:
+					yield ('sols', r.value())
+					if r.expect(',]') == ']':
+						break
+		else:
+			yield (key, r.value())
+		if r.expect(',}') == '}':
+			return
+
+if __name__ == '__main__':
+	print("TESTING MODULE: json_stream.py")
+	doc = {'latest_sol' : 12345, 'sols' : [{'sol' : s, 'url' : 'http://x/sol%d.json' % s, 'note' : 'café ☃'} for s in range(50)],
+		'last_manifest_update' : '2018-02-05T12:00:00.000Z', 'empty' : [], 'flag' : True}
+	text = json.dumps(doc, indent=2).encode('utf-8')
+	for size in [1, 7, 64, 100000]:
+		chunks = [text[i:i+size] for i in range(0, len(text), size)]
+		top = {}
+		sols = []
+		for key, value in iterManifest(chunks):
+			if key == 'sols':
+				sols.append(value)
+			else:
+				top[key] = value
+		top['sols'] = sols
+		print(size, top == doc)
+	print(list(iterManifest([b'{"sols" : []}'])))
+	print(list(iterManifest([b'{}'])))
+	try:
+		list(iterManifest([b'{"sols" : [{"sol" : 1}, {"sol" : ']))
+	except ValueError as e:
+		print('truncated:', type(e).__name__)
+	print("DONE.")
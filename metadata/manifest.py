@@ -7,35 +7,109 @@
 # Library imports
 import os
 import json
-import requests
 
 # marsrover-pipline imports
 import missions.spacecraft as spacecraft
 import metadata.util as util
+import metadata.config as config
+import metadata.http_cache as http_cache
+import metadata.http_client as http_client
+import metadata.json_stream as json_stream
+import metadata.manifest_store as manifest_store
+from metadata.metrics import registry as metrics
+from metadata.sol_index import SolIndex
+from metadata.manifest_cache import sharedCache
 
 class Manifest:
-	def __init__(self, spacecraft):
+	# client is the HttpClient to fetch with; defaults to the shared, pooled one.
+	def __init__(self, spacecraft, client=None):
 		self.sc = spacecraft
+		self.http = client if client is not None else http_client.getSharedClient()
 		self.remoteMf = None
 		self.recentSols = []
 		self.toUpdate = []
 
-		# Pull in locally cached image manifest here
-		conf = json.load(open(os.path.expanduser('~/.marsroverio'),'r'))
+		# Locally cached image manifest; read on first use (see loadLocal), not here, so a Manifest
+		# that only ends up looking at the remote one costs nothing to make.
+		conf = config.getConfig()
 		self.localMfPath = conf['manifest_path'] + self.sc['mission'] + '/image_manifest.json'
-		self.localMf = json.load(open(self.localMfPath,'r'))
+		self.local = None # (manifest, index) once loaded
+		self.remoteIdx = SolIndex(None)
+
+	# Pull in locally cached image manifest, if not already.
+	# Parsed copy is shared process-wide and only re-read if the file changes.
+	def loadLocal(self):
+		if self.local is None:
+			with metrics.stage('manifest_load'):
+				self.local = sharedCache.getLocal(self.sc, self.localMfPath)
+		return self.local
+
+	@property
+	def localMf(self):
+		return self.loadLocal()[0]
+
+	@property
+	def localIdx(self):
+		return self.loadLocal()[1]
 
 	# Pull in the remote manifest
-	def getRemoteManifest(self):
+	# If useCache, reuse a remote manifest already fetched by this process (within 'remote_manifest_ttl',
+	# see manifest_cache.py) instead of downloading again.
+	def getRemoteManifest(self, useCache=False):
+		if useCache:
+			self.remoteMf, self.remoteIdx = sharedCache.getRemote(self.sc)
+			if self.remoteMf is not None:
+				return True
+			self.remoteIdx = SolIndex(None)
+
+		# Conditional GET; if unchanged upstream the body comes from the on-disk cache.
 		remoteMfUrl = self.sc['raws_prefix'] + self.sc['image_manifest']
-		req = requests.get(remoteMfUrl)
+		with metrics.stage('manifest_download'):
+			req = http_cache.getSharedCache().get(remoteMfUrl, client=self.http)
 
 		# Check for success first:
 		if req.status_code != 200:
 			return False
 		
 		# If success, snag the json, decode, and return success.
-		self.remoteMf = req.json()
+		with metrics.stage('manifest_parse'):
+			self.remoteMf = req.json()
+			self.remoteIdx = SolIndex(self.remoteMf)
+		sharedCache.putRemote(self.sc, self.remoteMf, self.remoteIdx)
+		return True
+
+	# Streaming alternative to getRemoteManifest, for very large manifests.
+	# Sol entries are parsed one at a time as they arrive and written straight into a binary index
+	# (see manifest_store.py) next to the local manifest, so the whole document is never in memory.
+	# Sols newer than the local manifest go onto toUpdate as they're seen (so no need for findUpdatedSols),
+	# and onChanged(sol entry) is called for each, if given.
+	# Afterwards remoteMf holds just the top-level fields; lookups go through the index as usual.
+	# Returns True for success, False if the manifest couldn't be fetched.
+	def streamRemoteManifest(self, onChanged=None):
+		remoteMfUrl = self.sc['raws_prefix'] + self.sc['image_manifest']
+		status, chunks = http_cache.getSharedCache().stream(remoteMfUrl, client=self.http)
+		if status != 200:
+			return False
+
+		oldManifTime = util.parseTime(self.localMf['last_manifest_update'])
+		writer = manifest_store.BinaryWriter(self.localMfPath[:-len('image_manifest.json')] + 'remote_manifest')
+		top = {}
+		try:
+			with metrics.stage('manifest_stream'): # Download and parse, interleaved
+				for key, value in json_stream.iterManifest(chunks):
+					if key != 'sols':
+						top[key] = value
+						continue
+					if writer.add(value) > oldManifTime:
+						self.toUpdate.append(value['sol'])
+						if onChanged is not None:
+							onChanged(value)
+		except BaseException:
+			writer.abort()
+			raise
+
+		self.remoteMf, self.remoteIdx = writer.finish(top)
+		sharedCache.putRemote(self.sc, self.remoteMf, self.remoteIdx)
 		return True
 
 	# Check for newness of manifest
@@ -50,54 +124,68 @@ class Manifest:
 
 		# We're gonna check both the update time and the latest image time.
 		# Just to be sure, honestly.
-		if util.cmptime(self.remoteMf['last_manifest_update'],self.localMf['last_manifest_update']):
-			status = 1
-		elif util.cmptime(self.remoteMf['most_recent_image'],self.localMf['most_recent_image']):
-			status = 1
-		else:
-			status = 0
+		with metrics.stage('manifest_compare'):
+			if util.cmptime(self.remoteMf['last_manifest_update'],self.localMf['last_manifest_update']):
+				status = 1
+			elif util.cmptime(self.remoteMf['most_recent_image'],self.localMf['most_recent_image']):
+				status = 1
+			else:
+				status = 0
 
 		return status
 	
 	# Replace the locally cached manifest with the (presumably new) remote manifest.
+	# The json is written to a temp file and renamed over, so readers never see half of it;
+	# the binary form used for fast loading is rewritten alongside (see manifest_store.py).
 	# Returns True if the write happened, False if remoteMf was not populated yet.
 	def replaceManifest(self):
 		if self.remoteMf is not None:
-			with open(self.localMfPath,'w') as outfile:
-				outfile.write(json.dumps(self.remoteMf, indent=2))
+			tmpPath = self.localMfPath + '.tmp' + str(os.getpid())
+			with open(tmpPath,'w') as outfile:
+				if 'sols' in self.remoteMf:
+					outfile.write(json.dumps(self.remoteMf, indent=2))
+				else:
+					manifest_store.exportJson(outfile, self.remoteMf, self.remoteIdx) # Streamed; no sols in memory
+			os.replace(tmpPath, self.localMfPath)
+			# Local is now the same as remote, so reuse the index rather than rebuilding.
+			self.local = (self.remoteMf, self.remoteIdx)
+			sharedCache.putLocal(self.sc, self.localMfPath, self.remoteMf, self.remoteIdx)
 			return True
 		else:
 			return False
 
 	# Make list of most recent sols (to push metadata to s3 to avoid unnecessary database hits.)
 	# (Specifically, if we go Dynamo, keeping the most recent sols on s3 helps avoid hot keys.)
+	# Only sols actually in the manifest are returned; missing sols are skipped rather than guessed at.
 	def findRecentSols(self):
-		latest = self.remoteMf['latest_sol']
-		self.recentSols = list(range(latest,latest-10,-1)) # Calling it 10 sols.
+		self.recentSols = self.activeIndex().latest(10) # Calling it 10 sols.
 	
 	# Make list of sols that have updated metadata compared to previous manifest
 	# This will let us only update the sols that need updating.
 	def findUpdatedSols(self):
 		oldManifTime = self.localMf['last_manifest_update']
-		for sol in self.remoteMf['sols']:
-			if util.cmptime(sol['last_manifest_update'],oldManifTime):
-				self.toUpdate.append(sol['sol'])
+		with metrics.stage('manifest_compare'):
+			self.toUpdate.extend(self.remoteIdx.updatedSince(oldManifTime))
 	
-	# Return a dictionary of metadata for a given sol - really just the bit of json for that sol.
-	# No good way to do except iterating...
-	# Also, since we know some sols are missing (grrr...), handle that.
-	def getSolMetadata(self,solNum):
-		# Check local if no remote, otherwise use remote:
+	# Index to use for lookups: local if no remote, otherwise remote.
+	def activeIndex(self):
 		if self.remoteMf is None:
-			for sol in self.localMf['sols']:
-				if sol['sol'] == solNum:
-					return sol
+			return self.localIdx
 		else:
-			for sol in self.remoteMf['sols']:
-				if sol['sol'] == solNum:
-					return sol
+			return self.remoteIdx
+
+	# Return a dictionary of metadata for a given sol - really just the bit of json for that sol.
+	# Since we know some sols are missing (grrr...), returns an empty dict for those.
+	def getSolMetadata(self,solNum):
+		return self.activeIndex().get(solNum)
+
+	# Return list of sols present in the manifest between first and last, inclusive.
+	def getSolRange(self,first,last):
+		return self.activeIndex().solRange(first,last)
 
-		return {} # If not in data, return empty dict.
+	# Return the n most recent sols present in the manifest, newest first.
+	def getLatestSols(self,n):
+		return self.activeIndex().latest(n)
 
 if __name__ == "__main__":
 	print("TESTING MODULE: manifest.py")
@@ -106,12 +194,17 @@ if __name__ == "__main__":
 	print(m.localMf['latest_sol'])
 	m.getRemoteManifest()
 	print(m.checkManifestTimes())
+	s = Manifest(spacecraft.MERB)
+	print(s.streamRemoteManifest())
+	print(s.toUpdate)
 	m.findRecentSols()
 	print(m.recentSols)
 	m.findUpdatedSols()
 	print(m.toUpdate)
 	print(m.getSolMetadata(4990))
 	print(m.getSolMetadata(4991))
+	print(m.getSolRange(4980,4990))
+	print(m.getLatestSols(5))
 	print(m.replaceManifest())
 	print("DONE.")
 
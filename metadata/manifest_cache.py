@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+#
+# Process-wide cache of parsed image manifests, keyed by mission.
+# Every Manifest (and so every SolMetadata) used to re-read and re-parse the local
+# image_manifest.json, and re-download the remote one on a miss. With this, a batch of
+# SolMetadata objects shares one parsed local manifest and one fetched remote manifest.
+# Local manifests are loaded from their memory-mapped binary form (see manifest_store.py) when
+# that's up to date with the json; otherwise the json is parsed and the binary form (re)written.
+# A fetched remote manifest is only reused for 'remote_manifest_ttl' seconds (from config), so a
+# long-running process (the scheduler, its workers) picks up upstream changes.
+#
+
+# Library imports
+import os
+import json
+import time
+import threading
+
+# marsrover-pipeline imports
+import metadata.config as config
+from metadata.sol_index import SolIndex
+import metadata.manifest_store as manifest_store
+
+DEFAULT_REMOTE_TTL = 300 # Seconds a fetched remote manifest is reused for, if not set in config
+
+class ManifestCache:
+	# remoteTtl is how long (seconds) a remote manifest is reused for; defaults to 'remote_manifest_ttl'
+	# in config (read when needed, not here), else DEFAULT_REMOTE_TTL.
+	def __init__(self, remoteTtl=None):
+		self.local = {}  # mission -> (path, (mtime, size), manifest, index)
+		self.remote = {} # mission -> (manifest, index, time.monotonic() when fetched)
+		self.remoteTtl = remoteTtl
+		self.lock = threading.Lock()
+
+	# Key used to detect the local file changing underneath us.
+	def statKey(self, path):
+		st = os.stat(path)
+		return (st.st_mtime_ns, st.st_size)
+
+	# Binary form lives next to the json: image_manifest.json -> image_manifest.*
+	def binaryBase(self, path):
+		return path[:-5] if path.endswith('.json') else path
+
+	# Save the binary form; best effort, since the json alone still works (e.g. read-only manifest dir).
+	def writeBinary(self, path, mf, idx, key):
+		try:
+			manifest_store.writeBinary(self.binaryBase(path), mf, idx, key)
+		except OSError:
+			pass
+
+	# Return (manifest, index) for the local manifest at path.
+	# Reloads only if the file's mtime or size changed since it was last loaded.
+	# Note a manifest loaded from the binary form has only the top-level fields, no 'sols'; use the index.
+	def getLocal(self, sc, path):
+		key = self.statKey(path)
+		with self.lock:
+			entry = self.local.get(sc['mission'])
+			if entry is not None and entry[0] == path and entry[1] == key:
+				return entry[2], entry[3]
+
+		loaded = manifest_store.loadBinary(self.binaryBase(path), key)
+		if loaded is not None:
+			mf, idx = loaded
+		else:
+			with open(path,'r') as infile:
+				mf = json.load(infile)
+			idx = SolIndex(mf)
+			self.writeBinary(path, mf, idx, key)
+
+		with self.lock:
+			self.local[sc['mission']] = (path, key, mf, idx)
+		return mf, idx
+
+	# Record a manifest that was just written to path, so the next getLocal() doesn't re-parse it.
+	# Also writes its binary form, for other processes.
+	def putLocal(self, sc, path, mf, idx):
+		key = self.statKey(path)
+		self.writeBinary(path, mf, idx, key)
+		with self.lock:
+			self.local[sc['mission']] = (path, key, mf, idx)
+
+	# Return (manifest, index) for the last remote manifest fetched this process, or (None, None)
+	# if there isn't one or it's older than the TTL.
+	def getRemote(self, sc):
+		ttl = self.remoteTtl
+		if ttl is None:
+			ttl = config.getConfig().get('remote_manifest_ttl', DEFAULT_REMOTE_TTL)
+		with self.lock:
+			entry = self.remote.get(sc['mission'])
+			if entry is None or time.monotonic() - entry[2] > ttl:
+				return None, None
+			return entry[0], entry[1]
+
+	def putRemote(self, sc, mf, idx):
+		with self.lock:
+			self.remote[sc['mission']] = (mf, idx, time.monotonic())
+
+	# Forget everything for a mission (or all missions if None).
+	def invalidate(self, sc=None):
+		with self.lock:
+			if sc is None:
+				self.local.clear()
+				self.remote.clear()
+			else:
+				self.local.pop(sc['mission'], None)
+				self.remote.pop(sc['mission'], None)
+
+# The one shared by everything in this process.
+sharedCache = ManifestCache()
+
+if __name__ == '__main__':
+	print("TESTING MODULE: manifest_cache.py")
+	import tempfile
+	import missions.spacecraft as spacecraft
+	with tempfile.TemporaryDirectory() as tmp:
+		path = os.path.join(tmp, 'image_manifest.json')
+		with open(path,'w') as outfile:
+			json.dump({'sols' : [{'sol' : 1, 'last_manifest_update' : '2018-02-05T12:00:00.000Z'}]}, outfile)
+		c = ManifestCache(remoteTtl=0.2)
+		a = c.getLocal(spacecraft.MERB, path)
+		b = c.getLocal(spacecraft.MERB, path)
+		print(a[0] is b[0]) # Shared, not re-parsed
+		with open(path,'w') as outfile:
+			json.dump({'sols' : [{'sol' : 1, 'last_manifest_update' : '2018-02-05T12:00:00.000Z'},
+								{'sol' : 2, 'last_manifest_update' : '2018-02-06T12:00:00.000Z'}]}, outfile)
+		print(len(c.getLocal(spacecraft.MERB, path)[1])) # Size changed, so re-parsed
+		print(ManifestCache().getLocal(spacecraft.MERB, path)[1].get(2)) # Fresh cache, from the binary form
+		print(c.getRemote(spacecraft.MERB))
+		c.putRemote(spacecraft.MERB, {'sols' : []}, a[1])
+		print(c.getRemote(spacecraft.MERB)[0])
+		time.sleep(0.3)
+		print(c.getRemote(spacecraft.MERB)) # Expired, so fetched again
+	print("DONE.")
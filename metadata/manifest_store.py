@@ -0,0 +1,304 @@
+#!/usr/bin/python3
+#
+# Compact binary on-disk form of a local image manifest, for fast startup.
+# Parsing the whole indent=2 image_manifest.json on every Manifest() is most of the startup cost.
+# Instead, next to it we keep:
+#	image_manifest.<gen>.npy      structured array, one row per sol (sorted): sol, num_images,
+#	                              parsed update time, and offset/length of that sol's entry json
+#	image_manifest.<gen>.entries  the per-sol entry json, back to back
+#	image_manifest.meta.json      top-level manifest fields, the current <gen>, and the stat of the
+#	                              json it was built from
+# Both data files are memory-mapped on load, so opening a mission's manifest only touches the pages
+# a lookup needs. The json is still written too, as an export.
+#
+# Writes are atomic: new data files get a new generation name, then the meta file is swapped in
+# with a rename. Readers only follow the meta file, so never see a half-written manifest.
+# Several processes (check, scheduler, backfill) may write at once. While a generation is being
+# written it has a marker file (image_manifest.<gen>.writing, holding the writer's host:pid), and
+# cleanup only removes generations that the meta file doesn't point at and no live writer owns.
+# BinaryWriter takes entries one at a time, so a streamed manifest can go straight to disk.
+#
+
+# Library imports
+import os
+import json
+import time
+import socket
+import numpy as np
+
+# marsrover-pipeline imports
+import metadata.util as util
+from metadata.sol_index import SolIndex
+
+ROW_DTYPE = np.dtype([('sol', '<i8'),
+					('num_images', '<i8'),    # -1 if missing from the entry
+					('updated', '<i8'),       # last_manifest_update, epoch microseconds
+					('entry_offset', '<i8'),  # into the .entries file
+					('entry_length', '<i8')])
+
+FORMAT_VERSION = 1
+
+# Compact, and reused: json.dumps builds a new encoder per call, which adds up over a streamed manifest.
+ENCODER = json.JSONEncoder(separators=(',', ':'))
+
+# SolIndex backed by the memory-mapped rows; entries are only decoded when asked for.
+class BinarySolIndex(SolIndex):
+	def __init__(self, rows, entries):
+		SolIndex.__init__(self, None)
+		self.rows = rows
+		self.entries = entries
+		self.solArray = rows['sol']
+		self.updateTimes = rows['updated']
+		self.sols = self.solArray.tolist()
+		self.bySol = None # Not used; see get()
+
+	def find(self, solNum):
+		i = int(np.searchsorted(self.solArray, solNum))
+		if i < len(self.solArray) and self.solArray[i] == solNum:
+			return i
+		return None
+
+	def __contains__(self, solNum):
+		return self.find(solNum) is not None
+
+	def get(self, solNum):
+		i = self.find(solNum)
+		if i is None:
+			return {}
+		offset = int(self.rows['entry_offset'][i])
+		length = int(self.rows['entry_length'][i])
+		return json.loads(self.entries[offset:offset+length].tobytes())
+
+# Builds a new generation of the binary form one sol entry at a time.
+# Entries can come in any order (and repeat; the last one for a sol wins, as in SolIndex).
+# Nothing is visible to readers until finish().
+class BinaryWriter:
+	def __init__(self, base):
+		self.base = base
+		self.gen = '%d.%d' % (time.time_ns(), os.getpid())
+		# Marker first (renamed into place, so it's never seen empty), so cleanup never sees this
+		# generation's data files without it.
+		with open(markerPath(base, self.gen) + '.tmp', 'w') as outfile:
+			outfile.write('%s:%d' % (socket.gethostname(), os.getpid()))
+		os.replace(markerPath(base, self.gen) + '.tmp', markerPath(base, self.gen))
+		self.entriesFile = open(entriesPath(base, self.gen), 'wb')
+		self.rows = np.zeros(1024, dtype=ROW_DTYPE)
+		self.count = 0
+		self.offset = 0
+
+	# Returns the entry's parsed last_manifest_update (epoch microseconds), since callers usually want it too.
+	def add(self, entry):
+		encoded = ENCODER.encode(entry).encode('utf-8')
+		self.entriesFile.write(encoded)
+		if self.count == len(self.rows):
+			self.rows = np.resize(self.rows, 2 * len(self.rows))
+		updated = util.parseTime(entry['last_manifest_update'])
+		self.rows[self.count] = (entry['sol'], entry.get('num_images', -1), updated, self.offset, len(encoded))
+		self.count += 1
+		self.offset += len(encoded)
+		return updated
+
+	# Commit: top is the top-level manifest fields, sourceKey identifies the json this matches (if any).
+	# Returns (top, BinarySolIndex) for the new generation. Raises (OSError, ...) if it can't be written.
+	def finish(self, top, sourceKey=None):
+		self.entriesFile.close()
+		meta = {k : v for k, v in top.items() if k != 'sols'}
+		meta['_binary'] = {'version' : FORMAT_VERSION, 'gen' : self.gen, 'source' : list(sourceKey) if sourceKey is not None else None}
+		tmpPath = metaPath(self.base) + '.tmp' + self.gen
+		try:
+			# Sort by sol, keeping the last entry for any repeated sol.
+			rows = self.rows[:self.count]
+			rows = rows[np.argsort(rows['sol'], kind='stable')]
+			keep = np.ones(len(rows), dtype=bool)
+			keep[:-1] = rows['sol'][:-1] != rows['sol'][1:]
+			np.save(rowsPath(self.base, self.gen), rows[keep])
+			with open(tmpPath, 'w') as outfile:
+				json.dump(meta, outfile)
+		except BaseException:
+			for path in (rowsPath(self.base, self.gen), tmpPath):
+				try:
+					os.remove(path)
+				except OSError:
+					pass
+			self.abort()
+			raise
+
+		# Commit point: swap in the new meta file. The new generation is mapped before anything is
+		# cleaned up, so it stays readable here even if a later writer's cleanup removes it.
+		os.replace(tmpPath, metaPath(self.base))
+		loaded = loadGeneration(self.base, self.gen)
+		removeMarker(self.base, self.gen)
+		removeOldGenerations(self.base)
+
+		del meta['_binary']
+		return meta, loaded
+
+	# Throw away a half-built generation.
+	def abort(self):
+		self.entriesFile.close()
+		try:
+			os.remove(entriesPath(self.base, self.gen))
+		except OSError:
+			pass
+		removeMarker(self.base, self.gen)
+
+# Write the binary form of manifest mf (already indexed as idx) next to base (the json path minus '.json').
+# sourceKey identifies the json it matches (see ManifestCache.statKey), so a stale binary is ignored.
+def writeBinary(base, mf, idx, sourceKey):
+	writer = BinaryWriter(base)
+	for sol in idx.sols:
+		writer.add(idx.get(sol))
+	writer.finish(mf, sourceKey)
+
+# Write a manifest held as (top-level fields, index) out as json, one sol entry at a time.
+# Used to export a streamed manifest without ever building the whole document.
+def exportJson(outfile, top, idx):
+	outfile.write('{')
+	for key, value in top.items():
+		if key != 'sols':
+			outfile.write(json.dumps(key) + ': ' + json.dumps(value) + ',\n')
+	outfile.write('"sols": [')
+	for i, sol in enumerate(idx.sols):
+		outfile.write((',\n' if i else '\n') + json.dumps(idx.get(sol)))
+	outfile.write('\n]}\n')
+
+def metaPath(base):
+	return base + '.meta.json'
+
+def rowsPath(base, gen):
+	return base + '.' + gen + '.npy'
+
+def entriesPath(base, gen):
+	return base + '.' + gen + '.entries'
+
+def markerPath(base, gen):
+	return base + '.' + gen + '.writing'
+
+def removeMarker(base, gen):
+	try:
+		os.remove(markerPath(base, gen))
+	except OSError:
+		pass
+
+# True if the writer of generation gen is still at it: its marker is there, and the process that
+# wrote it is alive (or on another host, where we can't tell, so it's assumed to be).
+def writerAlive(base, gen):
+	try:
+		with open(markerPath(base, gen), 'r') as infile:
+			host, pid = infile.read().rsplit(':', 1)
+		if host != socket.gethostname():
+			return True
+		os.kill(int(pid), 0)
+		return True
+	except ProcessLookupError:
+		return False # Writer died; its marker is left over
+	except PermissionError:
+		return True # Someone else's process, but alive
+	except (OSError, ValueError):
+		return False # No marker (or unreadable): not being written
+
+# Remove data files of every generation the meta file doesn't point at, except ones a live writer
+# is still writing (they're about to be committed). Markers of dead writers go too.
+def removeOldGenerations(base):
+	directory, name = os.path.split(base)
+	try:
+		with open(metaPath(base), 'r') as infile:
+			current = json.load(infile)['_binary']['gen']
+	except (OSError, ValueError, KeyError):
+		return # Can't tell which generation is current, so leave everything
+	gens = {}
+	for f in os.listdir(directory or '.'):
+		for suffix in ('.npy', '.entries', '.writing'):
+			if f.startswith(name + '.') and f.endswith(suffix):
+				gens.setdefault(f[len(name)+1:-len(suffix)], []).append(f)
+	for gen, files in gens.items():
+		if gen == current or writerAlive(base, gen):
+			continue
+		for f in files:
+			try:
+				os.remove(os.path.join(directory, f))
+			except OSError:
+				pass
+
+# Load the binary form. Returns (top-level manifest fields, BinarySolIndex), or None if there isn't a
+# usable one (missing, older format, or built from a json other than sourceKey).
+# The returned manifest dict has no 'sols'; use the index for those.
+def loadBinary(base, sourceKey=None):
+	for attempt in range(3):
+		try:
+			with open(metaPath(base), 'r') as infile:
+				meta = json.load(infile)
+			info = meta.pop('_binary')
+			if info['version'] != FORMAT_VERSION:
+				return None
+			if sourceKey is not None and (info['source'] is None or tuple(info['source']) != tuple(sourceKey)):
+				return None
+
+			return meta, loadGeneration(base, info['gen'])
+		except FileNotFoundError:
+			# A writer replaced the generation between reading meta and opening it; read meta again.
+			continue
+		except (OSError, ValueError, KeyError):
+			return None
+	return None
+
+# Map the data files of one generation as a BinarySolIndex. Raises OSError if they're missing.
+def loadGeneration(base, gen):
+	rows = np.load(rowsPath(base, gen), mmap_mode='r')
+	if os.path.getsize(entriesPath(base, gen)) > 0:
+		entries = np.memmap(entriesPath(base, gen), dtype=np.uint8, mode='r')
+	else:
+		entries = np.zeros(0, dtype=np.uint8)
+	return BinarySolIndex(rows, entries)
+
+if __name__ == '__main__':
+	print("TESTING MODULE: manifest_store.py")
+	import tempfile
+	mf = {'latest_sol' : 10, 'last_manifest_update' : '2018-02-10T12:00:00.000Z', 'most_recent_image' : '2018-02-10T12:00:00.000Z',
+		'sols' : [{'sol' : s, 'num_images' : s * 2, 'last_manifest_update' : '2018-02-%02dT12:00:00.000Z' % s, 'url' : 'u' + str(s)} for s in [1, 2, 3, 5, 7, 10]]}
+	with tempfile.TemporaryDirectory() as tmp:
+		base = os.path.join(tmp, 'image_manifest')
+		print(loadBinary(base))
+		writeBinary(base, mf, SolIndex(mf), (1, 2))
+		top, idx = loadBinary(base, (1, 2))
+		print(top)
+		print(idx.get(5), idx.get(4), 7 in idx)
+		print(idx.solRange(2, 7), idx.latest(2), idx.updatedSince('2018-02-04T00:00:00.000Z'))
+		print(loadBinary(base, (1, 3)))
+		writeBinary(base, mf, SolIndex(mf), (1, 3))
+		print(sorted(os.listdir(tmp)).__len__()) # meta + one generation
+		print(loadBinary(base, (1, 3))[1].get(10))
+		writeBinary(base, {'sols' : []}, SolIndex({'sols' : []}), (0, 0))
+		print(len(loadBinary(base)[1]))
+
+		# Streamed: out of order, with a repeat
+		w = BinaryWriter(base)
+		for entry in mf['sols'][3:] + mf['sols'][:3] + [dict(mf['sols'][0], num_images=99)]:
+			w.add(entry)
+		top, idx = w.finish({'latest_sol' : 10})
+		print(idx.sols, idx.get(1)['num_images'])
+
+		# Two writers at once: committing one leaves the other's (older) generation alone,
+		# and the other still commits and loads fine afterwards.
+		slow = BinaryWriter(base)
+		fast = BinaryWriter(base)
+		for entry in mf['sols']:
+			slow.add(entry)
+			fast.add(entry)
+		fast.finish({'latest_sol' : 10})
+		print(os.path.exists(entriesPath(base, slow.gen)))
+		top, idx = slow.finish({'latest_sol' : 10})
+		print(top, len(idx), loadBinary(base)[1].sols == idx.sols, sorted(os.listdir(tmp)).__len__())
+
+		# A writer that died part way: its generation is cleaned up by the next commit.
+		dead = BinaryWriter(base)
+		dead.entriesFile.close()
+		with open(markerPath(base, dead.gen), 'w') as outfile:
+			outfile.write('%s:%d' % (socket.gethostname(), 2**22 + 1)) # No such pid
+		writeBinary(base, mf, SolIndex(mf), (1, 4))
+		print(sorted(os.listdir(tmp)).__len__())
+		import io
+		out = io.StringIO()
+		exportJson(out, mf, SolIndex(mf))
+		print(json.loads(out.getvalue()) == mf)
+	print("DONE.")
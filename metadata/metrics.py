@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+#
+# Lightweight instrumentation: per-stage timing histograms and counters for the whole pipeline,
+# exported as a JSON run report and/or a Prometheus text file (for node_exporter's textfile collector).
+# Recording is a perf_counter call and a dict update under a lock, so it's fine to leave on.
+#
+# Stages are timed with the stage() context manager:
+#	with metrics.registry.stage('image_decode'):
+#		...
+# and counted with registry.count('frames_decoded'). Stages named in profileStages also run under
+# cProfile (one profile per stage, accumulated), for digging into a single slow stage.
+#
+# Each process has its own registry; pipeline.backfill merges the workers' snapshots into its own.
+#
+
+# Library imports
+import os
+import json
+import time
+import bisect
+import threading
+import contextlib
+
+# Histogram bucket upper bounds, seconds.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+PROM_PREFIX = 'marsrover_'
+
+class Histogram:
+	def __init__(self):
+		self.counts = [0] * (len(BUCKETS) + 1) # Last is +Inf
+		self.count = 0
+		self.sum = 0.0
+		self.min = None
+		self.max = None
+
+	def observe(self, seconds):
+		self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+		self.count += 1
+		self.sum += seconds
+		self.min = seconds if self.min is None else min(self.min, seconds)
+		self.max = seconds if self.max is None else max(self.max, seconds)
+
+	def toDict(self):
+		return {'count' : self.count, 'sum' : self.sum, 'min' : self.min, 'max' : self.max,
+				'mean' : self.sum / self.count if self.count else None, 'buckets' : list(self.counts)}
+
+	def merge(self, d):
+		self.counts = [a + b for a, b in zip(self.counts, d['buckets'])]
+		self.count += d['count']
+		self.sum += d['sum']
+		for attr, pick in (('min', min), ('max', max)):
+			if d[attr] is not None:
+				setattr(self, attr, d[attr] if getattr(self, attr) is None else pick(getattr(self, attr), d[attr]))
+
+class Metrics:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.counters = {}
+		self.histograms = {}
+		self.profileStages = set()
+		self.profiles = {} # stage -> pstats.Stats, accumulated
+		self.profiling = threading.local() # Only one cProfile can run per thread; nested stages aren't profiled
+		self.started = time.time()
+
+	def count(self, name, n=1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+
+	def observe(self, name, seconds):
+		with self.lock:
+			hist = self.histograms.get(name)
+			if hist is None:
+				hist = self.histograms[name] = Histogram()
+			hist.observe(seconds)
+
+	@contextlib.contextmanager
+	def stage(self, name):
+		profiler = None
+		if name in self.profileStages and not getattr(self.profiling, 'active', False):
+			import cProfile # Only when profiling; it's most of this module's import time
+			profiler = cProfile.Profile()
+			self.profiling.active = True
+			profiler.enable()
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(name, time.perf_counter() - start)
+			if profiler is not None:
+				profiler.disable()
+				self.profiling.active = False
+				import pstats
+				with self.lock:
+					if name in self.profiles:
+						self.profiles[name].add(profiler)
+					else:
+						self.profiles[name] = pstats.Stats(profiler)
+
+	# Turn on cProfile for these stages (names, or a comma-separated string).
+	def profile(self, stages):
+		if isinstance(stages, str):
+			stages = [s for s in stages.split(',') if s]
+		self.profileStages.update(stages)
+
+	# Clear counters and timings. Profiles keep accumulating for the life of the process.
+	def reset(self):
+		with self.lock:
+			self.counters = {}
+			self.histograms = {}
+			self.started = time.time()
+
+	# Plain-dict copy, e.g. to send back from a worker process.
+	def snapshot(self):
+		with self.lock:
+			return {'started' : self.started, 'counters' : dict(self.counters),
+					'stages' : {name : hist.toDict() for name, hist in self.histograms.items()}}
+
+	# Fold in a snapshot (from another process).
+	def merge(self, snap):
+		with self.lock:
+			for name, n in snap['counters'].items():
+				self.counters[name] = self.counters.get(name, 0) + n
+			for name, d in snap['stages'].items():
+				if name not in self.histograms:
+					self.histograms[name] = Histogram()
+				self.histograms[name].merge(d)
+
+	def report(self):
+		snap = self.snapshot()
+		snap['finished'] = time.time()
+		snap['bucket_bounds'] = list(BUCKETS) + ['+Inf']
+		return snap
+
+	def writeJson(self, path):
+		atomicWrite(path, json.dumps(self.report(), indent=2, sort_keys=True))
+
+	def prometheusText(self):
+		snap = self.snapshot()
+		lines = ['# HELP %sstage_seconds Time spent per pipeline stage.' % PROM_PREFIX,
+				'# TYPE %sstage_seconds histogram' % PROM_PREFIX]
+		for name, d in sorted(snap['stages'].items()):
+			cumulative = 0
+			for bound, n in zip(list(BUCKETS) + ['+Inf'], d['buckets']):
+				cumulative += n
+				lines.append('%sstage_seconds_bucket{stage="%s",le="%s"} %d' % (PROM_PREFIX, name, bound, cumulative))
+			lines.append('%sstage_seconds_sum{stage="%s"} %f' % (PROM_PREFIX, name, d['sum']))
+			lines.append('%sstage_seconds_count{stage="%s"} %d' % (PROM_PREFIX, name, d['count']))
+		for name, n in sorted(snap['counters'].items()):
+			lines.append('# TYPE %s%s_total counter' % (PROM_PREFIX, name))
+			lines.append('%s%s_total %s' % (PROM_PREFIX, name, n))
+		return '\n'.join(lines) + '\n'
+
+	def writePrometheus(self, path):
+		atomicWrite(path, self.prometheusText())
+
+	# Write each profiled stage's stats to <directory>/<stage>.<pid>.prof (load with pstats / snakeviz).
+	def writeProfiles(self, directory):
+		os.makedirs(directory, exist_ok=True)
+		with self.lock:
+			for name, stats in self.profiles.items():
+				stats.dump_stats(os.path.join(directory, '%s.%d.prof' % (name, os.getpid())))
+
+# Collectors read these files while we write them, so write to a temp name and rename.
+def atomicWrite(path, text):
+	tmpPath = path + '.tmp' + str(os.getpid())
+	with open(tmpPath, 'w') as outfile:
+		outfile.write(text)
+	os.replace(tmpPath, path)
+
+# The process-wide registry everything records into.
+registry = Metrics()
+
+if __name__ == '__main__':
+	print("TESTING MODULE: metrics.py")
+	import tempfile
+	m = Metrics()
+	for i in range(5):
+		with m.stage('image_decode'):
+			time.sleep(0.002)
+	m.count('frames_decoded', 5)
+	m.count('bytes_downloaded', 1024)
+	snap = m.snapshot()
+	print(snap['counters'], snap['stages']['image_decode']['count'], snap['stages']['image_decode']['sum'] > 0.01)
+
+	# Overhead of an un-profiled stage
+	start = time.perf_counter()
+	for i in range(100000):
+		with m.stage('noop'):
+			pass
+	print("stage overhead under %d us" % (1 + (time.perf_counter() - start) * 10))
+
+	# Merge (as from a worker process), and exceptions still get timed
+	other = Metrics()
+	try:
+		with other.stage('image_decode'):
+			raise ValueError()
+	except ValueError:
+		pass
+	other.count('frames_decoded')
+	m.merge(other.snapshot())
+	print(m.snapshot()['counters']['frames_decoded'], m.snapshot()['stages']['image_decode']['count'])
+
+	m.profile('composite')
+	with m.stage('composite'):
+		with m.stage('composite'): # Nested; only the outer one is profiled
+			sum(range(10000))
+	print(list(m.profiles))
+	text = m.prometheusText()
+	print([l for l in text.splitlines() if 'image_decode' in l and ('+Inf' in l or '_count' in l)])
+	print([l for l in text.splitlines() if 'frames_decoded' in l])
+	with tempfile.TemporaryDirectory() as tmp:
+		m.writeJson(os.path.join(tmp, 'report.json'))
+		m.writePrometheus(os.path.join(tmp, 'metrics.prom'))
+		m.writeProfiles(os.path.join(tmp, 'profiles'))
+		with open(os.path.join(tmp, 'report.json')) as infile:
+			print(sorted(json.load(infile)))
+		print(os.listdir(os.path.join(tmp, 'profiles'))[0].startswith('composite.'))
+	print("DONE.")
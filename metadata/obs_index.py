@@ -0,0 +1,271 @@
+#!/usr/bin/python3
+#
+# Mission-wide index of observations and images, built up from the per-sol image manifests
+# SolMetadata fetches. Pancam.getObs and friends only see one sol's block; this answers questions
+# across all of them ("every L257-capable Pancam observation in sequence P2xxx", "all MI frames
+# between sols 3000 and 3100") from local disk, in milliseconds, without fetching anything.
+#
+# Per observation: sol, instrument, obs id, sequence id, filters (eye + filter number, e.g. L2);
+# per image: its obs, filter and url. A sol is re-indexed only when its manifest time changes,
+# and re-indexing replaces everything for that sol, so removed observations drop out too.
+#
+# SQLite in WAL mode at <manifest_path>/obs_index.sqlite, like the state store, so parallel
+# backfill workers can all add to it.
+#
+# Usage, from the root directory:
+#     marsrover-pipeline $ python3 -m metadata.obs_index build merb --sols 1 5000
+#     marsrover-pipeline $ python3 -m metadata.obs_index query merb --instrument pancam --seq P2 --product L257
+#     marsrover-pipeline $ python3 -m metadata.obs_index query merb --instrument mi --sols 3000 3100 --images
+#
+
+# Library imports
+import sys
+import time
+import sqlite3
+import argparse
+
+# marsrover-pipeline imports
+import metadata.config as config
+import metadata.sol_diff as sol_diff
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS sols (
+	mission TEXT NOT NULL,
+	sol INTEGER NOT NULL,
+	manifest_time TEXT,         -- last_manifest_update of the sol manifest that was indexed
+	indexed REAL NOT NULL,
+	PRIMARY KEY (mission, sol));
+CREATE TABLE IF NOT EXISTS observations (
+	mission TEXT NOT NULL,
+	sol INTEGER NOT NULL,
+	instrument TEXT NOT NULL,   -- as in spacecraft instruments, e.g. 'pancam'
+	obs_id TEXT NOT NULL,
+	seq_id TEXT,                -- e.g. 'P2532'; NULL where the image ids don't carry one (MSL)
+	filters TEXT,               -- sorted, comma-separated, e.g. 'L2,L5,L7'; NULL if none known
+	num_images INTEGER NOT NULL,
+	PRIMARY KEY (mission, sol, instrument, obs_id));
+CREATE INDEX IF NOT EXISTS observations_seq ON observations (mission, seq_id);
+CREATE TABLE IF NOT EXISTS images (
+	mission TEXT NOT NULL,
+	sol INTEGER NOT NULL,
+	instrument TEXT NOT NULL,
+	obs_id TEXT NOT NULL,
+	image_id TEXT NOT NULL,
+	filter TEXT,
+	url TEXT NOT NULL,
+	PRIMARY KEY (mission, sol, instrument, image_id));
+CREATE INDEX IF NOT EXISTS images_obs ON images (mission, obs_id)"""
+
+# Sequence id of an observation: characters 18-22 of a MER image id (as Pancam.getSeqId).
+# None for missions whose ids don't follow the MER naming.
+def seqId(sc, obsId):
+	if sc['spacecraft'] in ('MER1', 'MER2') and len(obsId) >= 23:
+		return obsId[18:23]
+	return None
+
+# Eye + filter number of an image (e.g. 'L2'), as Pancam.getObsFilters; None if the entry has no filter.
+def imageFilter(image):
+	if 'filter_number' not in image:
+		return None
+	return image['imageid'][-4] + str(image['filter_number'])
+
+# Filter positions a product (by name, see composite.py) needs.
+def productFilters(name):
+	import missions.mer.composite as composite # Only the product specs are needed, not the engine
+	for product in composite.DEFAULT_PRODUCTS:
+		if product['name'] == name:
+			return sorted(composite.requiredFilters(product))
+	raise ValueError('unknown product: ' + name)
+
+class ObsIndex:
+	# path defaults to <manifest_path>/obs_index.sqlite
+	def __init__(self, path=None):
+		if path is None:
+			path = config.getConfig()['manifest_path'] + 'obs_index.sqlite'
+		self.path = path
+		self.db = sqlite3.connect(path, timeout=60)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=NORMAL')
+		with self.db:
+			self.db.executescript(SCHEMA)
+
+	# Index one sol's image manifest (the json SolMetadata fetches, its imageMd).
+	# Skipped if this manifest time is already indexed; returns True if the sol was (re)indexed.
+	def addSol(self, sc, sol, imageMd):
+		mission = sc['mission']
+		manifestTime = imageMd.get('last_manifest_update')
+		row = self.db.execute('SELECT manifest_time FROM sols WHERE mission=? AND sol=?', (mission, sol)).fetchone()
+		if row is not None and manifestTime is not None and row[0] == manifestTime:
+			return False
+
+		observations = []
+		images = []
+		for inst, key in sc['instruments'].items():
+			for obsId, obsImages in sol_diff.indexObs(imageMd.get(key)).items():
+				filters = sorted(set(f for f in (imageFilter(im) for im in obsImages.values()) if f is not None))
+				observations.append((mission, sol, inst, obsId, seqId(sc, obsId), ','.join(filters) if filters else None, len(obsImages)))
+				images.extend((mission, sol, inst, obsId, imageId, imageFilter(im), im['url']) for imageId, im in obsImages.items())
+
+		with self.db:
+			self.db.execute('DELETE FROM observations WHERE mission=? AND sol=?', (mission, sol))
+			self.db.execute('DELETE FROM images WHERE mission=? AND sol=?', (mission, sol))
+			self.db.executemany('INSERT OR REPLACE INTO observations VALUES (?,?,?,?,?,?,?)', observations)
+			self.db.executemany('INSERT OR REPLACE INTO images VALUES (?,?,?,?,?,?,?)', images)
+			self.db.execute('INSERT OR REPLACE INTO sols VALUES (?,?,?,?)', (mission, sol, manifestTime, time.time()))
+		return True
+
+	# Indexed sols of a mission as {sol : manifest time}.
+	def indexedSols(self, mission):
+		return dict(self.db.execute('SELECT sol, manifest_time FROM sols WHERE mission=? ORDER BY sol', (mission,)).fetchall())
+
+	# Shared WHERE clause for findObs/findImages. alias is the table being filtered.
+	def where(self, alias, mission, instrument, sols):
+		clauses = [alias + '.mission=?']
+		params = [mission]
+		if instrument is not None:
+			clauses.append(alias + '.instrument=?')
+			params.append(instrument)
+		if sols is not None:
+			clauses.append(alias + '.sol BETWEEN ? AND ?')
+			params.extend(sols)
+		return clauses, params
+
+	# Observations matching every given condition, ordered by sol then obs id. Each is a dict:
+	# {'sol', 'instrument', 'obs_id', 'seq_id', 'filters' : [...], 'num_images'}.
+	#	instrument: e.g. 'pancam'
+	#	sols: (first, last), inclusive
+	#	seq: sequence id, or a prefix of one ('P2' matches P2000-P2999)
+	#	filters: filter positions the observation must all have (e.g. ['L2', 'L5', 'L7'])
+	#	product: a product name the observation must be able to make (e.g. 'L257'); same as its filters
+	def findObs(self, mission, instrument=None, sols=None, seq=None, filters=None, product=None, limit=None):
+		clauses, params = self.where('o', mission, instrument, sols)
+		if seq is not None:
+			clauses.append('o.seq_id GLOB ?') # Case sensitive, so it can use the index
+			params.append(seq + '*')
+		required = set(filters or [])
+		if product is not None:
+			required.update(productFilters(product))
+		for f in sorted(required):
+			clauses.append("(',' || o.filters || ',') LIKE ?")
+			params.append('%,' + f + ',%')
+		query = ('SELECT o.sol, o.instrument, o.obs_id, o.seq_id, o.filters, o.num_images FROM observations o WHERE '
+				+ ' AND '.join(clauses) + ' ORDER BY o.sol, o.obs_id')
+		if limit is not None:
+			query += ' LIMIT %d' % limit
+		return [{'sol' : r[0], 'instrument' : r[1], 'obs_id' : r[2], 'seq_id' : r[3],
+				'filters' : r[4].split(',') if r[4] else [], 'num_images' : r[5]}
+				for r in self.db.execute(query, params)]
+
+	# Images matching every given condition, ordered by sol then image id. Each is a dict:
+	# {'sol', 'instrument', 'obs_id', 'image_id', 'filter', 'url'}.
+	#	obsId: only this observation's images
+	#	filters: only images taken through one of these filter positions
+	def findImages(self, mission, instrument=None, sols=None, obsId=None, filters=None, limit=None):
+		clauses, params = self.where('i', mission, instrument, sols)
+		if obsId is not None:
+			clauses.append('i.obs_id=?')
+			params.append(obsId)
+		if filters:
+			clauses.append('i.filter IN (%s)' % ','.join('?' * len(filters)))
+			params.extend(filters)
+		query = ('SELECT i.sol, i.instrument, i.obs_id, i.image_id, i.filter, i.url FROM images i WHERE '
+				+ ' AND '.join(clauses) + ' ORDER BY i.sol, i.image_id')
+		if limit is not None:
+			query += ' LIMIT %d' % limit
+		return [{'sol' : r[0], 'instrument' : r[1], 'obs_id' : r[2], 'image_id' : r[3], 'filter' : r[4], 'url' : r[5]}
+				for r in self.db.execute(query, params)]
+
+	# Observation ids per sol, for driving a targeted reprocess: {sol : [obs ids]}.
+	# Takes the same arguments as findObs.
+	def obsBySol(self, mission, **conditions):
+		bySol = {}
+		for obs in self.findObs(mission, **conditions):
+			bySol.setdefault(obs['sol'], []).append(obs['obs_id'])
+		return bySol
+
+	def close(self):
+		self.db.close()
+
+# Index sols from their manifests (through the HTTP cache, so sols fetched before cost a conditional GET).
+# Manifests are fetched in parallel; the index is written from this thread only.
+def build(sc, sols, index, workers=8, progress=None):
+	import concurrent.futures
+	import metadata.sol_metadata as solmd
+	indexed = 0
+	with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+		for sol, sd in zip(sols, pool.map(lambda s: solmd.SolMetadata(sc, s), sols)):
+			if sd.initStatus and index.addSol(sc, sol, sd.imageMd):
+				indexed += 1
+			if progress is not None:
+				progress(sol, sd.initStatus)
+	return indexed
+
+if __name__ == '__main__' and len(sys.argv) > 1:
+	import missions.spacecraft as spacecraft
+	parser = argparse.ArgumentParser(description='Build or query the mission-wide observation index.')
+	parser.add_argument('command', choices=['build', 'query'])
+	parser.add_argument('mission', choices=sorted(spacecraft.MISSIONS))
+	parser.add_argument('--sols', nargs=2, type=int, metavar=('FIRST', 'LAST'), help='inclusive sol range')
+	parser.add_argument('--instrument', default=None, help="e.g. pancam, mi (query)")
+	parser.add_argument('--seq', default=None, help='sequence id or prefix, e.g. P2 (query)')
+	parser.add_argument('--filters', default=None, help='comma-separated filter positions an observation must have, e.g. L2,R2 (query)')
+	parser.add_argument('--product', default=None, help='product an observation must be able to make, e.g. L257 (query)')
+	parser.add_argument('--images', action='store_true', help='list matching images and their urls instead of observations (query)')
+	parser.add_argument('--workers', type=int, default=8, help='concurrent manifest downloads (build)')
+	args = parser.parse_args()
+
+	sc = spacecraft.MISSIONS[args.mission]
+	index = ObsIndex()
+	if args.command == 'build':
+		import metadata.manifest as manifest
+		m = manifest.Manifest(sc)
+		sols = m.getSolRange(args.sols[0], args.sols[1]) if args.sols else m.getSolRange(0, sys.maxsize)
+		print("Indexed %d of %d sols" % (build(sc, sols, index, args.workers), len(sols)))
+	else:
+		start = time.perf_counter()
+		filters = args.filters.split(',') if args.filters else None
+		if args.images:
+			rows = index.findImages(args.mission, args.instrument, args.sols, filters=filters)
+			for r in rows:
+				print(r['sol'], r['obs_id'], r['image_id'], r['filter'] or '-', r['url'])
+		else:
+			rows = index.findObs(args.mission, args.instrument, args.sols, args.seq, filters, args.product)
+			for r in rows:
+				print(r['sol'], r['instrument'], r['obs_id'], r['seq_id'] or '-', ','.join(r['filters']) or '-', r['num_images'])
+		print("%d found in %.1f ms" % (len(rows), (time.perf_counter() - start) * 1000), file=sys.stderr)
+	index.close()
+	sys.exit(0)
+
+if __name__ == '__main__':
+	print("TESTING MODULE: obs_index.py")
+	import os
+	import tempfile
+	import missions.spacecraft as spacecraft
+	import bench.synthetic as synthetic
+	with tempfile.TemporaryDirectory() as tmp:
+		index = ObsIndex(os.path.join(tmp, 'obs_index.sqlite'))
+		md = synthetic.makeSolManifest(spacecraft.MERB, 3000, '2018-02-05T12:00:00.000Z', numObs=3)
+		md['pcam_images'][1]['images'] = [im for im in md['pcam_images'][1]['images'] if im['imageid'][-4:-2] in ('L2', 'R2')]
+		md['mi_images'] = [{'id' : '1M000000000EFF0000P2956M2M1', 'images' : [{'imageid' : '1M000000000EFF0000P2956M2M1', 'url' : 'u'}]}]
+		print(index.addSol(spacecraft.MERB, 3000, md), index.addSol(spacecraft.MERB, 3000, md)) # Second is a no-op
+		print(index.indexedSols('merb'))
+		obs = index.findObs('merb', 'pancam')
+		print(len(obs), obs[1]['seq_id'], obs[1]['filters'])
+		print(len(index.findObs('merb', product='L257')), len(index.findObs('merb', filters=['L2', 'R2'])))
+		print(len(index.findObs('merb', seq=obs[0]['seq_id'][:2])), index.findObs('merb', seq='Q'))
+		print(index.findImages('merb', 'mi', (2990, 3010)))
+		print(len(index.findImages('merb', obsId=obs[0]['obs_id'])), len(index.findImages('merb', 'pancam', filters=['L2'])))
+
+		# A newer manifest replaces the sol; observations gone from it are gone from the index
+		md['last_manifest_update'] = '2018-02-06T12:00:00.000Z'
+		del md['pcam_images'][0]
+		print(index.addSol(spacecraft.MERB, 3000, md), len(index.findObs('merb', 'pancam')))
+		print(index.obsBySol('merb', instrument='pancam', product='L2R2'))
+
+		# Mission-wide query speed over ~5000 sols of 10 Pancam observations
+		for sol in range(1, 5000):
+			index.addSol(spacecraft.MERB, sol, synthetic.makeSolManifest(spacecraft.MERB, sol, '2018-02-05T12:00:00.000Z', numObs=10))
+		start = time.perf_counter()
+		found = index.findObs('merb', 'pancam', (3000, 3100), seq='P2305', product='L257')
+		print(len(found), "found in under %d ms" % (1 + (time.perf_counter() - start) * 1000))
+		index.close()
+	print("DONE.")
@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+#
+# Image-level diffing of per-sol image manifests (the json SolMetadata fetches).
+# findUpdatedSols only says *that* a sol changed; on an active mission a downlink usually adds a
+# handful of frames to a sol that already has hundreds. Comparing against a snapshot of the
+# last-seen sol manifest says exactly which observations and images are new, gone, or changed,
+# so only those get reprocessed.
+#
+
+# Library imports
+import os
+import json
+import threading
+
+# marsrover-pipeline imports
+import metadata.config as config
+
+# Flatten one instrument's block into {obsId : {imageid : image dict}}.
+# MER blocks are observations with an 'images' list; a bare image entry is treated as its own observation.
+def indexObs(block):
+	obs = {}
+	for entry in block or []:
+		if 'images' in entry:
+			obs[entry['id']] = {im['imageid'] : im for im in entry['images']}
+		else:
+			obs[entry['imageid']] = {entry['imageid'] : entry}
+	return obs
+
+class SolDiff:
+	def __init__(self, old, new, instruments):
+		self.instruments = {}
+		for inst, key in instruments.items():
+			oldObs = indexObs(old.get(key) if old is not None else None)
+			newObs = indexObs(new.get(key))
+			d = {'added_obs' : [], 'removed_obs' : [], 'changed_obs' : [],
+				'added_images' : [], 'removed_images' : [], 'changed_images' : []}
+
+			for obsId, images in newObs.items():
+				if obsId not in oldObs:
+					d['added_obs'].append(obsId)
+					d['added_images'].extend(images)
+					continue
+				oldImages = oldObs[obsId]
+				added = [i for i in images if i not in oldImages]
+				removed = [i for i in oldImages if i not in images]
+				changed = [i for i in images if i in oldImages and images[i] != oldImages[i]]
+				if added or removed or changed:
+					d['changed_obs'].append(obsId)
+					d['added_images'].extend(added)
+					d['removed_images'].extend(removed)
+					d['changed_images'].extend(changed)
+
+			for obsId, images in oldObs.items():
+				if obsId not in newObs:
+					d['removed_obs'].append(obsId)
+					d['removed_images'].extend(images)
+
+			self.instruments[inst] = d
+
+	# Observations (by id) of an instrument that need (re)processing: new or changed.
+	def obsToProcess(self, inst):
+		d = self.instruments.get(inst)
+		if d is None:
+			return []
+		return d['added_obs'] + d['changed_obs']
+
+	# True if nothing at all changed for any instrument
+	def isEmpty(self):
+		return all(not any(d.values()) for d in self.instruments.values())
+
+	# Image counts per instrument, for logging
+	def summary(self):
+		return {inst : {k : len(v) for k, v in d.items()} for inst, d in self.instruments.items()}
+
+# Last-seen per-sol image manifests, one json file per sol under manifest_path/<mission>/sol_snapshots/.
+class SnapshotStore:
+	def __init__(self, sc, rootDir=None):
+		if rootDir is None:
+			rootDir = config.getConfig()['manifest_path'] + sc['mission'] + '/sol_snapshots/'
+		self.rootDir = rootDir
+		os.makedirs(self.rootDir, exist_ok=True)
+
+	def path(self, sol):
+		return os.path.join(self.rootDir, 'sol' + str(sol) + '.json')
+
+	# Return the last saved manifest for a sol, or None if never seen.
+	def load(self, sol):
+		try:
+			with open(self.path(sol),'r') as infile:
+				return json.load(infile)
+		except (OSError, ValueError):
+			return None
+
+	# Save atomically (temp file + rename); parallel workers may be saving other sols at the same time.
+	def save(self, sol, imageMd):
+		tmpPath = self.path(sol) + '.tmp' + str(os.getpid()) + '.' + str(threading.get_ident())
+		with open(tmpPath,'w') as outfile:
+			json.dump(imageMd, outfile)
+		os.replace(tmpPath, self.path(sol))
+
+if __name__ == '__main__':
+	print("TESTING MODULE: sol_diff.py")
+	import tempfile
+	import missions.spacecraft as spacecraft
+	old = {'pcam_images' : [{'id' : 'A', 'images' : [{'imageid' : 'A1', 'url' : 'u1'}, {'imageid' : 'A2', 'url' : 'u2'}]},
+							{'id' : 'B', 'images' : [{'imageid' : 'B1', 'url' : 'u3'}]}],
+			'ncam_images' : [{'id' : 'N', 'images' : [{'imageid' : 'N1', 'url' : 'u4'}]}]}
+	new = {'pcam_images' : [{'id' : 'A', 'images' : [{'imageid' : 'A1', 'url' : 'u1'}, {'imageid' : 'A2', 'url' : 'u2b'}, {'imageid' : 'A3', 'url' : 'u5'}]},
+							{'id' : 'C', 'images' : [{'imageid' : 'C1', 'url' : 'u6'}]}],
+			'ncam_images' : [{'id' : 'N', 'images' : [{'imageid' : 'N1', 'url' : 'u4'}]}]}
+	d = SolDiff(old, new, spacecraft.MERB['instruments'])
+	print(d.instruments['pancam'])
+	print(d.obsToProcess('pancam'))
+	print(d.obsToProcess('navcam'))
+	print(d.isEmpty())
+	print(SolDiff(new, new, spacecraft.MERB['instruments']).isEmpty())
+	print(SolDiff(None, new, spacecraft.MERB['instruments']).obsToProcess('pancam'))
+	with tempfile.TemporaryDirectory() as tmp:
+		store = SnapshotStore(spacecraft.MERB, tmp)
+		print(store.load(5))
+		store.save(5, new)
+		print(store.load(5) == new)
+	print("DONE.")
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+#
+# Index over the 'sols' array of an image manifest.
+# The manifest json is just a big list of sols, so finding one means walking the list.
+# This builds a dict keyed by sol plus a sorted list of sol numbers once, so lookups are
+# constant time and range queries ("sols 1200-1300", "latest 10 sols") are a bisect.
+# Per-sol update timestamps are parsed once into a NumPy array alongside, so
+# "which sols changed since T" is a single vectorized comparison.
+#
+
+# Library imports
+import bisect
+import numpy as np
+
+# marsrover-pipeline imports
+import metadata.util as util
+
+class SolIndex:
+	def __init__(self, mf):
+		self.bySol = {}
+		self.sols = []
+		self.solArray = np.zeros(0, dtype=np.int64)
+		self.updateTimes = np.zeros(0, dtype=np.int64) # Epoch microseconds, same order as sols
+
+		# Empty/missing manifest just makes an empty index.
+		if mf is None:
+			return
+
+		for entry in mf.get('sols',[]):
+			self.bySol[entry['sol']] = entry
+		self.sols = sorted(self.bySol)
+		self.solArray = np.array(self.sols, dtype=np.int64)
+		self.updateTimes = np.fromiter((util.parseTime(self.bySol[s]['last_manifest_update']) for s in self.sols),
+										dtype=np.int64, count=len(self.sols))
+
+	# Number of sols actually present in the manifest
+	def __len__(self):
+		return len(self.sols)
+
+	def __contains__(self, solNum):
+		return solNum in self.bySol
+
+	# Return the manifest entry for a sol, or empty dict if missing (matches Manifest.getSolMetadata)
+	def get(self, solNum):
+		return self.bySol.get(solNum, {})
+
+	# Return the sol numbers present in [first, last], inclusive, ascending.
+	def solRange(self, first, last):
+		lo = bisect.bisect_left(self.sols, first)
+		hi = bisect.bisect_right(self.sols, last)
+		return self.sols[lo:hi]
+
+	# Return the n most recent sols that actually exist, newest first.
+	def latest(self, n):
+		if n <= 0:
+			return []
+		return self.sols[:-n-1:-1]
+
+	# Return the sols whose last_manifest_update is newer than the given timestamp, ascending.
+	def updatedSince(self, ts):
+		return self.solArray[self.updateTimes > util.parseTime(ts)].tolist()
+
+	# Highest sol in the index, or None if empty
+	def latestSol(self):
+		if not self.sols:
+			return None
+		return self.sols[-1]
+
+if __name__ == '__main__':
+	print("TESTING MODULE: sol_index.py")
+	mf = {'sols' : [{'sol' : s, 'num_images' : 1, 'last_manifest_update' : '2018-02-%02dT12:00:00.000Z' % s} for s in [5, 1, 2, 3, 7, 10, 9]]}
+	idx = SolIndex(mf)
+	print(len(idx))
+	print(idx.get(7))
+	print(idx.get(4))
+	print(idx.solRange(2,8))
+	print(idx.latest(3))
+	print(idx.latest(100))
+	print(idx.latestSol())
+	print(idx.updatedSince('2018-02-05T12:00:00.000Z'))
+	print(SolIndex(None).latestSol())
+	print("DONE.")
@@ -5,41 +5,43 @@
 # NOTE: MSL manifest 2.0 links (to image metadata manifests) are broken before sol 1246.
 #
 
-# Library imports
-import json
-import requests
-import boto3 # AWS
-
 # marsrover-pipeline imports
 import missions.spacecraft as spacecraft
 import metadata.manifest as manifest
 import metadata.util as util
+import metadata.http_cache as http_cache
+import metadata.http_client as http_client
+from metadata.metrics import registry as metrics
 
 class SolMetadata:
-	def __init__(self,spacecraft,sol):
+	# client is the HttpClient to fetch with; defaults to the shared, pooled one.
+	def __init__(self,spacecraft,sol,client=None):
 		self.sc = spacecraft
+		self.http = client if client is not None else http_client.getSharedClient()
 		
 		# Attempt to find the sol in the local metadata first
-		# If not there, check remote.
+		# If not there, check remote (fetched at most once per process, shared by every SolMetadata).
 		# If still not there, oops...
-		manif = manifest.Manifest(self.sc)
+		manif = manifest.Manifest(self.sc, self.http)
 		self.masterMd = manif.getSolMetadata(sol)
 		if self.masterMd == {}:
-			manif.getRemoteManifest()
+			manif.getRemoteManifest(useCache=True)
 			self.masterMd = manif.getSolMetadata(sol)
 		if self.masterMd == {}:
 			self.initStatus = False
 			return
 
-		# Try to get the individual image manifest.
+		# Try to get the individual image manifest (conditional GET, so unchanged sols come from cache).
 		# If not successful, exit with failure.
-		req = requests.get(self.masterMd['url'])
+		with metrics.stage('sol_manifest_download'):
+			req = http_cache.getSharedCache().get(self.masterMd['url'], client=self.http)
 		if req.status_code != 200:
 			self.initStatus = False
 			return
 		
 		# If successful, go ahead and parse the json:
-		self.imageMd = req.json()
+		with metrics.stage('sol_manifest_parse'):
+			self.imageMd = req.json()
 		
 		# If we got here, yay, success!!
 		self.initStatus = True
@@ -64,12 +66,19 @@ class SolMetadata:
 	def getInstrumentObs(self,inst):
 		return self.imageMd[self.sc['instruments'][inst]]
 
-	# Push the manifest to our s3 bucket
-	# Should be able to do this without intermediate file by following method.
-	def putSolOnBucket(self):
-		s3 = boto3.resource('s3')
-		dataBucket = s3.Object('marsroversio.data','latest_sols/' + self.sc['mission'] + '/images_sol' + str(self.masterMd['sol']) + '.json')
-		dataBucket.put(Body=json.dumps(self.imageMd))
+	# Push the manifest to our s3 bucket (gzipped; skipped if unchanged since it was last pushed).
+	# Given a publisher, the upload is only queued, so many sols can go up at once; call its flush() after.
+	# Without one, the shared publisher is used and this waits for just this upload (not whatever else is
+	# queued there). Returns False if it failed.
+	def putSolOnBucket(self, publisher=None):
+		import pipeline.publisher as publish # Only needed (with boto3) when publishing
+		key = publish.solKey(self.sc, self.masterMd['sol'])
+		if publisher is not None:
+			publisher.putJson(key, self.imageMd)
+			return True
+		publisher = publish.getSharedPublisher()
+		publisher.putJson(key, self.imageMd)
+		return publisher.flush([key]) == {}
 
 if __name__ == '__main__':
 	print("TESTING MODULE: sol_metadata.py")
@@ -91,7 +100,7 @@ if __name__ == '__main__':
 	print(r.checkManifestTimes())
 	print(r.getNumImages())
 	print(r.getInstrumentObs('navcam'))
-	r.putSolOnBucket()
+	print(r.putSolOnBucket())
 	x = SolMetadata(spacecraft.MERA,4000) # Poor Spirit died @ 2209 so this will fail.
 	print("Failure:")
 	print(x.sc)
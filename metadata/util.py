@@ -3,48 +3,60 @@
 # Some handy utilities that could (will) be useful.
 #
 
-# I hate datetime enough to implement this myself.
-# Returns True if lhs > rhs, Returns False if lhs <= rhs
+# Library imports
+import json
+import hashlib
+import datetime
+import functools
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+# Parse a manifest timestamp ('2018-02-05T12:00:00.000Z') into integer microseconds since the Unix epoch.
+# Integers compare (and vectorize) much faster than re-slicing the strings every time.
+# I still hate datetime, but its C ISO parser is several times faster than slicing in Python.
+def parseTime(ts):
+	try:
+		return (datetime.datetime.fromisoformat(ts) - EPOCH) // ONE_MICROSECOND
+	except (ValueError, TypeError):
+		# Older Pythons don't take the trailing 'Z' (or odd fraction lengths); do it by hand.
+		return parseTimeSlow(ts)
+
 # Since timestamps are in uniform format in the manifests, this can be fairly inflexible.
-def cmptime(lhs,rhs):
-	# First check year
-	if int(lhs[0:4]) > int(rhs[0:4]):
-		return True
-	elif int(lhs[0:4]) < int(rhs[0:4]):
-		return False
+def parseTimeSlow(ts):
+	year = int(ts[0:4])
+	month = int(ts[5:7])
+	day = int(ts[8:10])
+
+	# Days since epoch from the civil date (Howard Hinnant's days_from_civil).
+	if month <= 2:
+		year -= 1
+	era = year // 400
+	yoe = year - era * 400
+	doy = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+	doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+	days = era * 146097 + doe - 719468
 
-	# Then month
-	if int(lhs[5:7]) > int(rhs[5:7]):
-		return True
-	elif int(lhs[5:7]) < int(rhs[5:7]):
-		return False
+	secs = ((days * 24 + int(ts[11:13])) * 60 + int(ts[14:16])) * 60 + int(ts[17:19])
 
-	# Then day...
-	if int(lhs[8:10]) > int(rhs[8:10]):
-		return True
-	elif int(lhs[8:10]) < int(rhs[8:10]):
-		return False
+	# Fractional seconds, if any, padded/truncated to microseconds. Drop the trailing 'Z'.
+	frac = ts[20:].rstrip('Z')
+	micros = int((frac + '000000')[:6]) if frac else 0
 
-	# Hour...
-	if int(lhs[11:13]) > int(rhs[11:13]):
-		return True
-	elif int(lhs[11:13]) < int(rhs[11:13]):
-		return False
+	return secs * 1000000 + micros
 
-	# Minute...
-	if int(lhs[14:16]) > int(rhs[14:16]):
-		return True
-	elif int(lhs[14:16]) < int(rhs[14:16]):
-		return False
+# cmptime callers tend to compare lots of timestamps against the same one, so remember recent parses.
+cachedParseTime = functools.lru_cache(maxsize=256)(parseTime)
 
-	# Finally seconds.
-	if float(lhs[17:-1]) > float(rhs[17:-1]):
-		return True
-	elif float(lhs[17:-1]) < float(rhs[17:-1]):
-		return False
+# Returns True if lhs > rhs, Returns False if lhs <= rhs
+# Kept for compatibility; new code should compare parseTime() values directly.
+def cmptime(lhs,rhs):
+	return cachedParseTime(lhs) > cachedParseTime(rhs)
 
-	# If anything else, equal:
-	return False
+# Fingerprint of one image's manifest entry; any change to it (url, timestamps, ...) changes this.
+# Used to tell if a product's inputs (state store) or a cached frame (frame cache) are still current.
+def imageFingerprint(image):
+	return hashlib.sha1(json.dumps(image, sort_keys=True).encode('utf-8')).hexdigest()
 
 if __name__ == '__main__':
 	print(cmptime('2019-02-05T12:00:00.000Z','2018-02-05T12:00:00.000Z'))
@@ -60,7 +72,8 @@ if __name__ == '__main__':
 	print(cmptime('2018-02-05T12:00:10.000Z','2018-02-05T12:00:00.000Z'))
 	print(cmptime('2018-02-05T12:00:00.000Z','2018-02-05T12:00:10.000Z'))
 	print(cmptime('2018-02-05T12:00:00.000Z','2018-02-05T12:00:00.000Z'))
-
-
-
-
+	print(cmptime('2018-02-05T12:00:00.001Z','2018-02-05T12:00:00.000Z'))
+	print(parseTime('1970-01-01T00:00:00.000Z'))
+	print(parseTime('2018-02-05T12:00:00.500Z'))
+	print(parseTimeSlow('2018-02-05T12:00:00.500Z'))
+	print(imageFingerprint({'imageid' : 'a', 'url' : 'b'}) == imageFingerprint({'url' : 'b', 'imageid' : 'a'}))
@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+#
+# On-disk cache of decoded raw frames, so reprocessing an observation (a new product type, a re-run
+# after a crash) doesn't download and decode every JPEG again.
+# Frames are stored as .npy under images_path/raw_cache/, named by imageid plus a version tag
+# (caller's choice; Pancam uses the manifest entry's fingerprint, so a re-downlinked frame isn't
+# served stale). Hits are memory-mapped read-only, so only the pages a product touches get read.
+# Size-bounded with LRU eviction, like the HTTP cache.
+#
+# Safe with several threads/processes using the same directory: writes go to a temp file and are
+# renamed into place, and a frame deleted while mapped stays readable until it's unmapped.
+#
+
+# Library imports
+import os
+import threading
+import collections
+import numpy as np
+
+# marsrover-pipeline imports
+import metadata.config as config
+from metadata.metrics import registry as metrics
+
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024 # About 2000 full Pancam frames
+
+class FrameCache:
+	def __init__(self, cacheDir, maxBytes=DEFAULT_MAX_BYTES):
+		self.cacheDir = cacheDir
+		self.maxBytes = maxBytes
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+		if not os.path.isdir(self.cacheDir):
+			os.makedirs(self.cacheDir, exist_ok=True)
+
+		# LRU order: file name -> size, least recently used first.
+		# Scan the directory once here; after that it's kept up to date in memory.
+		entries = []
+		for name in os.listdir(self.cacheDir):
+			if name.endswith('.npy'):
+				st = os.stat(os.path.join(self.cacheDir, name))
+				entries.append((st.st_mtime, name, st.st_size))
+		entries.sort()
+		self.lru = collections.OrderedDict((name, size) for mtime, name, size in entries)
+		self.totalBytes = sum(self.lru.values())
+
+	def name(self, imageId, version):
+		return imageId + '.' + version + '.npy'
+
+	def path(self, name):
+		return os.path.join(self.cacheDir, name)
+
+	# Return the cached frame (read-only memmap), or None.
+	def get(self, imageId, version):
+		name = self.name(imageId, version)
+		try:
+			frame = np.load(self.path(name), mmap_mode='r')
+		except (OSError, ValueError):
+			with self.lock:
+				self.misses += 1
+			metrics.count('frame_cache_misses')
+			return None
+		with self.lock:
+			self.hits += 1
+			if name in self.lru:
+				self.lru.move_to_end(name)
+		metrics.count('frame_cache_hits')
+		try:
+			os.utime(self.path(name)) # So the order survives restarts, and other processes see it
+		except OSError:
+			pass
+		return frame
+
+	# Store a frame. Other versions of the same image are dropped.
+	def put(self, imageId, version, frame):
+		name = self.name(imageId, version)
+		tmpPath = self.path(name) + '.tmp' + str(os.getpid()) + '.' + str(threading.get_ident())
+		with open(tmpPath, 'wb') as outfile:
+			np.save(outfile, np.ascontiguousarray(frame))
+		size = os.path.getsize(tmpPath)
+		os.replace(tmpPath, self.path(name))
+
+		with self.lock:
+			stale = [n for n in self.lru if n.startswith(imageId + '.') and n != name]
+			for n in stale:
+				self.totalBytes -= self.lru.pop(n)
+			self.totalBytes -= self.lru.pop(name, 0)
+			self.lru[name] = size
+			self.totalBytes += size
+		for n in stale:
+			self.remove(n)
+		self.evict()
+
+	def remove(self, name):
+		try:
+			os.remove(self.path(name))
+		except OSError:
+			pass
+
+	# Drop least recently used frames until we're under the size cap.
+	def evict(self):
+		while True:
+			with self.lock:
+				if self.totalBytes <= self.maxBytes or len(self.lru) <= 1:
+					return
+				name, size = self.lru.popitem(last=False)
+				self.totalBytes -= size
+			self.remove(name)
+
+sharedFrameCache = None
+sharedFrameCacheLock = threading.Lock()
+
+# The process-wide cache, under <images_path>/raw_cache/.
+# Size cap comes from the optional 'frame_cache_max_bytes' config key; 0 turns the cache off (returns None).
+def getSharedCache():
+	global sharedFrameCache
+	if sharedFrameCache is None:
+		with sharedFrameCacheLock:
+			if sharedFrameCache is None:
+				conf = config.getConfig()
+				maxBytes = conf.get('frame_cache_max_bytes', DEFAULT_MAX_BYTES)
+				if not maxBytes:
+					return None
+				sharedFrameCache = FrameCache(conf['images_path'] + 'raw_cache/', maxBytes)
+	return sharedFrameCache
+
+if __name__ == '__main__':
+	print("TESTING MODULE: frame_cache.py")
+	import tempfile
+	import concurrent.futures
+	with tempfile.TemporaryDirectory() as tmp:
+		frame = np.arange(1024 * 1024, dtype=np.uint32).astype(np.uint8).reshape(1024, 1024)
+		c = FrameCache(tmp, maxBytes=3 * frame.nbytes + 1000)
+		print(c.get('1P1L2', 'v1'))
+		c.put('1P1L2', 'v1', frame)
+		hit = c.get('1P1L2', 'v1')
+		print(type(hit).__name__, hit.flags.writeable, np.array_equal(hit, frame), c.hits, c.misses)
+
+		# New version replaces the old one
+		c.put('1P1L2', 'v2', frame[::2])
+		print(c.get('1P1L2', 'v1'), c.get('1P1L2', 'v2').shape, sorted(os.listdir(tmp)))
+
+		# LRU: 1P1L2 was used most recently, so 1P1L5 goes first
+		c.put('1P1L5', 'v1', frame)
+		c.put('1P1L7', 'v1', frame)
+		c.get('1P1L2', 'v2')
+		c.put('1P1R2', 'v1', frame)
+		print(sorted(os.listdir(tmp)), c.totalBytes <= c.maxBytes)
+
+		# Evicted while mapped: the mapping still reads fine
+		mapped = c.get('1P1L7', 'v1')
+		c.remove(c.name('1P1L7', 'v1'))
+		print(int(mapped[1, 1]) == int(frame[1, 1]))
+
+		# Concurrent writers and readers of the same frames
+		def work(i):
+			c.put('1P1X' + str(i % 4), 'v1', frame)
+			hit = c.get('1P1X' + str(i % 4), 'v1')
+			return hit is None or np.array_equal(hit, frame)
+		with concurrent.futures.ThreadPoolExecutor(8) as pool:
+			print(all(pool.map(work, range(64))))
+		print(FrameCache(tmp, c.maxBytes).totalBytes == c.totalBytes)
+	print("DONE.")
@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+#
+# Compositing engine for Pancam observations.
+# Every product (false color, true color approximation, anaglyph) is described the same way:
+# for each output channel, a weighted sum of filter frames. So one engine can work out which
+# products an observation supports and build all of them in a single pass over the loaded frames,
+# writing each straight into its own preallocated output image.
+#
+# Product spec format (channels are in R, G, B order; the engine writes OpenCV's BGR):
+#	{'name' : 'L257', 'channels' : [{'L2' : 1.0}, {'L5' : 1.0}, {'L7' : 1.0}]}
+#
+
+# Library imports
+import numpy as np
+
+# Standard geology false color: L2 (753nm), L5 (535nm), L7 (432nm)
+L257 = {'name' : 'L257',
+		'channels' : [{'L2' : 1.0}, {'L5' : 1.0}, {'L7' : 1.0}]}
+
+# Nearer-to-natural false color: L4 (601nm), L5 (535nm), L6 (482nm)
+L456 = {'name' : 'L456',
+		'channels' : [{'L4' : 1.0}, {'L5' : 1.0}, {'L6' : 1.0}]}
+
+# True color approximation from a 13 filter observation's left eye.
+# Rough: red blends L4/L3, blue blends L6/L7. Raw JPEGs aren't radiometrically calibrated anyway.
+LTRUE = {'name' : 'LTRUE',
+		'channels' : [{'L4' : 0.75, 'L3' : 0.25}, {'L5' : 1.0}, {'L6' : 0.75, 'L7' : 0.25}]}
+
+# Red/cyan stereo anaglyph from an L2R2 pair: left eye in red, right eye in green and blue.
+L2R2 = {'name' : 'L2R2',
+		'channels' : [{'L2' : 1.0}, {'R2' : 1.0}, {'R2' : 1.0}]}
+
+DEFAULT_PRODUCTS = [L257, L456, LTRUE, L2R2]
+
+# Build a one-filter-per-channel spec, as makeFalseColor always has.
+def falseColor(redFilter, greenFilter, blueFilter):
+	return {'name' : redFilter[0] + redFilter[1] + greenFilter[1] + blueFilter[1],
+			'channels' : [{redFilter : 1.0}, {greenFilter : 1.0}, {blueFilter : 1.0}]}
+
+# Every filter position a product needs.
+def requiredFilters(product):
+	filters = set()
+	for channel in product['channels']:
+		filters.update(channel)
+	return filters
+
+class Compositor:
+	def __init__(self, products=None):
+		self.products = products if products is not None else DEFAULT_PRODUCTS
+		self.scratch = {} # (use, shape) -> float32 buffer, reused across products and observations
+
+	# Products whose filters are all in the given list (e.g. from Pancam.getObsFilters)
+	def possibleProducts(self, filters, products=None):
+		products = products if products is not None else self.products
+		filters = set(filters)
+		return [p for p in products if requiredFilters(p) <= filters]
+
+	def getScratch(self, use, shape):
+		if (use, shape) not in self.scratch:
+			self.scratch[(use, shape)] = np.empty(shape, dtype=np.float32)
+		return self.scratch[(use, shape)]
+
+	# Fill one uint8 output channel (a strided view into the output image).
+	def fillChannel(self, out, weights, frames):
+		# Single frame at full weight is just a copy; no float math needed.
+		if len(weights) == 1:
+			(filt, weight), = weights.items()
+			if weight == 1.0:
+				np.copyto(out, frames[filt])
+				return
+
+		acc = self.getScratch('acc', out.shape)
+		term = self.getScratch('term', out.shape)
+		acc.fill(0.5) # Rounds on the final truncating cast
+		for filt, weight in weights.items():
+			np.multiply(frames[filt], np.float32(weight), out=term)
+			acc += term
+		np.clip(acc, 0, 255, out=acc)
+		np.copyto(out, acc, casting='unsafe')
+
+	# Build every product that the frames support.
+	# frames is filter position -> decoded grayscale image (only complete frames should be passed).
+	# Returns dict of product name -> BGR image.
+	def build(self, frames, products=None):
+		built = {}
+		for product in self.possibleProducts(frames.keys(), products):
+			# All input frames must be the same size (no mixing thumbnails and full frames).
+			shapes = {frames[f].shape for f in requiredFilters(product)}
+			if len(shapes) != 1:
+				continue
+			height, width = shapes.pop()
+
+			out = np.empty((height, width, 3), dtype=np.uint8)
+			for c, weights in enumerate(product['channels']):
+				self.fillChannel(out[:, :, 2 - c], weights, frames) # RGB spec -> BGR image
+			built[product['name']] = out
+
+		return built
+
+if __name__ == '__main__':
+	print("TESTING MODULE: composite.py")
+	frames = {f : np.full((4, 4), 10 * i, np.uint8) for i, f in enumerate(['L2', 'L3', 'L4', 'L5', 'L6', 'L7', 'R2'])}
+	c = Compositor()
+	print([p['name'] for p in c.possibleProducts(frames.keys())])
+	print([p['name'] for p in c.possibleProducts(['L2', 'L5', 'L7', 'R1'])])
+	built = c.build(frames)
+	for name, image in built.items():
+		print(name, image.shape, image[0, 0])
+	print(falseColor('R3', 'R2', 'R1'))
+	print(c.build({'L2' : np.zeros((4, 4), np.uint8), 'L5' : np.zeros((8, 8), np.uint8), 'L7' : np.zeros((4, 4), np.uint8)}))
+	print("DONE.")
@@ -8,6 +8,43 @@
 import cv2
 import numpy as np
 
+# marsrover-pipeline imports
+from metadata.metrics import registry as metrics
+
+# Bytes read from the connection at a time, when reading into a preallocated buffer.
+READ_CHUNK = 65536
+
+# Decode an image straight out of an HTTP response (requested with stream=True).
+# When the length is known, the body is read in READ_CHUNK pieces into one preallocated buffer and
+# handed to imdecode as-is, so the only copy of the whole body is that buffer. (Not raw.readinto:
+# urllib3's reads the whole requested length into a temporary bytes and copies that over.)
+# Otherwise falls back to a zero-copy view of .content.
+# Returns the decoded image, or None if it couldn't be read/decoded.
+def decodeResponse(req, flags=cv2.IMREAD_GRAYSCALE):
+	with metrics.stage('image_download'):
+		length = req.headers.get('Content-Length')
+		if length is not None and req.headers.get('Content-Encoding') in (None, 'identity'):
+			buf = np.empty(int(length), dtype=np.uint8)
+			view = memoryview(buf)
+			pos = 0
+			while pos < len(buf):
+				chunk = req.raw.read(min(READ_CHUNK, len(buf) - pos))
+				if not chunk:
+					return None # Truncated download
+				view[pos:pos+len(chunk)] = chunk
+				pos += len(chunk)
+		else:
+			buf = np.frombuffer(req.content, dtype=np.uint8)
+	metrics.count('bytes_downloaded', len(buf))
+
+	if len(buf) == 0:
+		return None
+	with metrics.stage('image_decode'):
+		image = cv2.imdecode(buf, flags)
+	if image is not None:
+		metrics.count('frames_decoded')
+	return image
+
 # Detect partial data products.
 # MER images come down top to bottom, left to right, in distinct chunks.
 # So checking if the bottom left corner of the image in question is solid black should
@@ -18,16 +55,35 @@ def checkPartial(image):
 	# If that is the case, check against the whole image - likely it's either all or nothing at this size.
 	height, width = image.shape[:2]
 	if (height < 150) or (width < 150):
-		templateImage = np.zeros((height,width,1), np.uint8)
 		checkCorner = image
 	else:
-		templateImage = np.zeros((150,150,1), np.uint8) # 150 pixel square black area
 		checkCorner = image[-151:-1, -151:-1] # Bottom right 150 x 150 area of image
 
-	# Check for full match; if every single original pixel is solid black,
-	# there's a preeeeetty good chance it's a partial.
-	if (checkCorner == templateImage).all():
-		return True
+	# If every single original pixel is solid black, there's a preeeeetty good chance it's a partial.
+	# "No nonzero pixels" is a view plus a reduction; no template image to allocate.
+	return not checkCorner.any()
+
+# Same check as checkPartial, for a whole stack of same-sized frames (N x height x width[ x channels]) at once.
+# Returns a boolean array, True where the frame is partial.
+def checkPartialStack(stack):
+	stack = np.asarray(stack)
+	height, width = stack.shape[1:3]
+	if (height < 150) or (width < 150):
+		checkCorner = stack
 	else:
-		return False
+		checkCorner = stack[:, -151:-1, -151:-1]
+
+	return ~checkCorner.reshape(len(stack), -1).any(axis=1)
 
+if __name__ == '__main__':
+	print("TESTING MODULE: image_utils.py")
+	full = np.full((1024,1024), 100, np.uint8)
+	partial = full.copy()
+	partial[600:] = 0
+	thumb = np.zeros((64,64), np.uint8)
+	print(checkPartial(full))
+	print(checkPartial(partial))
+	print(checkPartial(thumb))
+	print(checkPartialStack([full, partial, full]))
+	print(checkPartialStack(np.zeros((2,64,64), np.uint8)))
+	print("DONE.")
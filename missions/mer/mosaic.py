@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+#
+# Mosaics of Pancam sequences: every observation of a sequence (one filter, or one product, each)
+# placed onto one canvas, with overlaps feathered into each other.
+# A full panorama is dozens to hundreds of frames, far too many to hold in memory at once, so:
+#	- frames are added one at a time and written straight out to .npy files in a work directory,
+#	  so the caller can let go of each as soon as it's added;
+#	- the canvas is a memory-mapped .npy, assembled tile by tile. Each tile reads only the slices
+#	  of the frames that overlap it (memory-mapped too), blends them and writes the result, so
+#	  memory use is a few tiles per worker whatever the size of the panorama;
+#	- tiles don't depend on each other, so they're blended in parallel (numpy releases the GIL).
+# Each finished tile can also go to the output writer as its own image (for a tiled viewer), and
+# is shrunk into a small preview of the whole mosaic as it goes.
+#
+# Frames are placed by pointing if the caller has it (pixel offsets per frame), otherwise by index:
+# left to right in the order added, in 'tiers' rows, overlapping by a fixed fraction.
+#
+# Settings come from the optional "mosaic" block of ~/.marsroverio, e.g.:
+#	"mosaic" : {"tile_size" : 1024, "overlap" : 0.15, "tiers" : 1, "workers" : 4, "preview_size" : 2048}
+#
+
+# Library imports
+import os
+import math
+import shutil
+import concurrent.futures
+import cv2
+import numpy as np
+
+# marsrover-pipeline imports
+import metadata.config as config
+from metadata.metrics import registry as metrics
+
+DEFAULTS = {'tile_size' : 1024,
+			'overlap' : 0.15,        # Fraction of a frame shared with its neighbours, for index-based placement
+			'tiers' : 1,             # Rows of frames, for index-based placement
+			'workers' : 4,           # Tiles blended at once
+			'preview_size' : 2048}   # Longest side of the preview
+
+# DEFAULTS, overridden by the given settings, or by the "mosaic" block of the config if none given.
+def getSettings(settings=None):
+	merged = dict(DEFAULTS)
+	merged.update(settings if settings is not None else config.getConfig().get('mosaic', {}))
+	return merged
+
+# (y, x) of each of count frames of the given shape: left to right, then top to bottom, in tiers rows.
+def gridLayout(count, shape, tiers=1, overlap=0.15):
+	columns = max(1, math.ceil(count / max(1, tiers)))
+	stepY = int(round(shape[0] * (1 - overlap)))
+	stepX = int(round(shape[1] * (1 - overlap)))
+	return [((i // columns) * stepY, (i % columns) * stepX) for i in range(count)]
+
+# Blend weight of each pixel of a frame: highest in the middle, falling off linearly to the edges,
+# so overlapping frames fade into each other instead of leaving seams. float32, (height, width, 1).
+def featherWeights(shape):
+	ys = np.arange(shape[0], dtype=np.float32)
+	xs = np.arange(shape[1], dtype=np.float32)
+	return np.minimum.outer(np.minimum(ys, ys[::-1]) + 1, np.minimum(xs, xs[::-1]) + 1)[:, :, None]
+
+class Mosaic:
+	# workDir holds the frames (and usually the canvas) while the mosaic is built; close() removes it.
+	def __init__(self, workDir, settings=None):
+		self.settings = getSettings(settings)
+		self.workDir = workDir
+		self.frames = [] # (path, shape, position or None), in the order added; path None for a skipped slot
+		self.weights = {} # frame shape -> featherWeights
+		os.makedirs(workDir, exist_ok=True)
+
+	# Add a frame: uint8, grayscale (2D) or color (3 channels); all frames must be alike.
+	# position is its (y, x) on the canvas in pixels, from pointing; leave it out for index-based placement.
+	# The frame is written out right away, so the caller needn't keep it.
+	def addFrame(self, image, position=None):
+		shapes = [shape for path, shape, p in self.frames if path is not None]
+		if shapes and image.shape[2:] != shapes[0][2:]:
+			raise ValueError('frames must all be grayscale or all be color')
+		path = os.path.join(self.workDir, 'frame%05d.npy' % len(self.frames))
+		np.save(path, np.ascontiguousarray(image))
+		self.frames.append((path, image.shape, position))
+		metrics.count('mosaic_frames')
+
+	# Leave an empty slot where a frame would have gone (e.g. it was partial), so with index-based
+	# placement the frames after it still land where they belong.
+	def skipFrame(self):
+		self.frames.append((None, None, None))
+
+	# Frames added (not counting skipped ones)
+	def __len__(self):
+		return sum(1 for path, shape, position in self.frames if path is not None)
+
+	# [(path, y, x)] for every frame, shifted so the canvas starts at 0, 0.
+	def positions(self):
+		added = [(i, path, shape, position) for i, (path, shape, position) in enumerate(self.frames) if path is not None]
+		if all(position is None for i, path, shape, position in added):
+			grid = gridLayout(len(self.frames), added[0][2], self.settings['tiers'], self.settings['overlap'])
+			given = [(path, grid[i]) for i, path, shape, position in added]
+		elif any(position is None for i, path, shape, position in added):
+			raise ValueError('either every frame has a position or none do')
+		else:
+			given = [(path, position) for i, path, shape, position in added]
+		top = min(y for path, (y, x) in given)
+		left = min(x for path, (y, x) in given)
+		return [(path, int(y - top), int(x - left)) for path, (y, x) in given]
+
+	def featherFor(self, shape):
+		if shape not in self.weights:
+			self.weights[shape] = featherWeights(shape)
+		return self.weights[shape]
+
+	# Blend the frames that overlap canvas rows y0:y1, columns x0:x1. placed is [(frame, y, x)].
+	def blendTile(self, placed, y0, x0, y1, x1, channels):
+		acc = np.zeros((y1 - y0, x1 - x0, channels), np.float32)
+		total = np.zeros((y1 - y0, x1 - x0, 1), np.float32)
+		for frame, y, x in placed:
+			# Overlap of this frame and the tile, in canvas coordinates.
+			top, left = max(y0, y), max(x0, x)
+			bottom, right = min(y1, y + frame.shape[0]), min(x1, x + frame.shape[1])
+			if top >= bottom or left >= right:
+				continue
+			pixels = frame[top-y:bottom-y, left-x:right-x].reshape(bottom - top, right - left, channels)
+			weights = self.featherFor(frame.shape[:2])[top-y:bottom-y, left-x:right-x]
+			acc[top-y0:bottom-y0, left-x0:right-x0] += pixels * weights
+			total[top-y0:bottom-y0, left-x0:right-x0] += weights
+		np.divide(acc, total, out=acc, where=total > 0) # Nothing there stays black
+		acc += 0.5 # Rounds on the truncating cast
+		tile = acc.astype(np.uint8)
+		return tile if channels == 3 else tile[:, :, 0]
+
+	# Assemble the mosaic into a memory-mapped .npy at canvasPath.
+	# If writer is given, each tile is also submitted to it, saved at tilePath(row, column).
+	# Returns (canvas, preview, {(row, column) : writer future}).
+	def build(self, canvasPath, writer=None, tilePath=None):
+		if len(self) == 0:
+			raise ValueError('no frames to mosaic')
+		# Frames are only mapped here; the tiles read the parts they need.
+		placed = [(np.load(path, mmap_mode='r'), y, x) for path, y, x in self.positions()]
+		height = max(y + frame.shape[0] for frame, y, x in placed)
+		width = max(x + frame.shape[1] for frame, y, x in placed)
+		channelShape = placed[0][0].shape[2:]
+		channels = channelShape[0] if channelShape else 1
+		canvas = np.lib.format.open_memmap(canvasPath, mode='w+', dtype=np.uint8, shape=(height, width) + channelShape)
+
+		scale = min(1.0, self.settings['preview_size'] / max(height, width))
+		preview = np.zeros((max(1, round(height * scale)), max(1, round(width * scale))) + channelShape, np.uint8)
+		size = self.settings['tile_size']
+		tiles = [(row, column) for row in range(math.ceil(height / size)) for column in range(math.ceil(width / size))]
+
+		def work(tile):
+			row, column = tile
+			y0, x0 = row * size, column * size
+			y1, x1 = min(y0 + size, height), min(x0 + size, width)
+			with metrics.stage('mosaic_tile'):
+				image = self.blendTile(placed, y0, x0, y1, x1, channels)
+				canvas[y0:y1, x0:x1] = image
+				# Preview edges are worked out from the canvas edges, so tiles meet without gaps.
+				py0, px0, py1, px1 = round(y0 * scale), round(x0 * scale), round(y1 * scale), round(x1 * scale)
+				if py1 > py0 and px1 > px0:
+					preview[py0:py1, px0:px1] = cv2.resize(image, (px1 - px0, py1 - py0), interpolation=cv2.INTER_AREA)
+			if writer is not None:
+				return writer.submit(tilePath(row, column), image)
+			return None
+
+		with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.settings['workers'])) as pool:
+			saves = {tile : future for tile, future in zip(tiles, pool.map(work, tiles)) if future is not None}
+		canvas.flush()
+		return canvas, preview, saves
+
+	# Remove the work directory (frames, and the canvas if it was put there).
+	def close(self):
+		shutil.rmtree(self.workDir, ignore_errors=True)
+
+if __name__ == '__main__':
+	print("TESTING MODULE: mosaic.py")
+	import tempfile
+	import tracemalloc
+	print(gridLayout(5, (1024, 1024), tiers=2, overlap=0.25))
+	print(featherWeights((4, 6))[:, :, 0].tolist())
+
+	# A synthetic panorama cut into overlapping frames, then put back together.
+	layout = gridLayout(60, (1000, 1000), tiers=2, overlap=0.6)
+	y, x = np.mgrid[0:layout[-1][0] + 1000, 0:layout[-1][1] + 1000]
+	pano = (((x // 7) ^ (y // 5)) & 0xff).astype(np.uint8)
+	with tempfile.TemporaryDirectory() as tmp:
+		m = Mosaic(os.path.join(tmp, 'work'), {'tile_size' : 256, 'overlap' : 0.6, 'tiers' : 2, 'preview_size' : 512})
+		for i, (fy, fx) in enumerate(layout):
+			if i == 5:
+				m.skipFrame() # Still covered by its neighbours at this much overlap
+			else:
+				m.addFrame(pano[fy:fy+1000, fx:fx+1000])
+		tracemalloc.start()
+		canvas, preview, saves = m.build(os.path.join(m.workDir, 'canvas.npy'))
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+		print(canvas.shape, preview.shape, np.array_equal(canvas, pano))
+		print("peak %.1f MiB for a %.1f MiB canvas (%.1f MiB of frames)" % (peak / 2**20, canvas.nbytes / 2**20, len(m) * 1000 * 1000 / 2**20))
+
+		# Pointing-based placement (and a gap left black), in color
+		c = Mosaic(os.path.join(tmp, 'color'), {'tile_size' : 100, 'preview_size' : 64})
+		c.addFrame(np.full((100, 100, 3), 200, np.uint8), (-50, 10))
+		c.addFrame(np.full((100, 100, 3), 100, np.uint8), (-50, 200))
+		canvas, preview, saves = c.build(os.path.join(c.workDir, 'canvas.npy'))
+		print(canvas.shape, canvas[50, 50].tolist(), canvas[50, 150].tolist(), canvas[50, 250].tolist(), preview.shape)
+		try:
+			c.addFrame(np.zeros((100, 100), np.uint8))
+		except ValueError as e:
+			print(e)
+		c.close()
+		print(os.path.exists(c.workDir))
+	print("DONE.")
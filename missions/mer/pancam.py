@@ -3,29 +3,59 @@
 # Instrument data handler for MER's Pancam instrument
 # Given an observation block (pcam_images array from json manifest):
 #	- Characterizes each observation (i.e. what filters used?)
-#	- Can create false colors of L257 observations
-#	- Can dump said false colors onto s3, and update s3 false color manifest
-#
-# Possible future expansion:
-#	- Mosaic-ing observations in a given sequence
-#	- True color approximations from 13F observations
-#	- Anaglyph stereo from L2R2 observations
+#	- Can create false colors of L257 (and L456) observations
+#	- Can create true color approximations from 13F observations
+#	- Can create anaglyph stereo from L2R2 observations
+#	- Can mosaic the observations of a sequence, one filter or product each (see mosaic.py)
+#	- Can save smaller sizes of products and raw frames for the website (given a pipeline/pyramid.py Pyramid)
+#	- Can dump said products onto s3 (see pipeline/publisher.py)
+# OpenCV (image_utils, mosaic) is only imported once images are actually loaded or saved, so just
+# looking at observations (ids, filters, possible products) stays cheap.
 #
 
 # Library imports
 import os
-import json
+import collections
+import concurrent.futures
 import requests
-import cv2
-import numpy as np
 
 import missions.spacecraft as spacecraft
-import missions.mer.image_utils as image_utils
+import missions.frame_cache as frame_cache
+import missions.mer.composite as composite
+import metadata.config as config
+import metadata.util as util
+import metadata.http_client as http_client
+from metadata.metrics import registry as metrics
+
+DEFAULT_WORKERS = 4 # Concurrent image downloads/decodes if not set in config
+
+# What a download can raise once the client's retries are used up (connection errors, timeouts,
+# truncated bodies, ...). A load that hits one fails like any other bad image.
+LOAD_ERRORS = (requests.RequestException, OSError)
 
 class Pancam:
-	def __init__(self, image_block, sol):
+	# client is the HttpClient to fetch images with; defaults to the shared, pooled one.
+	# workers is how many images are downloaded/decoded at once; defaults to 'image_workers' in config.
+	# frameCache holds decoded frames between runs; defaults to the shared one (None if turned off in config).
+	# writer is the OutputWriter (see pipeline/output_writer.py) that encodes and saves products; defaults
+	# to the shared one, picked up on first save.
+	# pyramid is the Pyramid (see pipeline/pyramid.py) of smaller sizes to save too; None for none.
+	def __init__(self, image_block, sol, client=None, workers=None, frameCache=False, writer=None, pyramid=None):
 		self.initStatus = True
+		self.http = client if client is not None else http_client.getSharedClient()
+		self.frameCache = frameCache if frameCache is not False else frame_cache.getSharedCache()
 		self.obsImages = {} # Checked when it may not have been inited yet, so do that here
+		self.obsPartials = {} # filter position -> True if that frame is a partial; worked out once at load
+		self.workers = workers if workers is not None else config.getConfig().get('image_workers', DEFAULT_WORKERS)
+		self.pool = None # Started on first load
+		self.prefetched = {} # obsId -> pending image loads started by prefetchObsImages
+		self.compositor = composite.Compositor()
+		self.savedImages = {} # product -> (path, sha1 of file contents) from the last saveGenObsImages
+		self.generated = [] # Names of products made for the loaded observation
+		self.writer = writer
+		self.pendingSaves = {} # obsId -> {product : future} from saveGenObsImages(wait=False)
+		self.imageDir = None # Where saveGenObsImages puts products; worked out on first save
+		self.pyramid = pyramid if pyramid is not None and pyramid.levels else None
 
 		# In MER images, the first character of the id (filename) of an image is serial number (MER1 = Oppy)
 		missionid = image_block[0]['id'][0]
@@ -84,6 +114,10 @@ class Pancam:
 	def getSeqId(self,obsId):
 		return obsId[18:23]
 	
+	# Get the ids of the observations in a sequence, in acquisition order (spacecraft clock).
+	def getSeqObs(self,seqId):
+		return sorted(oid for oid in self.getObsIds() if self.getSeqId(oid) == seqId)
+
 	# Get the Pancam filters used in the observation.
 	def getObsFilters(self,obsId):
 		filters = []
@@ -103,50 +137,164 @@ class Pancam:
 			filters.append(eye+filt)
 
 		return filters
+
+	# Get the names of the products (see composite.py) an observation's filters allow for.
+	# Doesn't need the images, so can be used to skip observations before downloading anything.
+	def getObsProducts(self,obsId,products=None):
+		return [p['name'] for p in self.compositor.possibleProducts(self.getObsFilters(obsId), products)]
+
+	# Get the manifest entries of the images each possible product would be built from.
+	# Returns {product name : [image dicts]}; lets callers tell if a product's inputs changed without downloading.
+	# With a pyramid, the smaller sizes saveGenObsImages (or saveObsDerivatives) makes are in there too,
+	# under the keys they're saved as: '<product>/<level>' from the product's images, '<filter position>/<level>'
+	# from the frame's. The raw frames' are there even if no product is possible, unless products were
+	# asked for by name (then only observations that can make one of them are of interest).
+	def getProductInputs(self,obsId,products=None):
+		frame = self.getObs(obsId)
+		if frame == {}:
+			return {}
+		byFilter = {im['imageid'][-4:-2] : im for im in frame['images']}
+		inputs = {p['name'] : [byFilter[f] for f in sorted(composite.requiredFilters(p))]
+				for p in self.compositor.possibleProducts(byFilter.keys(), products)}
+		if self.pyramid is not None and (inputs or products is None):
+			sources = dict(inputs)
+			sources.update((filterPos, [im]) for filterPos, im in byFilter.items())
+			for level, size in self.pyramid.levels:
+				inputs.update((key + '/' + level, images) for key, images in sources.items())
+		return inputs
 	
+	# Download and decode a single image. Runs on the worker pool.
+	# Returns the decoded image, or None if the download failed.
+	def fetchImage(self,image):
+		import missions.mer.image_utils as image_utils # cv2
+		# Decoded before? Then it's on disk already, and no download or decode is needed.
+		# Versioned by the manifest entry, so a frame that's been re-downlinked isn't served stale.
+		if self.frameCache is not None:
+			version = util.imageFingerprint(image)[:16]
+			cached = self.frameCache.get(image['imageid'], version)
+			if cached is not None:
+				return cached
+
+		# Pull down the image from merpublic bucket (pooled connection), streamed so it can be decoded in place.
+		with self.http.get(image['url'], stream=True) as req:
+			if req.status_code != 200:
+				return None
+
+			# Read image into numpy array (i.e. OpenCV image!) without copying the download around.
+			# imdecode releases the GIL, so decodes on different workers really do run in parallel.
+			decoded = image_utils.decodeResponse(req) # Grayscale
+
+		if decoded is not None and self.frameCache is not None:
+			try:
+				self.frameCache.put(image['imageid'], version, decoded)
+			except OSError:
+				pass # Cache is best effort; disk full etc. shouldn't fail the load
+		return decoded
+
+	# Download a single image and decode it straight to the pyramid's largest level. Runs on the worker pool.
+	# Uses the full frame if it's cached, otherwise a reduced-resolution decode. Returns None if the download failed.
+	def fetchReduced(self,image):
+		if self.frameCache is not None:
+			cached = self.frameCache.get(image['imageid'], util.imageFingerprint(image)[:16])
+			if cached is not None:
+				return self.pyramid.reduce(cached)
+
+		with self.http.get(image['url']) as req:
+			if req.status_code != 200 or not req.content:
+				return None
+			metrics.count('bytes_downloaded', len(req.content))
+			with metrics.stage('reduced_decode'):
+				return self.pyramid.decodeReduced(req.content)
+
+	# Kick off downloads for every image in a frame; returns list of (filter position, future).
+	def startObsLoad(self,frame):
+		if self.pool is None:
+			self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.workers))
+		return [(im['imageid'][-4:-2], self.pool.submit(self.fetchImage, im)) for im in frame['images']]
+
+	# Wait for loads started by startObsLoad. Returns (images, partials) dicts, or (None, None) if any failed
+	# (bad status, undecodable, or a download error). On failure the rest are cancelled; no point
+	# downloading an observation we're throwing away.
+	def finishObsLoad(self,pending):
+		import missions.mer.image_utils as image_utils # cv2
+		images = {}
+		for i, (filterPos, future) in enumerate(pending):
+			try:
+				image = future.result()
+			except LOAD_ERRORS:
+				metrics.count('image_load_errors')
+				image = None
+			if image is None:
+				for filterPosLeft, futureLeft in pending[i+1:]:
+					futureLeft.cancel()
+				return None, None
+			images[filterPos] = image
+
+		# Partial check happens once here, not every time a product asks. Partial frames are never
+		# composited, so this is also where they're counted (once per observation).
+		partials = {key : image_utils.checkPartial(val) for key, val in images.items()}
+		metrics.count('partials_rejected', sum(partials.values()))
+		return images, partials
+
+	# Start downloading an observation in the background, e.g. while the current one is composited.
+	# The next loadObsImages(obsId) picks up the result instead of downloading again.
+	# Returns False if the observation doesn't exist.
+	def prefetchObsImages(self,obsId):
+		if obsId in self.prefetched:
+			return True
+		frame = self.getObs(obsId)
+		if frame == {}:
+			return False
+		self.prefetched[obsId] = self.startObsLoad(frame)
+		return True
+
 	# Load each image in a given observation from s3
-	# Returns False for failure, True for success
+	# Images are downloaded and decoded concurrently on the worker pool.
+	# All or nothing: returns False for failure (if any image fails), True for success
 	def loadObsImages(self,obsId):
 		frame = {}
 		self.obsImages = {}
+		self.obsPartials = {}
+		self.generated = []
 		self.activeObs = obsId # Set which observation the current images are from
 
-		# Get frame by obsId
-		frame = self.getObs(obsId)
+		# Use a prefetch if one was started; otherwise start now.
+		pending = self.prefetched.pop(obsId, None)
+		if pending is None:
+			# Get frame by obsId
+			frame = self.getObs(obsId)
 
-		# Exit if frame not found
-		if frame == {}:
-			return False
-
-		# For each image in the frame...
-		for im in frame['images']:
-			filterPos = im['imageid'][-4:-2] # Get filter eye & pos
-			
-			req = requests.get(im['url']) # Pull down the image from merpublic bucket
-			if req.status_code != 200: # If it fails, a "valid" url died, so fail method
+			# Exit if frame not found
+			if frame == {}:
 				return False
 
-			# Read image into numpy array (i.e. OpenCV image!)
-			self.obsImages[filterPos] = np.asarray(bytearray(req.content), dtype='uint8')
-			self.obsImages[filterPos] = cv2.imdecode(self.obsImages[filterPos], cv2.IMREAD_GRAYSCALE)
-		
+			pending = self.startObsLoad(frame)
+
+		# If any image fails, a "valid" url died, so fail method
+		images, partials = self.finishObsLoad(pending)
+		if images is None:
+			return False
+
 		# At this point return success!
+		self.obsImages = images
+		self.obsPartials = partials
 		return True
 
+	# Stop the worker pool (and any prefetches still running).
+	def close(self):
+		if self.pool is not None:
+			self.pool.shutdown(wait=False, cancel_futures=True)
+			self.pool = None
+		self.prefetched = {}
+
 	# Check if any current images are partials - return filter position of all partials
+	# (Worked out when the observation was loaded; this just reads the result.)
 	def checkPartialImages(self):
-		partials = []
-
-		# First check if there is an observation to check; return empty otherwise.
-		if self.obsImages == {}:
-			return []
-		
-		# Now go through images and use util funtion to test for partials:
-		for key,val in self.obsImages.items():
-			if image_utils.checkPartial(val):
-				partials.append(key)
+		return [key for key, partial in self.obsPartials.items() if partial]
 
-		return partials
+	# True if the given filter position is loaded and complete.
+	def isFrameUsable(self,filterPos):
+		return (filterPos in self.obsImages) and not self.obsPartials.get(filterPos, False)
 	
 	# Create a false color image using one filter for each channel.
 	# Usually this involves the L2, L5, and L7 filters, can occasionally be L456.
@@ -154,57 +302,245 @@ class Pancam:
 	# Will reject if different eyes or requested filters are unavailable (or partial).
 	# Returns True if image created and False otherwise; image added to obsImages dict.
 	def makeFalseColor(self,redFilter,greenFilter,blueFilter):
-		colorId = ""
-		# Check for same eye in all images, and set eye in ID if good.
-		if (redFilter[0] == greenFilter[0]) and (redFilter[0] == blueFilter[0]):
-			colorId = redFilter[0]
-		else:
+		# Check for same eye in all images.
+		if not (redFilter[0] == greenFilter[0] == blueFilter[0]):
 			return False
 
-		# Now check for existence and completeness of requested frames
-		if (redFilter not in self.obsImages) or (redFilter in self.checkPartialImages()):
-			return False
-		elif (greenFilter not in self.obsImages) or (greenFilter in self.checkPartialImages()):
-			return False
-		elif (blueFilter not in self.obsImages) or (blueFilter in self.checkPartialImages()):
-			return False
-		else:
-			# If all good, finish the identifier:
-			colorId = colorId + redFilter[1] + greenFilter[1] + blueFilter[1]
+		# Existence and completeness of requested frames is checked by the compositor;
+		# the product just won't be built if any are missing (or partial).
+		return self.makeProducts([composite.falseColor(redFilter,greenFilter,blueFilter)]) != []
 
-		# Now for the easy part (yay OpenCV): Merge the images.
-		imArray = [self.obsImages[blueFilter], self.obsImages[greenFilter], self.obsImages[redFilter]] # Note: OpenCV uses BGR instead of RGB for some reason. "Legacy."
-		self.obsImages[colorId] = cv2.merge(imArray)
-
-		return True
+	# Build every possible product for the loaded observation in one pass (default: all of composite.DEFAULT_PRODUCTS).
+	# Only complete (non-partial) frames are used. Products are added to obsImages.
+	# Returns list of names of the products made.
+	def makeProducts(self,products=None):
+		frames = {key : self.obsImages[key] for key, partial in self.obsPartials.items() if not partial}
+		with metrics.stage('composite'):
+			built = self.compositor.build(frames, products)
+		metrics.count('products_built', len(built))
+		self.obsImages.update(built)
+		self.generated.extend(name for name in built if name not in self.generated)
+		return list(built)
 
 	# Cache generated images locally.
 	# Uses path in .marsroverio config file.
+	# With a pyramid, smaller sizes of the products and of the raw frames go in <level>/ subdirectories
+	# (keys '<product>/<level>' and '<filter position>/<level>' in savedImages, see getProductInputs).
+	# Products are encoded and written by the output writer's workers (format/quality from config).
+	# With wait=False this only queues them, so the next observation can be loaded and composited
+	# meanwhile; finishSave(obsId) collects the result later.
+	# Path and content hash of each file written are kept in savedImages.
 	# Return True if success and False if failure
-	def saveGenObsImages(self):
-		conf = json.load(open(os.path.expanduser('~/.marsroverio'),'r'))
-		localImageDir = conf['images_path'] + self.sc['mission'] + '/' + str(self.sol) + '/'
-		# Check for directory's existence. If it doesn't exist, create.
-		if not os.path.isdir(localImageDir):
-			if os.path.isfile(localImageDir[:-1]): # Cut the '/' for this check
-				return False
-			else:
-				os.makedirs(localImageDir)
+	def saveGenObsImages(self, wait=True):
+		localImageDir = self.prepareImageDir()
+		if localImageDir is None:
+			return False
+
+		# Only products made by makeProducts are saved at full size, not the raw frames.
+		saves = {}
+		sources = {}
+		for key in self.generated:
+			path = localImageDir + self.activeObs + key + self.writer.extension
+			saves[key] = self.writer.submit(path, self.obsImages[key])
+			sources[key] = path
 
-		# Save images. Not the best algorithm to detect which are generated, but eh.
-		# This doesn't just look for a L257 so we can accomodate other color sets and future other products.
-		nonGen = self.getObsFilters(self.activeObs)
-		for key,val in self.obsImages.items():
-			if key not in nonGen:
-				cv2.imwrite(localImageDir + self.activeObs + key + '.jpg',val)
+		# Smaller sizes: of the products, and of the raw frames (their full size is already public), named by imageid.
+		if self.pyramid is not None:
+			for im in self.getObs(self.activeObs).get('images', []):
+				if im['imageid'][-4:-2] in self.obsImages:
+					sources[im['imageid'][-4:-2]] = localImageDir + im['imageid'] + self.writer.extension
+			for key, path in sources.items():
+				with metrics.stage('pyramid'):
+					levels = self.pyramid.build(self.obsImages[key])
+				for level, image in levels.items():
+					saves[key + '/' + level] = self.writer.submit(self.pyramid.path(path, level), image)
 
+		self.pendingSaves[self.activeObs] = saves
+		if wait:
+			return self.finishSave(self.activeObs)
 		return True
 
+	# Save the pyramid levels of each raw frame of an observation without loading it at full size
+	# (for observations nothing is generated from). Frames are decoded at reduced resolution, only as
+	# fine as the largest level needs. They're in savedImages as '<filter position>/<level>'.
+	# A frame that fails to download or decode is left out, like a failed save.
+	# With wait=False the saves are only queued; finishSave(obsId) collects them later.
+	# Returns True if every frame was fetched (and, with wait, saved).
+	def saveObsDerivatives(self, obsId, wait=True):
+		frame = self.getObs(obsId)
+		localImageDir = self.prepareImageDir()
+		if frame == {} or localImageDir is None:
+			return False
+		if self.pyramid is None:
+			self.pendingSaves[obsId] = {}
+			return self.finishSave(obsId) if wait else True
+
+		if self.pool is None:
+			self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.workers))
+		pending = [(im, self.pool.submit(self.fetchReduced, im)) for im in frame['images']]
+		saves = {}
+		ok = True
+		for im, future in pending:
+			try:
+				reduced = future.result()
+			except LOAD_ERRORS:
+				metrics.count('image_load_errors')
+				reduced = None
+			if reduced is None:
+				ok = False
+				continue
+			path = localImageDir + im['imageid'] + self.writer.extension
+			with metrics.stage('pyramid'):
+				levels = self.pyramid.build(reduced)
+			for level, image in levels.items():
+				saves[im['imageid'][-4:-2] + '/' + level] = self.writer.submit(self.pyramid.path(path, level), image)
+		self.pendingSaves[obsId] = saves
+		if wait:
+			return self.finishSave(obsId) and ok
+		return ok
+
+	# Output directory for this sol (plus one per pyramid level), created if needed. None if it can't be.
+	# Also picks up the shared writer the first time, if none was given.
+	def prepareImageDir(self):
+		if self.writer is None:
+			import pipeline.output_writer as output_writer # Only needed (with cv2 encoders) when saving
+			self.writer = output_writer.getSharedWriter()
+		if self.imageDir is None:
+			self.imageDir = config.getConfig()['images_path'] + self.sc['mission'] + '/' + str(self.sol) + '/'
+		# Check for directory's existence. If it doesn't exist, create.
+		if not os.path.isdir(self.imageDir):
+			if os.path.isfile(self.imageDir[:-1]): # Cut the '/' for this check
+				return None
+			os.makedirs(self.imageDir, exist_ok=True)
+		for level, size in (self.pyramid.levels if self.pyramid is not None else []):
+			os.makedirs(self.imageDir + level, exist_ok=True)
+		return self.imageDir
+
+	# Mosaic the observations of a sequence, using one filter position (e.g. 'L2') or one product
+	# (e.g. 'L257', see composite.py) from each; observations without it (or with it partial) are left
+	# out, but keep their place.
+	# Only one observation is in memory at a time, and the mosaic is assembled on disk, tile by tile.
+	# positions places observations by pointing, {obsId : (y, x)} in pixels; without it they're
+	# placed by index (see mosaic.py). Only observations with a position are used then.
+	# The preview is saved as <seqId><key>_mosaic and the full-size tiles under mosaic/<seqId><key>/,
+	# and they're in savedImages ('mosaic', 'mosaic/<row>_<column>'), ready for publishGenObsImages.
+	# The whole full-size mosaic is kept next to the tiles as canvas.npy (memory-mappable, for cropping
+	# or re-tiling without redoing the blend); it's a local product only, too big to publish.
+	# Whatever observation was loaded before is still loaded after.
+	# Returns the number of observations used (0 if none could be, or downloads failed; nothing is saved).
+	def makeMosaic(self,seqId,key='L2',positions=None,settings=None):
+		import missions.mer.mosaic as mosaic # cv2
+		localImageDir = self.prepareImageDir()
+		if localImageDir is None:
+			return 0
+		name = seqId + key
+		tileDir = localImageDir + 'mosaic/' + name + '/'
+		products = [p for p in composite.DEFAULT_PRODUCTS if p['name'] == key]
+		oids = [oid for oid in self.getSeqObs(seqId) if positions is None or oid in positions]
+		frames = self.iterProductFrames(oids, key, products) if products else self.iterFilterFrames(oids, key)
+
+		builder = mosaic.Mosaic(tileDir + 'work/', settings)
+		try:
+			for oid, image in frames:
+				if image is not None:
+					builder.addFrame(image, positions[oid] if positions is not None else None)
+				else:
+					builder.skipFrame()
+			if len(builder) == 0:
+				return 0
+			# Built in the work directory, and only moved into place once complete.
+			canvas, preview, saves = builder.build(builder.workDir + 'canvas.npy', self.writer,
+												lambda row, column: tileDir + '%d_%d%s' % (row, column, self.writer.extension))
+			del canvas # Flushed; tiles and preview have their own copies
+			os.replace(builder.workDir + 'canvas.npy', tileDir + 'canvas.npy')
+		except LOAD_ERRORS:
+			metrics.count('image_load_errors')
+			return 0
+		finally:
+			frames.close() # Stops any downloads still running ahead
+			builder.close()
+		self.pendingSaves[name] = {'mosaic/%d_%d' % tile : future for tile, future in saves.items()}
+		self.pendingSaves[name]['mosaic'] = self.writer.submit(localImageDir + name + '_mosaic' + self.writer.extension, preview)
+		return len(builder) if self.finishSave(name) else 0
+
+	# (obsId, frame of one filter position) for each observation, the frame None if missing or partial.
+	# Downloads run ahead on the worker pool, a few at a time, but frames are handed back one by one.
+	# A download error (LOAD_ERRORS) is raised to the caller; downloads still running ahead are cancelled
+	# then, or whenever the caller stops early.
+	def iterFilterFrames(self,oids,filterPos):
+		import missions.mer.image_utils as image_utils # cv2
+		if self.pool is None:
+			self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.workers))
+
+		def start(oid):
+			images = [im for im in self.getObs(oid).get('images', []) if im['imageid'][-4:-2] == filterPos]
+			return oid, (self.pool.submit(self.fetchImage, images[0]) if images else None)
+
+		def finish(oid, future):
+			image = future.result() if future is not None else None
+			return oid, (image if image is not None and not image_utils.checkPartial(image) else None)
+
+		pending = collections.deque()
+		try:
+			for oid in oids:
+				pending.append(start(oid))
+				if len(pending) > self.workers:
+					yield finish(*pending.popleft())
+			while pending:
+				yield finish(*pending.popleft())
+		finally:
+			for oid, future in pending:
+				if future is not None:
+					future.cancel()
+
+	# (obsId, product image) for each observation, the image None if it can't be made.
+	# The next observation is prefetched while this one is composited.
+	# Loads each observation in turn (loadObsImages), so it puts back whatever observation was loaded
+	# before when done, and drops any prefetch of its own it didn't get to.
+	def iterProductFrames(self,oids,key,products):
+		loaded = (self.obsImages, self.obsPartials, self.generated, getattr(self, 'activeObs', None))
+		try:
+			for i, oid in enumerate(oids):
+				if i + 1 < len(oids):
+					self.prefetchObsImages(oids[i+1])
+				image = None
+				if self.loadObsImages(oid) and self.makeProducts(products):
+					image = self.obsImages[key]
+				self.obsImages = {} # Let go of the frames before the next observation comes in
+				self.generated = []
+				yield oid, image
+		finally:
+			for oid in oids:
+				for filterPos, future in self.prefetched.pop(oid, []):
+					future.cancel()
+			self.obsImages, self.obsPartials, self.generated, self.activeObs = loaded
+
+	# Wait for the products of an observation queued by saveGenObsImages(wait=False), and put
+	# what was written into savedImages. Returns True if everything was written.
+	def finishSave(self, obsId):
+		import cv2 # For cv2.error; already loaded by the writer
+		self.savedImages = {}
+		ok = True
+		for key, future in self.pendingSaves.pop(obsId, {}).items():
+			try:
+				self.savedImages[key] = future.result()
+			except (OSError, ValueError, cv2.error): # Write failed, or encode did (cv2.error for e.g. an unsupported depth)
+				ok = False
+		return ok
+
+	# Queue the images from the last saveGenObsImages for upload to our s3 bucket (unchanged ones are skipped).
+	# Call the publisher's flush() once a batch of observations has been queued.
+	def publishGenObsImages(self, publisher):
+		for key, (path, contentHash) in self.savedImages.items():
+			publisher.putImage(self.sc, self.sol, os.path.relpath(path, self.imageDir), path, contentHash)
+
 if __name__ == "__main__":
 	print("TESTING MODULE: pancam.py")
 	import metadata.sol_metadata as solmd
+	import pipeline.output_writer as output_writer
+	import pipeline.pyramid as pyramid
 	SD = solmd.SolMetadata(spacecraft.MERB,4995)
-	PC = Pancam(SD.getInstrumentObs('pancam'),4995)
+	PC = Pancam(SD.getInstrumentObs('pancam'),4995,writer=output_writer.getSharedWriter(),pyramid=pyramid.Pyramid())
 	print(PC.checkInitStatus())
 	print(PC.getNumObs())
 	oids = PC.getObsIds()
@@ -213,11 +549,18 @@ if __name__ == "__main__":
 	for oid in oids:
 		print(PC.getObsFilters(oid))
 	print(PC.getObsFilters('fake_id'))
+	print(PC.prefetchObsImages(oids[1]))
 	print(PC.loadObsImages(oids[1]))
 	print(PC.checkPartialImages())
 	print(PC.makeFalseColor("L2","R2","L7"))
 	print(PC.makeFalseColor("R3","R2","R1"))
 	print(PC.makeFalseColor("L2","L5","L7"))
+	print(PC.getObsProducts(oids[1]))
+	print(PC.makeProducts())
 	print(PC.saveGenObsImages())
+	print(PC.saveObsDerivatives(oids[0]))
+	print(PC.getSeqObs(PC.getSeqId(oids[0])))
+	print(PC.makeMosaic(PC.getSeqId(oids[0]), 'L2'))
+	PC.close()
 	print("DONE.")
 
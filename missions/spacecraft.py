@@ -52,6 +52,9 @@ M20 =  {'raws_prefix' : 'Coming Soon(TM)',
 		'spacecraft' : 'M2020',
 		'instruments' : {}} # Many cams, 2 years to fill in.
 
+# Look up by the 'mission' string (i.e. what a command line or a config file will say).
+MISSIONS = {sc['mission'] : sc for sc in [MERB, MERA, MSL, NSYT, M20]}
+
 if __name__ == '__main__':
 	print("TESTING MODULE: spacecraft.py")
 	print("Opportunity: ")
@@ -79,5 +82,7 @@ if __name__ == '__main__':
 	print("    " + NSYT['raws_prefix'] + NSYT['image_manifest'])
 	print("    Spacecraft Info:")
 	print("    " + NSYT['name'] + " " + str(NSYT['scid']) + " " + NSYT['spacecraft'] + NSYT['mission'])
+	print("Missions: ")
+	print("    " + str(sorted(MISSIONS)))
 	print("DONE.")
 
@@ -0,0 +1,344 @@
+#!/usr/bin/python3
+#
+# Backfill driver: regenerates products for a range of sols (or the sols the manifest says changed)
+# by spreading sols across a pool of worker processes.
+# Each sol is: SolMetadata -> instrument handler per observation -> composite -> save.
+# Every product's inputs and output are recorded in the state store, and observations whose products
+# are all current are skipped before anything is downloaded.
+# With changedOnly, each sol's image manifest is diffed against the snapshot from the last
+# successful run, and only new or changed observations are processed.
+# Every sol manifest fetched is also added to the observation index (metadata/obs_index.py), and
+# --seq uses that index to reprocess just the observations of a sequence, without scanning manifests.
+# With --mosaic KEY, each sequence with a new or changed observation (every sequence, without
+# --changed-only) is also mosaicked (Pancam.makeMosaic), from one filter position or product of each
+# of its observations.
+# With publish, the sol manifest and new products also go up to our s3 bucket (pipeline/publisher.py).
+# Each worker's stage timings and counters (metadata/metrics.py) come back with its results and are
+# merged, for the --metrics-json / --metrics-prom reports.
+# Outputs land where saveGenObsImages always puts them (images_path/mission/sol/), so the layout
+# doesn't depend on which worker did what or in what order.
+#
+# Usage, from the root directory:
+#     marsrover-pipeline $ python3 -m pipeline.backfill merb --sols 1200 1300
+#     marsrover-pipeline $ python3 -m pipeline.backfill msl --updated --replace-manifest
+#     marsrover-pipeline $ python3 -m pipeline.backfill msl --queue
+#
+
+# Library imports
+import sys
+import json
+import argparse
+import resource
+import traceback
+import concurrent.futures
+
+# marsrover-pipeline imports
+import missions.spacecraft as spacecraft
+import metadata.config as config
+import metadata.util as util
+import metadata.manifest as manifest
+import metadata.sol_metadata as solmd
+import metadata.sol_diff as sol_diff
+import metadata.metrics as metrics
+import metadata.obs_index as obs_index
+import pipeline.state_store as state_store
+import pipeline.work_queue as work_queue
+
+# Instrument handlers per mission; instruments not listed here have nothing to generate (yet).
+# Sols of a mission with none at all are reported as unsupported rather than ok.
+def getHandlers(sc):
+	if sc['spacecraft'] in ('MER1', 'MER2'):
+		import missions.mer.pancam as pancam
+		return {'pancam' : pancam.Pancam}
+	return {}
+
+# Per-worker setup: cap the address space so one runaway sol fails on its own (MemoryError)
+# instead of taking the machine down. memoryMb of None/0 means no cap.
+# profileStages/profileDir: stages to run under cProfile, and where each worker writes the profiles.
+def initWorker(memoryMb, profileStages=None, profileDir=None):
+	global workerProfileDir
+	if memoryMb:
+		limit = int(memoryMb) * 1024 * 1024
+		resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+	if profileStages:
+		metrics.registry.profile(profileStages)
+	workerProfileDir = profileDir
+
+workerProfileDir = None
+
+# Regenerate everything for one sol. Runs in a worker process.
+# Never raises; returns a result dict describing what happened. 'unsupported' is set (with 'ok') when
+# the mission has no product handlers: the sol was indexed (and published) but nothing was generated.
+# onlyObs, if given, restricts it to those observation ids, and onlyProducts to those product names.
+# mosaicKey, if given, turns on the mosaic stage.
+def processSol(mission, sol, imageWorkers=None, changedOnly=False, publish=False, onlyObs=None, mosaicKey=None, onlyProducts=None):
+	result = {'mission' : mission, 'sol' : sol, 'ok' : False, 'unsupported' : False,
+			'observations' : 0, 'skipped_obs' : 0, 'products' : 0, 'mosaics' : 0, 'failed_obs' : [], 'error' : None}
+	metrics.registry.reset() # Workers handle many sols; report just this one's
+	try:
+		with metrics.registry.stage('sol_total'):
+			runSol(mission, sol, imageWorkers, changedOnly, publish, onlyObs, mosaicKey, onlyProducts, result)
+	finally:
+		result['metrics'] = metrics.registry.snapshot()
+		if workerProfileDir is not None:
+			metrics.registry.writeProfiles(workerProfileDir)
+	return result
+
+# The work of processSol; fills in result.
+def runSol(mission, sol, imageWorkers, changedOnly, publish, onlyObs, mosaicKey, onlyProducts, result):
+	publisher = None
+	state = None
+	try:
+		state = state_store.StateStore()
+		sc = spacecraft.MISSIONS[mission]
+		sd = solmd.SolMetadata(sc, sol)
+		if not sd.initStatus:
+			result['error'] = 'no sol metadata'
+			return
+		index = obs_index.ObsIndex()
+		index.addSol(sc, sol, sd.imageMd)
+		index.close()
+
+		# Diff against the last-seen manifest; without one (or without changedOnly) everything counts as added.
+		snapshots = sol_diff.SnapshotStore(sc)
+		diff = sol_diff.SolDiff(snapshots.load(sol) if changedOnly else None, sd.imageMd, sc['instruments'])
+		if publish:
+			import pipeline.publisher as s3publisher # Only needed (with boto3) when publishing
+			publisher = s3publisher.getSharedPublisher()
+			sd.putSolOnBucket(publisher)
+
+		handlers = getHandlers(sc)
+		if handlers:
+			import pipeline.output_writer as output_writer # cv2, like the handlers; not needed without them
+			import pipeline.pyramid as pyramid
+		products = productsFor(onlyProducts) if onlyProducts is not None else None
+		result['unsupported'] = not handlers
+		for inst, handler in handlers.items():
+			block = sd.getInstrumentObs(inst)
+			if not block:
+				continue
+			obsHandler = handler(block, sol, workers=imageWorkers, writer=output_writer.getSharedWriter(), pyramid=pyramid.Pyramid())
+			try:
+				if not obsHandler.checkInitStatus():
+					continue
+
+				# Only new/changed observations that can make something, and that the state store
+				# doesn't already have current outputs for.
+				changed = set(diff.obsToProcess(inst))
+				if onlyObs is not None:
+					changed &= set(onlyObs)
+				todo = []
+				productInputs = {}
+				for oid in obsHandler.getObsIds():
+					if oid not in changed:
+						continue
+					inputs = {product : {im['imageid'] : util.imageFingerprint(im) for im in images}
+							for product, images in obsHandler.getProductInputs(oid, products).items()}
+					if inputs and not state.isObsCurrent(mission, sol, oid, inputs):
+						todo.append(oid)
+						productInputs[oid] = inputs
+				result['skipped_obs'] += obsHandler.getNumObs() - len(todo)
+
+				# Once an observation's products are on disk, record (and publish) them.
+				def finishObs(oid):
+					if not obsHandler.finishSave(oid):
+						result['failed_obs'].append(oid)
+						return
+					state.recordObs(mission, sol, oid, productInputs[oid], obsHandler.savedImages,
+									sd.imageMd.get('last_manifest_update'))
+					if publisher is not None:
+						obsHandler.publishGenObsImages(publisher)
+
+				# Observations nothing can be composited from only need their raw frames' smaller sizes,
+				# which don't take a full-resolution load.
+				derivativesOnly = {oid for oid in todo if not productsFor(productInputs[oid])}
+
+				# Prefetch the next observation while compositing this one, and encode/write this one's
+				# products while the next is loaded and composited.
+				saving = None
+				for i, oid in enumerate(todo):
+					if i + 1 < len(todo) and todo[i+1] not in derivativesOnly:
+						obsHandler.prefetchObsImages(todo[i+1])
+					result['observations'] += 1
+					if oid in derivativesOnly:
+						if not obsHandler.saveObsDerivatives(oid, wait=False):
+							obsHandler.finishSave(oid) # Drop what did get queued; the observation is redone
+							result['failed_obs'].append(oid)
+							continue
+					else:
+						if not obsHandler.loadObsImages(oid):
+							result['failed_obs'].append(oid)
+							continue
+						result['products'] += len(obsHandler.makeProducts(productsFor(productInputs[oid])))
+						if not obsHandler.saveGenObsImages(wait=False):
+							result['failed_obs'].append(oid)
+							continue
+					if saving is not None:
+						finishObs(saving)
+					saving = oid
+				if saving is not None:
+					finishObs(saving)
+
+				# Mosaic every sequence (of more than one observation) with a new or changed observation
+				# (so, without changedOnly, every sequence), even if its products were current.
+				if mosaicKey is not None and hasattr(obsHandler, 'makeMosaic'):
+					for seqId in sorted({obsHandler.getSeqId(oid) for oid in obsHandler.getObsIds() if oid in changed}):
+						if len(obsHandler.getSeqObs(seqId)) > 1 and obsHandler.makeMosaic(seqId, mosaicKey):
+							result['mosaics'] += 1
+							if publisher is not None:
+								obsHandler.publishGenObsImages(publisher)
+			finally: # Its image pool goes even if the sol fails part way
+				obsHandler.close()
+
+		if publisher is not None:
+			failed = publisher.flush()
+			if failed:
+				result['error'] = 'upload failed: ' + ', '.join(sorted(failed))
+
+		result['ok'] = (result['failed_obs'] == [] and result['error'] is None)
+		# Only a full pass counts as having seen this manifest: unsupported sols still count as changed once
+		# there are handlers, and observations or products a partial run left out still need doing.
+		if result['ok'] and not result['unsupported'] and onlyObs is None and onlyProducts is None:
+			snapshots.save(sol, sd.imageMd)
+	except MemoryError:
+		result['error'] = 'over worker memory budget'
+	except Exception:
+		result['error'] = traceback.format_exc(limit=3)
+	finally:
+		if state is not None:
+			state.close()
+
+# Product specs (from the compositor defaults) for a set of product names.
+def productsFor(names):
+	import missions.mer.composite as composite
+	return [p for p in composite.DEFAULT_PRODUCTS if p['name'] in names]
+
+# Run processSol for each sol on a process pool. Returns results sorted by sol.
+# progress, if given, is called with each result as it finishes.
+# profileStages/profileDir turn on cProfile for those stages in the workers (see metrics.py).
+# onlyObs, if given, is {sol : [observation ids]} to restrict each sol to.
+# mosaicKey, if given, also mosaics sequences, and onlyProducts restricts products (see processSol).
+# Workers' metrics are merged into metrics.registry.
+def backfill(mission, sols, workers=None, memoryMb=None, imageWorkers=None, progress=None, changedOnly=False, publish=False,
+			profileStages=None, profileDir=None, onlyObs=None, mosaicKey=None, onlyProducts=None):
+	results = []
+	# Fresh worker every so often so leaks/fragmentation can't build up over thousands of sols.
+	with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+												initializer=initWorker, initargs=(memoryMb, profileStages, profileDir),
+												max_tasks_per_child=50) as pool:
+		futures = {pool.submit(processSol, mission, sol, imageWorkers, changedOnly, publish,
+							onlyObs.get(sol, []) if onlyObs is not None else None, mosaicKey, onlyProducts) : sol for sol in sols}
+		for future in concurrent.futures.as_completed(futures):
+			try:
+				result = future.result()
+			except Exception as e: # Worker died outright (killed, pool broken, ...)
+				result = {'mission' : mission, 'sol' : futures[future], 'ok' : False,
+						'observations' : 0, 'skipped_obs' : 0, 'products' : 0, 'failed_obs' : [], 'error' : repr(e)}
+			snap = result.pop('metrics', None)
+			if snap is not None:
+				metrics.registry.merge(snap)
+			results.append(result)
+			if progress is not None:
+				progress(result)
+
+	return sorted(results, key=lambda r: r['sol'])
+
+def printResult(result):
+	if result.get('unsupported') and result['ok']:
+		print("sol %d: skipped (no product handlers for %s)" % (result['sol'], result['mission']))
+	elif result['ok']:
+		print("sol %d: ok (%d obs, %d unchanged/skipped, %d products%s)" % (result['sol'], result['observations'], result['skipped_obs'], result['products'],
+																	', %d mosaics' % result['mosaics'] if result.get('mosaics') else ''))
+	else:
+		print("sol %d: FAILED (%s; failed obs: %s)" % (result['sol'], (result['error'] or 'observation load/save failed').strip().splitlines()[-1], result['failed_obs']))
+	sys.stdout.flush()
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Regenerate products for a range of sols using a process pool.')
+	parser.add_argument('mission', choices=sorted(spacecraft.MISSIONS))
+	which = parser.add_mutually_exclusive_group(required=True)
+	which.add_argument('--sols', nargs=2, type=int, metavar=('FIRST', 'LAST'), help='inclusive sol range (sols missing from the manifest are skipped)')
+	which.add_argument('--updated', action='store_true', help='sols updated in the remote manifest since the local one (implies --changed-only)')
+	which.add_argument('--queue', action='store_true', help='sols queued by pipeline.check (implies --changed-only)')
+	which.add_argument('--seq', default=None, help='observations in sequences starting with SEQ (e.g. P2532), from the observation index')
+	parser.add_argument('--product', default=None, help='with --seq, only make this product (e.g. L257), from the observations that can')
+	parser.add_argument('--mosaic', default=None, metavar='KEY', help='also mosaic each sequence (with a changed observation, with --changed-only), from this filter (e.g. L2) or product (e.g. L257)')
+	parser.add_argument('--changed-only', action='store_true', help='only process observations that changed since the last successful run')
+	parser.add_argument('--workers', type=int, default=None, help='worker processes (default: CPU count)')
+	parser.add_argument('--memory-mb', type=int, default=None, help="per-worker memory cap (default: 'backfill_worker_memory_mb' in config, else none)")
+	parser.add_argument('--image-workers', type=int, default=None, help="concurrent image downloads per worker (default: 'image_workers' in config)")
+	parser.add_argument('--publish', action='store_true', help="upload sol manifests and new products to our bucket ('publish' in config)")
+	parser.add_argument('--metrics-json', default=None, help='write stage timings and counters for the run to this JSON file')
+	parser.add_argument('--metrics-prom', default=None, help='write them in Prometheus text format to this file')
+	parser.add_argument('--profile', default=None, metavar='STAGES', help='comma-separated stages to run under cProfile (e.g. image_decode,composite)')
+	parser.add_argument('--profile-dir', default='profiles', help='where workers write <stage>.<pid>.prof files (default: ./profiles)')
+	parser.add_argument('--report', default=None, help='write per-sol results to this JSON file')
+	parser.add_argument('--stream-manifest', action='store_true', help='with --updated, parse the remote manifest incrementally (for very large manifests)')
+	parser.add_argument('--replace-manifest', action='store_true', help='with --updated, replace the local manifest if every sol succeeded')
+	args = parser.parse_args()
+	if args.product is not None and args.seq is None:
+		parser.error('--product only works with --seq')
+	if args.product is not None and not productsFor([args.product]):
+		parser.error('unknown product: ' + args.product)
+
+	sc = spacecraft.MISSIONS[args.mission]
+	m = manifest.Manifest(sc)
+	onlyObs = None
+	queue = None
+	if args.queue:
+		# Take back sols claimed by runs that died; a running scheduler's claims are left alone.
+		queue = work_queue.WorkQueue()
+		queue.requeueRunning(args.mission)
+		claimed = {sol : generation for mission, sol, generation in queue.claim(args.mission)}
+		sols = sorted(claimed)
+	elif args.seq is not None:
+		index = obs_index.ObsIndex()
+		onlyObs = index.obsBySol(args.mission, seq=args.seq, product=args.product)
+		index.close()
+		sols = sorted(onlyObs)
+	elif args.updated:
+		if args.stream_manifest:
+			fetched = m.streamRemoteManifest() # Finds updated sols as it goes
+		else:
+			fetched = m.getRemoteManifest()
+			if fetched:
+				m.findUpdatedSols()
+		if not fetched:
+			print("Could not fetch remote manifest.")
+			sys.exit(1)
+		sols = m.toUpdate
+	else:
+		sols = m.getSolRange(args.sols[0], args.sols[1])
+
+	memoryMb = args.memory_mb if args.memory_mb is not None else config.getConfig().get('backfill_worker_memory_mb')
+	print("Backfilling %d sols of %s" % (len(sols), sc['name']))
+	progress = printResult
+	if queue is not None:
+		# Mark each sol off as it finishes, so an interrupted run only redoes what it didn't get to.
+		def progress(result):
+			queue.finish(args.mission, result['sol'], claimed[result['sol']], result['ok'], result['error'])
+			printResult(result)
+	results = backfill(args.mission, sols, args.workers, memoryMb, args.image_workers, progress,
+					changedOnly=(args.changed_only or args.updated or args.queue), publish=args.publish,
+					profileStages=args.profile, profileDir=(args.profile_dir if args.profile else None), onlyObs=onlyObs,
+					mosaicKey=args.mosaic, onlyProducts=[args.product] if args.product is not None else None)
+
+	failed = [r['sol'] for r in results if not r['ok']]
+	unsupported = [r['sol'] for r in results if r['ok'] and r.get('unsupported')]
+	if queue is not None:
+		queue.close()
+	print("Done: %d ok, %d skipped (unsupported), %d failed %s" % (len(results) - len(failed) - len(unsupported), len(unsupported), len(failed), failed if failed else ''))
+
+	if args.metrics_json is not None:
+		metrics.registry.writeJson(args.metrics_json)
+	if args.metrics_prom is not None:
+		metrics.registry.writePrometheus(args.metrics_prom)
+
+	if args.report is not None:
+		with open(args.report, 'w') as outfile:
+			json.dump(results, outfile, indent=2)
+
+	if args.updated and args.replace_manifest and not failed:
+		m.replaceManifest()
+
+	sys.exit(1 if failed else 0)
@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+#
+# Cheap periodic check, for cron: is the remote manifest newer than ours? If so, which sols changed?
+# Those go onto the work queue (pipeline/work_queue.py) for backfill --queue to process, and the
+# local manifest is replaced so the next check only sees what's new since this one.
+# Only the manifest and HTTP code is imported: no OpenCV, no boto3, no instrument handlers, so a
+# check that finds nothing costs little more than one conditional GET (see bench/startup.py).
+#
+# Usage, from the root directory:
+#     marsrover-pipeline $ python3 -m pipeline.check merb msl
+#     marsrover-pipeline $ python3 -m pipeline.check msl --dry-run
+#
+
+# Library imports
+import sys
+import argparse
+
+# marsrover-pipeline imports
+import missions.spacecraft as spacecraft
+import metadata.manifest as manifest
+import pipeline.work_queue as work_queue
+
+# Check one mission. Returns the updated sols (empty if nothing changed), or None if the remote
+# manifest couldn't be fetched. Unless queue is None, they're enqueued and the local manifest replaced.
+# Updated sols among the most recent ones (Manifest.findRecentSols) are queued at recentPriority, if given.
+def checkMission(sc, queue=None, priority=0, recentPriority=None):
+	m = manifest.Manifest(sc)
+	status = m.checkManifestTimes()
+	if status == -1:
+		return None
+	if status == 0:
+		return []
+	m.findUpdatedSols()
+	if queue is not None:
+		recent = set()
+		if recentPriority is not None:
+			m.findRecentSols()
+			recent = set(m.recentSols)
+			queue.enqueue(sc['mission'], [sol for sol in m.toUpdate if sol in recent], recentPriority)
+		queue.enqueue(sc['mission'], [sol for sol in m.toUpdate if sol not in recent], priority)
+		m.replaceManifest() # Only once the sols are safely queued
+	return m.toUpdate
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Check remote manifests for updates and queue the updated sols.')
+	parser.add_argument('missions', nargs='+', choices=sorted(spacecraft.MISSIONS))
+	parser.add_argument('--priority', type=int, default=0, help='queue priority for the updated sols (higher goes first)')
+	parser.add_argument('--recent-priority', type=int, default=None, help='queue priority for updated sols among the most recent ones (default: --priority)')
+	parser.add_argument('--dry-run', action='store_true', help="just print the updated sols; don't queue them or touch the local manifest")
+	args = parser.parse_args()
+
+	queue = None if args.dry_run else work_queue.WorkQueue()
+	failed = False
+	for mission in args.missions:
+		sols = checkMission(spacecraft.MISSIONS[mission], queue, args.priority, args.recent_priority)
+		if sols is None:
+			print("%s: could not fetch remote manifest" % mission)
+			failed = True
+		elif not sols:
+			print("%s: up to date" % mission)
+		else:
+			print("%s: %d sols updated%s: %s" % (mission, len(sols), '' if args.dry_run else ', queued', sols))
+	if queue is not None:
+		queue.close()
+	sys.exit(1 if failed else 0)
@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+#
+# Output stage: encodes generated products and writes them to disk on a pool of worker threads,
+# so compositing (and the downloads feeding it) carry on while earlier products are encoded.
+# cv2.imencode releases the GIL, so the encoders really do run in parallel.
+# The queue is bounded: once it's full, submit() blocks, which holds back compositing and in turn
+# loading, instead of piling up decoded products in memory.
+# Files are written to a temp name and renamed into place, so a crash never leaves half an image.
+#
+# Settings come from the optional "output" block of ~/.marsroverio, e.g.:
+#	"output" : {"format" : "jpg", "quality" : 90, "progressive" : true, "workers" : 4, "queue_size" : 16}
+# format is jpg, webp or png; quality applies to jpg and webp (0-100), png_compression (0-9) to png.
+#
+
+# Library imports
+import os
+import hashlib
+import threading
+import concurrent.futures
+import cv2
+
+# marsrover-pipeline imports
+import metadata.config as config
+from metadata.metrics import registry as metrics
+
+DEFAULTS = {'format' : 'jpg',
+			'quality' : 95,          # OpenCV's own default for jpg
+			'progressive' : False,   # jpg only
+			'png_compression' : 3,
+			'workers' : 4,
+			'queue_size' : 16}       # Products queued or being encoded before submit() blocks
+
+EXTENSIONS = {'jpg' : '.jpg', 'webp' : '.webp', 'png' : '.png'}
+
+class OutputWriter:
+	def __init__(self, settings=None):
+		self.settings = dict(DEFAULTS)
+		self.settings.update(settings if settings is not None else {})
+		if self.settings['format'] not in EXTENSIONS:
+			raise ValueError('Unknown output format: ' + str(self.settings['format']))
+		self.extension = EXTENSIONS[self.settings['format']]
+		self.params = self.encodeParams()
+		self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.settings['workers'])
+		self.slots = threading.BoundedSemaphore(max(1, self.settings['queue_size']))
+
+	# cv2.imencode flags for the configured format.
+	def encodeParams(self):
+		fmt = self.settings['format']
+		if fmt == 'jpg':
+			return [cv2.IMWRITE_JPEG_QUALITY, int(self.settings['quality']),
+					cv2.IMWRITE_JPEG_PROGRESSIVE, int(bool(self.settings['progressive']))]
+		if fmt == 'webp':
+			return [cv2.IMWRITE_WEBP_QUALITY, int(self.settings['quality'])]
+		return [cv2.IMWRITE_PNG_COMPRESSION, int(self.settings['png_compression'])]
+
+	# Queue image to be encoded and written to path (which should end in self.extension).
+	# Blocks while the queue is full. Returns a Future for (path, sha1 of file contents);
+	# it raises if encoding or writing failed. The image must not be modified until then.
+	def submit(self, path, image):
+		with metrics.stage('output_queue_wait'): # Time held back by backpressure
+			self.slots.acquire()
+		try:
+			future = self.pool.submit(self.write, path, image)
+		except BaseException:
+			self.slots.release()
+			raise
+		future.add_done_callback(lambda f: self.slots.release())
+		return future
+
+	# Runs on the pool.
+	def write(self, path, image):
+		with metrics.stage('encode'):
+			ok, encoded = cv2.imencode(self.extension, image, self.params)
+		if not ok:
+			raise ValueError('Could not encode ' + path)
+		tmpPath = path + '.tmp' + str(os.getpid()) + '.' + str(threading.get_ident())
+		try:
+			with metrics.stage('write'):
+				with open(tmpPath,'wb') as outfile:
+					outfile.write(encoded)
+				os.replace(tmpPath, path)
+		except OSError:
+			try:
+				os.remove(tmpPath)
+			except OSError:
+				pass
+			raise
+		metrics.count('images_written')
+		metrics.count('bytes_written', len(encoded))
+		return path, hashlib.sha1(encoded).hexdigest()
+
+	# Wait for everything queued, then stop the workers.
+	def close(self):
+		self.pool.shutdown(wait=True)
+
+# One OutputWriter per process, made on first use.
+sharedWriter = None
+sharedWriterLock = threading.Lock()
+
+def getSharedWriter():
+	global sharedWriter
+	if sharedWriter is None:
+		with sharedWriterLock:
+			if sharedWriter is None:
+				sharedWriter = OutputWriter(config.getConfig().get('output', {}))
+	return sharedWriter
+
+if __name__ == '__main__':
+	print("TESTING MODULE: output_writer.py")
+	import tempfile
+	import numpy as np
+	image = np.random.RandomState(0).randint(0, 255, (1024, 1024, 3), dtype=np.uint8)
+	with tempfile.TemporaryDirectory() as tmp:
+		for settings in [{}, {'quality' : 70, 'progressive' : True}, {'format' : 'webp', 'quality' : 80}, {'format' : 'png'}]:
+			w = OutputWriter(settings)
+			path = os.path.join(tmp, 'product' + w.extension)
+			path, contentHash = w.submit(path, image).result()
+			decoded = cv2.imread(path)
+			with open(path,'rb') as infile:
+				print(settings, decoded.shape, os.path.getsize(path) // 1024, 'KiB', hashlib.sha1(infile.read()).hexdigest() == contentHash)
+			w.close()
+
+		# Backpressure: with 2 workers and a queue of 3, submit blocks once 3 are in flight.
+		w = OutputWriter({'workers' : 2, 'queue_size' : 3})
+		futures = [w.submit(os.path.join(tmp, 'q%d.jpg' % i), image) for i in range(12)]
+		print(all(f.result()[0].endswith('.jpg') for f in futures), len(os.listdir(tmp)))
+
+		# Failures come back through the future, and leave no temp files behind.
+		bad = w.submit(os.path.join(tmp, 'missing_dir', 'x.jpg'), image)
+		print(type(bad.exception()).__name__, [f for f in os.listdir(tmp) if '.tmp' in f])
+		w.close()
+		try:
+			OutputWriter({'format' : 'gif'})
+		except ValueError as e:
+			print(e)
+	print("DONE.")
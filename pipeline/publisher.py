@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+#
+# Publishes sol manifests and generated images to our s3 bucket.
+# One boto3 client for the whole process (they're thread-safe; building one costs more than most
+# uploads), uploads run concurrently on a thread pool, and text bodies are gzipped with the
+# matching Content-Encoding. Every published object's content hash is kept in the state store, so
+# re-publishing something unchanged (e.g. the recent-sols window on every run) costs nothing.
+#
+# Settings come from the optional "publish" block of ~/.marsroverio, e.g.:
+#	"publish" : {"bucket" : "marsroversio.data", "workers" : 8, "endpoint_url" : "http://localhost:5000"}
+# endpoint_url points boto3 at a local s3 stand-in (moto, minio, ...) instead of AWS.
+#
+# Usage: queue objects with putJson/putFile, then flush() to wait for them and record what went up.
+#
+
+# Library imports
+import os
+import gzip
+import json
+import hashlib
+import threading
+import concurrent.futures
+import boto3 # AWS
+
+# marsrover-pipeline imports
+import metadata.config as config
+import pipeline.state_store as state_store
+from metadata.metrics import registry as metrics
+
+DEFAULTS = {'bucket' : 'marsroversio.data',
+			'workers' : 8,
+			'endpoint_url' : None}
+
+# Content types worth compressing; images are already compressed.
+COMPRESSIBLE = ('application/json', 'text/')
+
+CONTENT_TYPES = {'.json' : 'application/json',
+				'.jpg' : 'image/jpeg',
+				'.png' : 'image/png',
+				'.webp' : 'image/webp'}
+
+class Publisher:
+	# s3 is a boto3 s3 client to use; by default one is made from settings.
+	# state is the StateStore that remembers published hashes; defaults to the shared state.sqlite.
+	def __init__(self, settings=None, s3=None, state=None):
+		self.settings = dict(DEFAULTS)
+		self.settings.update(settings if settings is not None else {})
+		self.bucket = self.settings['bucket']
+		self.s3 = s3 if s3 is not None else boto3.client('s3', endpoint_url=self.settings['endpoint_url'])
+		self.state = state if state is not None else state_store.StateStore(checkSameThread=False)
+		self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.settings['workers'])
+		self.lock = threading.Lock() # Guards pending and state; publishers can be shared between threads
+		self.pending = {} # key -> (future, published hash, earlier upload of the key it waits for or None)
+		self.uploaded = 0
+		self.skipped = 0
+
+	# Queue a json document under key.
+	def putJson(self, key, obj):
+		return self.put(key, json.dumps(obj, sort_keys=True).encode('utf-8'), 'application/json')
+
+	# Queue a local file under key. contentHash, if the caller already has the sha1 of the file
+	# (Pancam.savedImages does), saves reading it twice when it turns out to be unchanged.
+	def putFile(self, key, path, contentType=None, contentHash=None):
+		if contentType is None:
+			contentType = CONTENT_TYPES.get(path[path.rfind('.'):].lower(), 'application/octet-stream')
+		body = None
+		if contentHash is None:
+			with open(path,'rb') as infile:
+				body = infile.read()
+			contentHash = hashlib.sha1(body).hexdigest()
+		return self.put(key, body, contentType, contentHash, path)
+
+	# Queue a generated image of a sol (filename relative to the sol's directory, see imageKey).
+	def putImage(self, sc, sol, filename, path, contentHash=None):
+		return self.putFile(imageKey(sc, sol, filename), path, contentHash=contentHash)
+
+	# Queue body (bytes) under key, unless exactly this content was already published (or queued) there.
+	# Uploads of one key go up in the order queued: if older content is still queued for the key, it's
+	# cancelled, or if already uploading, the new upload waits for it, so the newest content lands last.
+	# Returns True if an upload was queued, False if it was skipped as unchanged.
+	def put(self, key, body, contentType, contentHash=None, path=None):
+		if contentHash is None:
+			contentHash = hashlib.sha1(body).hexdigest()
+		compress = contentType.startswith(COMPRESSIBLE)
+		# Anything that changes the stored object changes the recorded hash.
+		publishedHash = contentHash + (':gzip:' if compress else ':') + contentType
+
+		with self.lock:
+			queued = self.pending.get(key)
+			if queued is not None and queued[1] == publishedHash:
+				self.skipped += 1
+				metrics.count('publish_skipped')
+				return False
+			if queued is None and self.state.getPublished(self.bucket, key) == publishedHash:
+				self.skipped += 1
+				metrics.count('publish_skipped')
+				return False
+			previous = None
+			if queued is not None:
+				previous = queued[0]
+				if previous.cancel():
+					previous = queued[2] # Never started: wait for whatever it was waiting for instead
+			future = self.pool.submit(self.upload, key, body, path, contentType, compress, contentHash, previous)
+			self.pending[key] = (future, publishedHash, previous)
+		return True
+
+	# Runs on the pool. previous is an earlier upload of the same key that has to land first.
+	# (It's already running, so waiting on it here can't deadlock the pool.)
+	def upload(self, key, body, path, contentType, compress, contentHash, previous=None):
+		if previous is not None:
+			concurrent.futures.wait([previous]) # Whether it failed doesn't matter, this one supersedes it
+		if body is None:
+			with open(path,'rb') as infile:
+				body = infile.read()
+		extra = {'ContentType' : contentType, 'Metadata' : {'sha1' : contentHash}}
+		if compress:
+			body = gzip.compress(body, mtime=0) # mtime=0 so the same content gives the same bytes
+			extra['ContentEncoding'] = 'gzip'
+		with metrics.stage('publish_upload'):
+			self.s3.put_object(Bucket=self.bucket, Key=key, Body=body, **extra)
+		metrics.count('bytes_uploaded', len(body))
+
+	# Wait for everything queued (or just the uploads of keys, leaving other callers' alone), and record
+	# the successes (one transaction).
+	# Returns {key : error string} for uploads that failed; those are retried on the next put.
+	def flush(self, keys=None):
+		with self.lock:
+			if keys is None:
+				pending = dict(self.pending)
+			else:
+				pending = {key : self.pending[key] for key in keys if key in self.pending}
+		done = []
+		failed = {}
+		for key, (future, publishedHash, previous) in pending.items():
+			try:
+				future.result()
+				done.append((key, publishedHash))
+			except Exception as e:
+				failed[key] = repr(e)
+		with self.lock:
+			# A key queued again meanwhile stays pending, so it's still ordered after this upload.
+			for key, entry in pending.items():
+				if self.pending.get(key) is entry:
+					del self.pending[key]
+			self.state.recordPublished(self.bucket, done)
+			self.uploaded += len(done)
+		return failed
+
+	def close(self):
+		self.flush()
+		self.pool.shutdown()
+		self.state.close()
+
+# Bucket key for a sol's image manifest
+def solKey(sc, sol):
+	return 'latest_sols/' + sc['mission'] + '/images_sol' + str(sol) + '.json'
+
+# Bucket key for a generated image, mirroring images_path/<mission>/<sol>/<file>
+# (file may be in a pyramid level directory, e.g. 'thumb/<file>')
+def imageKey(sc, sol, filename):
+	return 'images/' + sc['mission'] + '/' + str(sol) + '/' + filename.replace(os.sep, '/')
+
+# One Publisher per process, made on first use.
+sharedPublisher = None
+sharedPublisherLock = threading.Lock()
+
+def getSharedPublisher():
+	global sharedPublisher
+	if sharedPublisher is None:
+		with sharedPublisherLock:
+			if sharedPublisher is None:
+				sharedPublisher = Publisher(config.getConfig().get('publish', {}))
+	return sharedPublisher
+
+if __name__ == '__main__':
+	print("TESTING MODULE: publisher.py")
+	import tempfile
+	from moto import mock_aws # Local s3 stand-in; pip install moto
+
+	os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+	os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+	os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+	with mock_aws(), tempfile.TemporaryDirectory() as tmp:
+		s3 = boto3.client('s3')
+		s3.create_bucket(Bucket=DEFAULTS['bucket'])
+		state = state_store.StateStore(os.path.join(tmp, 'state.sqlite'), checkSameThread=False)
+		p = Publisher(s3=s3, state=state)
+
+		imagePath = os.path.join(tmp, 'obsL257.jpg')
+		with open(imagePath,'wb') as outfile:
+			outfile.write(b'\xff\xd8 not really a jpeg')
+		sols = {sol : {'sol' : sol, 'pcam_images' : [{'id' : 'obs' + str(sol)}]} for sol in range(10)}
+		print([p.putJson('latest_sols/merb/images_sol%d.json' % sol, md) for sol, md in sols.items()].count(True))
+		print(p.putJson('latest_sols/merb/images_sol0.json', sols[0])) # Already queued
+		print(p.putFile('images/merb/0/obsL257.jpg', imagePath))
+		print(p.flush())
+		print(p.uploaded, p.skipped)
+
+		obj = s3.get_object(Bucket=DEFAULTS['bucket'], Key='latest_sols/merb/images_sol3.json')
+		print(obj['ContentEncoding'], obj['ContentType'], json.loads(gzip.decompress(obj['Body'].read())) == sols[3])
+		obj = s3.get_object(Bucket=DEFAULTS['bucket'], Key='images/merb/0/obsL257.jpg')
+		print(obj.get('ContentEncoding'), obj['ContentType'], obj['Body'].read())
+
+		# Second run: only what changed goes up, even from a fresh Publisher.
+		p.close()
+		p = Publisher(s3=s3, state=state_store.StateStore(os.path.join(tmp, 'state.sqlite'), checkSameThread=False))
+		sols[4]['pcam_images'].append({'id' : 'new'})
+		print([sol for sol, md in sols.items() if p.putJson('latest_sols/merb/images_sol%d.json' % sol, md)])
+		print(p.putFile('images/merb/0/obsL257.jpg', imagePath, contentHash=hashlib.sha1(open(imagePath,'rb').read()).hexdigest()))
+		print(p.flush(), p.uploaded, p.skipped)
+
+		# Changed again while queued or uploading: the newest content is what ends up in the bucket
+		for version in range(20):
+			p.putJson('latest_sols/merb/images_sol5.json', {'version' : version})
+		print(p.flush(), json.loads(gzip.decompress(s3.get_object(Bucket=DEFAULTS['bucket'], Key='latest_sols/merb/images_sol5.json')['Body'].read())),
+			p.state.getPublished(DEFAULTS['bucket'], 'latest_sols/merb/images_sol5.json') == hashlib.sha1(b'{"version": 19}').hexdigest() + ':gzip:application/json')
+
+		# Flushing some keys leaves the rest queued.
+		p.putJson('latest_sols/merb/images_sol6.json', {'version' : 1})
+		p.putJson('latest_sols/merb/images_sol7.json', {'version' : 1})
+		print(p.flush(['latest_sols/merb/images_sol6.json']), sorted(p.pending), p.flush(), sorted(p.pending))
+
+		# Failed uploads aren't recorded, so they go again next time.
+		bad = Publisher(s3=s3, state=p.state, settings={'bucket' : 'missing'})
+		bad.putJson('x.json', {})
+		print(list(bad.flush()), bad.putJson('x.json', {}))
+		bad.pool.shutdown()
+		bad.flush()
+		p.close()
+	print("DONE.")
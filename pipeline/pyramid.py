@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+#
+# Multi-resolution derivatives for the website: every product (and raw frame) in a few sizes.
+# Levels are built largest to smallest, each downsampled from the one before (INTER_AREA), so a
+# thumbnail costs a resize of the medium image instead of another pass over the full frame.
+# When only the smaller sizes of a JPEG are wanted (raw frames of observations nothing is generated
+# from), decodeThumbnail has libjpeg decode it at 1/2, 1/4 or 1/8 scale directly (IMREAD_REDUCED_*),
+# just fine enough for the largest level, which skips most of the decode work. The scale is picked
+# from the image's size (read from the JPEG header if not given), so it's decoded only once.
+# Instrument handlers don't import this; they're handed a Pyramid (see backfill.py).
+#
+# Layout, ready to publish as-is (see publisher.imageKey):
+#	<images_path>/<mission>/<sol>/<file>           full (unchanged)
+#	<images_path>/<mission>/<sol>/<level>/<file>   smaller levels, e.g. medium/, thumb/
+#
+# Levels come from the optional "pyramid" block of ~/.marsroverio, level name -> longest side in pixels:
+#	"pyramid" : {"medium" : 512, "thumb" : 64}
+# Without it, DEFAULT_LEVELS are made; "pyramid" : {} turns them off.
+#
+
+# Library imports
+import os
+import cv2
+import numpy as np
+
+# marsrover-pipeline imports
+import metadata.config as config
+
+DEFAULT_LEVELS = {'medium' : 512, 'thumb' : 64} # 64 matches MER's own thumbnail size
+
+# Reduced-resolution decode flags by scale factor, largest first.
+REDUCED_FLAGS = {cv2.IMREAD_GRAYSCALE : [(8, cv2.IMREAD_REDUCED_GRAYSCALE_8), (4, cv2.IMREAD_REDUCED_GRAYSCALE_4), (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)],
+				cv2.IMREAD_COLOR : [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)]}
+
+# SOF markers (baseline, progressive, ...); the others in 0xc0-0xcf (DHT, JPG, DAC) carry no size.
+SOF_MARKERS = set(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+
+# Configured levels (DEFAULT_LEVELS if not configured) as a list of (name, longest side), largest first.
+def getLevels():
+	levels = config.getConfig().get('pyramid', DEFAULT_LEVELS)
+	return sorted(levels.items(), key=lambda level: -level[1])
+
+# The levels to make, and how. Handed to instrument handlers, so they don't need config or this module.
+class Pyramid:
+	# levels is a list of (name, longest side); defaults to the configured ones.
+	def __init__(self, levels=None):
+		self.levels = sorted(levels if levels is not None else getLevels(), key=lambda level: -level[1])
+
+	# Every level of image, as {name : image}.
+	def build(self, image):
+		return buildPyramid(image, self.levels)
+
+	# An image already decoded, shrunk to the largest level (all build() needs).
+	def reduce(self, image):
+		return shrink(image, self.levels[0][1])
+
+	# A JPEG decoded straight to the largest level, at reduced resolution (see decodeThumbnail).
+	def decodeReduced(self, buf, sourceSize=None, flags=cv2.IMREAD_GRAYSCALE):
+		return decodeThumbnail(buf, self.levels[0][1], flags, sourceSize)
+
+	def path(self, fullPath, level):
+		return levelPath(fullPath, level)
+
+# Shrink image so its longest side is at most size (never enlarges).
+def shrink(image, size):
+	height, width = image.shape[:2]
+	scale = size / max(height, width)
+	if scale >= 1:
+		return image
+	return cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
+
+# Every level of image in one pass, each from the previous level.
+# levels is a list of (name, longest side); returns {name : image}, same order.
+def buildPyramid(image, levels):
+	pyramid = {}
+	current = image
+	for name, size in sorted(levels, key=lambda level: -level[1]):
+		current = shrink(current, size)
+		pyramid[name] = current
+	return pyramid
+
+# Longest side of a JPEG (bytes or uint8 array) from its SOF header, without decoding it; None if not found.
+def jpegSize(buf):
+	buf = memoryview(buf).cast('B')
+	i = 2 # After SOI
+	while i + 9 <= len(buf):
+		if buf[i] != 0xff:
+			return None
+		marker = buf[i+1]
+		if marker == 0xff: # Fill byte
+			i += 1
+			continue
+		if marker in SOF_MARKERS:
+			return max((buf[i+5] << 8) | buf[i+6], (buf[i+7] << 8) | buf[i+8])
+		i += 2 + ((buf[i+2] << 8) | buf[i+3])
+	return None
+
+# Decode a JPEG (bytes or uint8 array) straight to a thumbnail with longest side size,
+# letting libjpeg skip detail that would be thrown away. Returns None if it won't decode.
+# sourceSize is the longest side of the full image, if known; otherwise it's read from the header.
+# The coarsest scale that still gives at least size is used, in a single decode.
+def decodeThumbnail(buf, size, flags=cv2.IMREAD_GRAYSCALE, sourceSize=None):
+	buf = np.frombuffer(buf, dtype=np.uint8) if isinstance(buf, (bytes, bytearray, memoryview)) else buf
+	if sourceSize is None:
+		sourceSize = jpegSize(buf)
+	decodeFlags = flags
+	if sourceSize is not None:
+		# libjpeg rounds scaled sizes up
+		decodeFlags = next((reduced for factor, reduced in REDUCED_FLAGS[flags] if -(-sourceSize // factor) >= size), flags)
+	image = cv2.imdecode(buf, decodeFlags)
+	return shrink(image, size) if image is not None else None
+
+# Where a level of a file goes, given the full-size path.
+def levelPath(fullPath, level):
+	directory, filename = os.path.split(fullPath)
+	return os.path.join(directory, level, filename)
+
+if __name__ == '__main__':
+	print("TESTING MODULE: pyramid.py")
+	import time
+	y, x = np.mgrid[0:1024, 0:1024]
+	frame = ((x ^ y) & 0xff).astype(np.uint8)
+	levels = sorted(DEFAULT_LEVELS.items(), key=lambda level: level[1]) # Order given doesn't matter
+	p = buildPyramid(frame, levels)
+	print({name : image.shape for name, image in p.items()})
+	print(buildPyramid(np.zeros((1024, 1344, 3), np.uint8), levels)['thumb'].shape)
+	print(buildPyramid(np.zeros((32, 32), np.uint8), levels)['thumb'].shape) # Never enlarged
+
+	ok, jpeg = cv2.imencode('.jpg', frame)
+	thumb = decodeThumbnail(jpeg.tobytes(), 64)
+	print(thumb.shape, abs(int(thumb.mean()) - int(p['thumb'].mean())) < 4)
+	print(decodeThumbnail(jpeg, 512).shape, decodeThumbnail(jpeg, 2000).shape)
+	ok, small = cv2.imencode('.jpg', frame[:100, :100])
+	print(decodeThumbnail(small, 64).shape, decodeThumbnail(b'not a jpeg', 64))
+	print(jpegSize(jpeg), jpegSize(small), jpegSize(b'not a jpeg'), decodeThumbnail(jpeg, 64, sourceSize=1024).shape)
+	color = cv2.imdecode(cv2.imencode('.jpg', cv2.merge([frame, frame, frame]))[1], cv2.IMREAD_COLOR)
+	print(decodeThumbnail(cv2.imencode('.jpg', color)[1], 64, cv2.IMREAD_COLOR).shape)
+
+	start = time.perf_counter()
+	for i in range(20):
+		full = cv2.imdecode(jpeg, cv2.IMREAD_GRAYSCALE)
+		shrink(full, 64)
+	fullTime = time.perf_counter() - start
+	start = time.perf_counter()
+	for i in range(20):
+		decodeThumbnail(jpeg, 64)
+	print("thumbnail decode %.1fx faster than full decode + resize" % (fullTime / (time.perf_counter() - start)))
+	print(levelPath('/images/merb/5/obsL257.jpg', 'thumb'))
+	pyr = Pyramid(levels)
+	print(pyr.levels, pyr.reduce(frame).shape, pyr.decodeReduced(jpeg).shape, {name : image.shape for name, image in pyr.build(pyr.decodeReduced(jpeg)).items()})
+	print("DONE.")
@@ -0,0 +1,288 @@
+#!/usr/bin/python3
+#
+# Long-running service: polls every mission's remote manifest on its own interval, queues the sols
+# that changed (pipeline/check.py, pipeline/work_queue.py) and works through the queue on one
+# shared pool of worker processes (pipeline/backfill.py's processSol), publishing as it goes.
+# So a new downlink is picked up within one poll interval and goes out as soon as a worker is free,
+# instead of waiting for the next cron run and a full pass.
+#
+#	- Changed sols in the recent window (Manifest.findRecentSols) are queued ahead of everything
+#	  else; other changed sols, and ranges queued with --backfill, are backfill work.
+#	- Backfill isn't starved: every backfill_every'th job slot goes to backfill work if there is any.
+#	- A sol that fails (timeout, stale manifest, ...) is retried after retry_backoff seconds,
+#	  doubling each time, and only marked failed after max_attempts tries.
+#	- Per host, at most host_concurrency jobs run at once (overridable under "hosts"), so one
+#	  mission's bucket can't hog the pool. Request rates per host are capped by the "rate"
+#	  setting of the http block (see metadata/http_client.py), in each worker.
+#	- SIGTERM/SIGINT: stop polling and taking new jobs, let running ones finish (up to
+#	  shutdown_grace seconds), record them, kill the workers of any still running and put those
+#	  back on the queue, and exit. A second signal kills the workers and exits right away.
+#	  Workers ignore the signals themselves (they reach the whole process group), so only the
+#	  scheduler decides when they stop. The queue is on disk: whatever didn't finish is picked
+#	  up again on the next start.
+#
+# Settings come from the optional "scheduler" block of ~/.marsroverio, e.g.:
+#	"scheduler" : {
+#		"missions" : {"msl" : {"interval" : 120}, "merb" : {"interval" : 3600}},
+#		"workers" : 4, "host_concurrency" : 2, "backfill_every" : 4,
+#		"hosts" : {"msl-raws.s3.amazonaws.com" : {"concurrency" : 3}}
+#	}
+#
+# Usage, from the root directory:
+#     marsrover-pipeline $ python3 -m pipeline.scheduler msl merb --publish
+#     marsrover-pipeline $ python3 -m pipeline.scheduler merb --backfill merb 1 5000 --metrics-prom /var/lib/node_exporter/marsrover.prom
+#
+
+# Library imports
+import os
+import sys
+import time
+import signal
+import argparse
+import threading
+import collections
+import concurrent.futures
+from urllib.parse import urlsplit
+
+# marsrover-pipeline imports
+import missions.spacecraft as spacecraft
+import metadata.config as config
+import metadata.metrics as metrics
+import metadata.manifest as manifest
+import pipeline.check as check
+import pipeline.work_queue as work_queue
+import pipeline.backfill as backfill
+
+DEFAULTS = {'missions' : {},         # mission -> {'interval' : seconds}
+			'interval' : 300,        # Poll interval for missions without their own
+			'workers' : 4,           # Worker processes, shared by every mission
+			'image_workers' : None,  # Concurrent image downloads per worker (default: 'image_workers' in config)
+			'host_concurrency' : 2,  # Jobs at once against one host, unless set under 'hosts'
+			'hosts' : {},            # host -> {'concurrency' : n}
+			'backfill_every' : 4,    # Every n'th job slot prefers backfill work; 0 for strict priority
+			'max_attempts' : 5,      # Tries before a failing sol is marked failed
+			'retry_backoff' : 60,    # Seconds before the first retry; doubles for each one after
+			'shutdown_grace' : 600,  # Seconds to wait for running jobs on shutdown
+			'mosaic' : None,         # Filter or product to mosaic updated sequences from (see backfill --mosaic); None for no mosaics
+			'tick' : 1.0}            # Longest the loop sleeps between looking at things
+
+RECENT_PRIORITY = 10
+BACKFILL_PRIORITY = 0
+
+# Worker setup: leave SIGINT/SIGTERM to the scheduler, which lets running sols finish.
+def initWorker(memoryMb):
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	signal.signal(signal.SIGTERM, signal.SIG_IGN)
+	backfill.initWorker(memoryMb)
+
+class Scheduler:
+	# missions: mission names to poll. queuePath defaults to the shared work queue file.
+	def __init__(self, missions, settings=None, queuePath=None, publish=False, memoryMb=None):
+		self.settings = dict(DEFAULTS)
+		self.settings.update(settings if settings is not None else config.getConfig().get('scheduler', {}))
+		self.missions = list(missions)
+		self.queuePath = queuePath
+		self.queue = None # Opened by run(), in the thread that uses it
+		self.publish = publish
+		self.memoryMb = memoryMb
+		self.stopping = threading.Event()
+		self.nextPoll = {mission : 0 for mission in self.missions}
+		self.polls = {} # future -> mission
+		self.jobs = {} # future -> (mission, sol, generation)
+		self.hostJobs = collections.Counter()
+		self.queuedAt = {} # (mission, sol) -> when this process queued it, for the latency metric
+		self.dispatched = 0
+		self.pool = None
+		self.pollPool = None
+
+	def interval(self, mission):
+		return self.settings['missions'].get(mission, {}).get('interval', self.settings['interval'])
+
+	def host(self, mission):
+		return urlsplit(spacecraft.MISSIONS[mission]['raws_prefix']).hostname
+
+	def hostLimit(self, host):
+		return self.settings['hosts'].get(host, {}).get('concurrency', self.settings['host_concurrency'])
+
+	# Ask for a graceful stop (safe from a signal handler).
+	def stop(self):
+		self.stopping.set()
+
+	# Kill the worker processes outright (they ignore SIGTERM). Safe from a signal handler.
+	def killWorkers(self):
+		if self.pool is not None:
+			for process in list((self.pool._processes or {}).values()):
+				process.kill()
+
+	# Runs on the poll threads. Each gets its own queue connection (sqlite connections stay in their thread).
+	def poll(self, mission):
+		queue = work_queue.WorkQueue(self.queuePath)
+		try:
+			with metrics.registry.stage('poll'):
+				return check.checkMission(spacecraft.MISSIONS[mission], queue, BACKFILL_PRIORITY, RECENT_PRIORITY)
+		finally:
+			queue.close()
+
+	def startPolls(self):
+		now = time.monotonic()
+		polling = set(self.polls.values())
+		for mission in self.missions:
+			if mission not in polling and now >= self.nextPoll[mission]:
+				self.polls[self.pollPool.submit(self.poll, mission)] = mission
+				self.nextPoll[mission] = now + self.interval(mission)
+
+	def collectPolls(self):
+		for future in [f for f in self.polls if f.done()]:
+			mission = self.polls.pop(future)
+			try:
+				sols = future.result()
+			except Exception as e:
+				print("%s: poll failed: %r" % (mission, e))
+				continue
+			if sols is None:
+				print("%s: could not fetch remote manifest" % mission)
+			elif sols:
+				print("%s: %d sols updated, queued: %s" % (mission, len(sols), sols))
+				metrics.registry.count('sols_queued', len(sols))
+				now = time.time()
+				for sol in sols:
+					self.queuedAt.setdefault((mission, sol), now)
+			sys.stdout.flush()
+
+	# Fill free worker slots from the queue, highest priority first, within each host's limit.
+	# A sol is never run twice at once: the queue keeps a re-queued sol running until its job
+	# finishes, and sols with a job here are excluded regardless.
+	def dispatch(self):
+		while len(self.jobs) < self.settings['workers']:
+			eligible = [m for m in self.missions if self.hostJobs[self.host(m)] < self.hostLimit(self.host(m))]
+			if not eligible:
+				return
+			running = [(mission, sol) for mission, sol, generation in self.jobs.values()]
+			claimed = []
+			every = self.settings['backfill_every']
+			if every and self.dispatched % every == every - 1:
+				claimed = self.queue.claim(eligible, limit=1, maxPriority=BACKFILL_PRIORITY, exclude=running)
+			if not claimed:
+				claimed = self.queue.claim(eligible, limit=1, exclude=running)
+			if not claimed:
+				return
+			mission, sol, generation = claimed[0]
+			future = self.pool.submit(backfill.processSol, mission, sol, self.settings['image_workers'], True, self.publish,
+									None, self.settings['mosaic'])
+			self.jobs[future] = (mission, sol, generation)
+			self.hostJobs[self.host(mission)] += 1
+			self.dispatched += 1
+
+	def collectJobs(self):
+		for future in [f for f in self.jobs if f.done()]:
+			mission, sol, generation = self.jobs.pop(future)
+			self.hostJobs[self.host(mission)] -= 1
+			try:
+				result = future.result()
+			except Exception as e: # Worker died outright
+				result = {'mission' : mission, 'sol' : sol, 'ok' : False, 'observations' : 0, 'skipped_obs' : 0,
+						'products' : 0, 'failed_obs' : [], 'error' : repr(e)}
+			snap = result.pop('metrics', None)
+			if snap is not None:
+				metrics.registry.merge(snap)
+			status = self.queue.finish(mission, sol, generation, result['ok'], result['error'],
+										self.settings['max_attempts'], self.settings['retry_backoff'])
+			if result['ok']:
+				metrics.registry.count('sols_unsupported' if result.get('unsupported') else 'sols_processed')
+			else:
+				metrics.registry.count('sols_failed' if status == work_queue.FAILED else 'sols_retried')
+			queuedAt = self.queuedAt.pop((mission, sol), None)
+			if queuedAt is not None and result['ok']:
+				metrics.registry.observe('sol_queue_latency', time.time() - queuedAt)
+			print("%s " % mission, end='')
+			backfill.printResult(result)
+			if not result['ok'] and status == work_queue.PENDING:
+				print("%s sol %d: will retry" % (mission, sol))
+
+	# Run until stop(). metricsPath, if given, gets a Prometheus text file of the metrics every metricsEvery seconds.
+	def run(self, metricsPath=None, metricsEvery=60):
+		self.queue = work_queue.WorkQueue(self.queuePath)
+		# Take back sols claimed by runs that died before finishing them (not those of a live backfill --queue).
+		for mission in self.missions:
+			self.queue.requeueRunning(mission)
+		self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.settings['workers'],
+															initializer=initWorker, initargs=(self.memoryMb,),
+															max_tasks_per_child=50)
+		self.pollPool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(self.missions)))
+		nextMetrics = time.monotonic() + metricsEvery
+		try:
+			while not self.stopping.is_set():
+				self.startPolls()
+				self.collectPolls()
+				self.collectJobs()
+				self.dispatch()
+				if metricsPath is not None and time.monotonic() >= nextMetrics:
+					metrics.registry.writePrometheus(metricsPath)
+					nextMetrics = time.monotonic() + metricsEvery
+				# Sleep until something finishes, a poll is due, or a tick passes.
+				untilPoll = max(0, min(self.nextPoll.values()) - time.monotonic())
+				pending = list(self.jobs) + list(self.polls)
+				if pending:
+					concurrent.futures.wait(pending, timeout=min(self.settings['tick'], untilPoll), return_when=concurrent.futures.FIRST_COMPLETED)
+				else:
+					self.stopping.wait(min(self.settings['tick'], untilPoll))
+		finally:
+			self.shutdown()
+			if metricsPath is not None:
+				metrics.registry.writePrometheus(metricsPath)
+
+	# Let running jobs finish (up to shutdown_grace) and record them. Any still running after that
+	# are killed and put back on the queue; everything else is dropped.
+	def shutdown(self):
+		if self.jobs:
+			print("Stopping: waiting up to %ds for %d running sols" % (self.settings['shutdown_grace'], len(self.jobs)))
+			sys.stdout.flush()
+			concurrent.futures.wait(list(self.jobs), timeout=self.settings['shutdown_grace'])
+		self.collectJobs()
+		if self.jobs:
+			print("Killing %d sols still running: %s" % (len(self.jobs), sorted((m, sol) for m, sol, g in self.jobs.values())))
+			for mission, sol, generation in self.jobs.values():
+				self.queue.release(mission, sol)
+			self.jobs = {}
+			self.killWorkers()
+		if self.pollPool is not None:
+			self.pollPool.shutdown(wait=True, cancel_futures=True)
+		if self.pool is not None:
+			# Workers are idle or dead by now, so this (and the interpreter's exit hook) doesn't wait on sols.
+			self.pool.shutdown(wait=True, cancel_futures=True)
+		self.queue.close()
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Poll mission manifests and process updated sols continuously.')
+	parser.add_argument('missions', nargs='+', choices=sorted(spacecraft.MISSIONS))
+	parser.add_argument('--publish', action='store_true', help="upload sol manifests and new products to our bucket ('publish' in config)")
+	parser.add_argument('--backfill', nargs=3, action='append', default=[], metavar=('MISSION', 'FIRST', 'LAST'),
+						help='also queue this inclusive sol range as backfill work (can be repeated)')
+	parser.add_argument('--memory-mb', type=int, default=None, help="per-worker memory cap (default: 'backfill_worker_memory_mb' in config, else none)")
+	parser.add_argument('--metrics-prom', default=None, help='keep a Prometheus text file of the metrics up to date here')
+	args = parser.parse_args()
+
+	scheduler = Scheduler(args.missions, publish=args.publish,
+						memoryMb=args.memory_mb if args.memory_mb is not None else config.getConfig().get('backfill_worker_memory_mb'))
+	queue = work_queue.WorkQueue()
+	for mission, first, last in args.backfill:
+		sols = manifest.Manifest(spacecraft.MISSIONS[mission]).getSolRange(int(first), int(last))
+		queue.enqueue(mission, sols, BACKFILL_PRIORITY)
+		print("%s: %d sols queued for backfill" % (mission, len(sols)))
+
+	# First signal: graceful stop. Second: out now (running sols stay claimed by this dead process,
+	# so the next start puts them back on the queue).
+	def onSignal(signum, frame):
+		if scheduler.stopping.is_set():
+			scheduler.killWorkers()
+			os._exit(1)
+		scheduler.stop()
+	signal.signal(signal.SIGTERM, onSignal)
+	signal.signal(signal.SIGINT, onSignal)
+
+	print("Scheduling %s with %d workers" % (', '.join(args.missions), scheduler.settings['workers']))
+	sys.stdout.flush()
+	scheduler.run(args.metrics_prom)
+	print("Stopped. Queue: %s" % queue.counts())
+	queue.close()
+	sys.exit(0)
@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+#
+# Persistent record of what has already been generated, and from which inputs.
+# Keyed by (mission, sol, obs_id, product); each row holds a fingerprint of the input images, the
+# sol manifest time they came from, where the output went and a hash of its contents.
+# The pipeline checks this before downloading anything, so a re-run after a crash or a config change
+# only redoes products whose inputs actually changed (or whose output went missing).
+#
+# SQLite in WAL mode, so parallel backfill workers can all write to it at once.
+#
+
+# Library imports
+import os
+import json
+import time
+import hashlib
+import sqlite3
+
+# marsrover-pipeline imports
+import metadata.config as config
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS products (
+	mission TEXT NOT NULL,
+	sol INTEGER NOT NULL,
+	obs_id TEXT NOT NULL,
+	product TEXT NOT NULL,
+	inputs TEXT NOT NULL,       -- json {imageid : fingerprint}
+	inputs_hash TEXT NOT NULL,
+	manifest_time TEXT,         -- last_manifest_update of the sol manifest the inputs came from
+	status TEXT NOT NULL,       -- 'ok', or 'unbuildable' (e.g. partial frames) so it isn't retried until inputs change
+	output_path TEXT,
+	output_hash TEXT,
+	updated REAL NOT NULL,
+	PRIMARY KEY (mission, sol, obs_id, product));
+CREATE TABLE IF NOT EXISTS published (
+	bucket TEXT NOT NULL,
+	key TEXT NOT NULL,
+	hash TEXT NOT NULL,         -- content hash + encoding + type of what was last uploaded (see publisher.py)
+	updated REAL NOT NULL,
+	PRIMARY KEY (bucket, key))"""
+
+STATUS_OK = 'ok'
+STATUS_UNBUILDABLE = 'unbuildable'
+
+def inputsHash(inputs):
+	return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+class StateStore:
+	# path defaults to <manifest_path>/state.sqlite
+	# checkSameThread=False allows use from several threads, as long as the caller serializes access.
+	def __init__(self, path=None, checkSameThread=True):
+		if path is None:
+			path = config.getConfig()['manifest_path'] + 'state.sqlite'
+		self.path = path
+		# Generous timeout: with many workers, a writer may have to wait its turn.
+		self.db = sqlite3.connect(path, timeout=60, check_same_thread=checkSameThread)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=NORMAL')
+		with self.db:
+			self.db.executescript(SCHEMA)
+
+	# Return the stored rows for one observation as {product : row dict}.
+	def getObs(self, mission, sol, obsId):
+		cur = self.db.execute('SELECT product, inputs_hash, manifest_time, status, output_path, output_hash FROM products '
+							'WHERE mission=? AND sol=? AND obs_id=?', (mission, sol, obsId))
+		return {r[0] : {'inputs_hash' : r[1], 'manifest_time' : r[2], 'status' : r[3], 'output_path' : r[4], 'output_hash' : r[5]}
+				for r in cur.fetchall()}
+
+	# True if every given product of the observation was already handled with exactly these inputs,
+	# and (for built products) the output is still on disk.
+	# productInputs is {product : {imageid : fingerprint}}
+	def isObsCurrent(self, mission, sol, obsId, productInputs):
+		rows = self.getObs(mission, sol, obsId)
+		for product, inputs in productInputs.items():
+			row = rows.get(product)
+			if row is None or row['inputs_hash'] != inputsHash(inputs):
+				return False
+			if row['status'] == STATUS_OK and not os.path.isfile(row['output_path']):
+				return False
+		return True
+
+	# Record the outcome for a set of products of one observation in a single transaction.
+	# outputs is {product : (output path, content hash)}; products without an entry are recorded as unbuildable.
+	def recordObs(self, mission, sol, obsId, productInputs, outputs, manifestTime=None):
+		now = time.time()
+		rows = []
+		for product, inputs in productInputs.items():
+			if product in outputs:
+				status = STATUS_OK
+				outputPath, outputHash = outputs[product]
+			else:
+				status = STATUS_UNBUILDABLE
+				outputPath, outputHash = None, None
+			rows.append((mission, sol, obsId, product, json.dumps(inputs, sort_keys=True), inputsHash(inputs),
+						manifestTime, status, outputPath, outputHash, now))
+		with self.db:
+			self.db.executemany('INSERT OR REPLACE INTO products VALUES (?,?,?,?,?,?,?,?,?,?,?)', rows)
+
+	# Forget a sol entirely (e.g. to force regeneration).
+	def clearSol(self, mission, sol):
+		with self.db:
+			self.db.execute('DELETE FROM products WHERE mission=? AND sol=?', (mission, sol))
+
+	# Hash last published to bucket/key, or None if never.
+	def getPublished(self, bucket, key):
+		row = self.db.execute('SELECT hash FROM published WHERE bucket=? AND key=?', (bucket, key)).fetchone()
+		return row[0] if row is not None else None
+
+	# Record a batch of uploads to a bucket, as (key, hash) pairs.
+	def recordPublished(self, bucket, items):
+		now = time.time()
+		with self.db:
+			self.db.executemany('INSERT OR REPLACE INTO published VALUES (?,?,?,?)', [(bucket, key, h, now) for key, h in items])
+
+	def close(self):
+		self.db.close()
+
+if __name__ == '__main__':
+	print("TESTING MODULE: state_store.py")
+	import tempfile
+	import multiprocessing
+
+	def hammer(args):
+		path, n = args
+		s = StateStore(path)
+		for i in range(50):
+			s.recordObs('merb', n, 'obs' + str(i), {'L257' : {'a' : str(i)}}, {'L257' : (path, 'h')})
+		s.close()
+		return n
+
+	with tempfile.TemporaryDirectory() as tmp:
+		path = os.path.join(tmp, 'state.sqlite')
+		s = StateStore(path)
+		inputs = {'L257' : {'1P1L2' : 'f1', '1P1L5' : 'f2', '1P1L7' : 'f3'}, 'L456' : {'1P1L4' : 'f4'}}
+		print(s.isObsCurrent('merb', 5, 'obs', inputs))
+		s.recordObs('merb', 5, 'obs', inputs, {'L257' : (path, 'abc')}, '2018-02-05T12:00:00.000Z')
+		print(s.getObs('merb', 5, 'obs'))
+		print(s.isObsCurrent('merb', 5, 'obs', inputs))
+		inputs['L257']['1P1L5'] = 'changed'
+		print(s.isObsCurrent('merb', 5, 'obs', inputs))
+
+		# Concurrent writers from several processes
+		with multiprocessing.Pool(4) as pool:
+			print(sorted(pool.map(hammer, [(path, n) for n in range(8)])))
+		print(s.db.execute('SELECT COUNT(*) FROM products').fetchone()[0])
+		s.close()
+	print("DONE.")
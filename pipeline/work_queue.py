@@ -0,0 +1,254 @@
+#!/usr/bin/python3
+#
+# Persistent queue of sols waiting to be (re)processed, shared between the cheap "did anything
+# change?" check (pipeline/check.py), which enqueues, and backfill, which claims and works through them.
+# A sol is in the queue at most once per mission; enqueueing it again while it's queued or running
+# bumps its generation. A running sol stays running (and can't be claimed twice): when the older
+# claim finishes, it goes back to pending for the newer request instead of being marked done.
+# Every claim records its owner (host and pid of the claiming process), so more than one consumer
+# (backfill --queue, the scheduler) can share the queue: requeueRunning() only takes back claims
+# whose owner is no longer running, never another live consumer's.
+#
+# SQLite in WAL mode at <manifest_path>/queue.sqlite; standard library only, so the check path
+# stays light.
+#
+
+# Library imports
+import os
+import time
+import socket
+import sqlite3
+import contextlib
+
+# marsrover-pipeline imports
+import metadata.config as config
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS queue (
+	mission TEXT NOT NULL,
+	sol INTEGER NOT NULL,
+	priority INTEGER NOT NULL,  -- higher is claimed first
+	status TEXT NOT NULL,       -- 'pending', 'running', 'done' or 'failed'
+	generation INTEGER NOT NULL,-- bumped on every enqueue
+	attempts INTEGER NOT NULL,
+	error TEXT,
+	enqueued REAL NOT NULL,
+	updated REAL NOT NULL,
+	owner TEXT,                 -- 'host:pid' of the process that claimed it, while running
+	not_before REAL,            -- pending retries of failed sols aren't claimed before this time
+	PRIMARY KEY (mission, sol));
+CREATE INDEX IF NOT EXISTS queue_claim ON queue (status, priority, sol)"""
+
+# Columns added since the first version of the table: name -> definition
+ADDED_COLUMNS = {'owner' : 'TEXT', 'not_before' : 'REAL'}
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Is the process that made a claim still running? Unknown owners (claims from before owners were
+# recorded) count as gone; claims made on another host count as alive, since we can't tell.
+def ownerAlive(owner):
+	if owner is None:
+		return False
+	host, pid = owner.rsplit(':', 1)
+	if host != socket.gethostname():
+		return True
+	try:
+		os.kill(int(pid), 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError: # Someone else's process
+		return True
+	return True
+
+class WorkQueue:
+	# path defaults to <manifest_path>/queue.sqlite
+	def __init__(self, path=None):
+		if path is None:
+			path = config.getConfig()['manifest_path'] + 'queue.sqlite'
+		self.path = path
+		# Transactions are explicit (BEGIN IMMEDIATE), so two claimers can't take the same sol.
+		self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=NORMAL')
+		self.db.executescript(SCHEMA)
+		existing = {row[1] for row in self.db.execute('PRAGMA table_info(queue)')}
+		for name, definition in ADDED_COLUMNS.items():
+			if name not in existing:
+				self.db.execute('ALTER TABLE queue ADD COLUMN %s %s' % (name, definition))
+		self.owner = '%s:%d' % (socket.gethostname(), os.getpid())
+
+	@contextlib.contextmanager
+	def transaction(self):
+		self.db.execute('BEGIN IMMEDIATE')
+		try:
+			yield
+		except BaseException:
+			self.db.execute('ROLLBACK')
+			raise
+		self.db.execute('COMMIT')
+
+	# Queue sols of a mission (again). A sol already queued keeps the higher of the two priorities;
+	# one that's running stays running, and is run again once that finishes.
+	def enqueue(self, mission, sols, priority=0):
+		now = time.time()
+		with self.transaction():
+			self.db.executemany('INSERT INTO queue VALUES (?,?,?,?,1,0,NULL,?,?,NULL,NULL) '
+								'ON CONFLICT (mission, sol) DO UPDATE SET status=CASE WHEN status=? THEN status ELSE excluded.status END, generation=generation+1, '
+								'priority=CASE WHEN status IN (?,?) THEN max(priority, excluded.priority) ELSE excluded.priority END, '
+								'attempts=0, error=NULL, not_before=NULL, updated=excluded.updated',
+								[(mission, sol, priority, PENDING, now, now, RUNNING, PENDING, RUNNING) for sol in sols])
+
+	# Take up to limit pending sols (all if None, and not ones waiting out a retry backoff), highest
+	# priority first, then newest sol first.
+	# Only of one mission (or a list of them) if given, only up to maxPriority if given, and never
+	# any of the (mission, sol)s in exclude. Returns [(mission, sol, generation)], now marked running
+	# and owned by this process.
+	def claim(self, mission=None, limit=None, maxPriority=None, exclude=()):
+		now = time.time()
+		query = 'SELECT mission, sol, generation FROM queue WHERE status=? AND (not_before IS NULL OR not_before<=?)'
+		params = [PENDING, now]
+		if mission is not None:
+			missions = [mission] if isinstance(mission, str) else list(mission)
+			query += ' AND mission IN (%s)' % ','.join('?' * len(missions))
+			params.extend(missions)
+		if maxPriority is not None:
+			query += ' AND priority<=?'
+			params.append(maxPriority)
+		for m, sol in exclude:
+			query += ' AND NOT (mission=? AND sol=?)'
+			params.extend((m, sol))
+		query += ' ORDER BY priority DESC, sol DESC'
+		if limit is not None:
+			query += ' LIMIT %d' % limit
+		with self.transaction():
+			claimed = self.db.execute(query, params).fetchall()
+			self.db.executemany('UPDATE queue SET status=?, attempts=attempts+1, updated=?, owner=?, not_before=NULL WHERE mission=? AND sol=?',
+								[(RUNNING, now, self.owner, m, sol) for m, sol, generation in claimed])
+		return claimed
+
+	# Record how a claimed sol went, and return its new status. If the sol was enqueued again since
+	# the claim, this run may have missed the newer data: it goes back to pending for the newer request.
+	# A failed sol is retried (pending again, after backoff seconds, doubling each time) until it has
+	# been tried maxAttempts times, then marked failed.
+	def finish(self, mission, sol, generation, ok, error=None, maxAttempts=1, backoff=60):
+		now = time.time()
+		with self.transaction():
+			row = self.db.execute('SELECT attempts FROM queue WHERE mission=? AND sol=? AND generation=?',
+								(mission, sol, generation)).fetchone()
+			if row is None:
+				self.db.execute('UPDATE queue SET status=?, updated=?, owner=NULL WHERE mission=? AND sol=? AND status=?',
+								(PENDING, now, mission, sol, RUNNING))
+				return PENDING
+			notBefore = None
+			if ok:
+				status = DONE
+			elif row[0] < maxAttempts:
+				status = PENDING
+				notBefore = now + backoff * 2 ** (row[0] - 1)
+			else:
+				status = FAILED
+			self.db.execute('UPDATE queue SET status=?, error=?, updated=?, owner=NULL, not_before=? WHERE mission=? AND sol=?',
+							(status, error, now, notBefore, mission, sol))
+			return status
+
+	# Hand back a claimed sol that was never run to the end (e.g. stopped at shutdown): pending again,
+	# without counting as an attempt.
+	def release(self, mission, sol):
+		with self.transaction():
+			self.db.execute('UPDATE queue SET status=?, attempts=max(0, attempts-1), updated=?, owner=NULL '
+							'WHERE mission=? AND sol=? AND status=? AND owner=?',
+							(PENDING, time.time(), mission, sol, RUNNING, self.owner))
+
+	# Put sols that were claimed but never finished back to pending (e.g. after a crash): those whose
+	# owner is gone. Claims of live processes on this host, and of other hosts, are left alone.
+	def requeueRunning(self, mission=None):
+		query = 'SELECT mission, sol, owner FROM queue WHERE status=?'
+		params = [RUNNING]
+		if mission is not None:
+			query += ' AND mission=?'
+			params.append(mission)
+		with self.transaction():
+			orphans = [(m, sol) for m, sol, owner in self.db.execute(query, params).fetchall() if not ownerAlive(owner)]
+			self.db.executemany('UPDATE queue SET status=?, updated=?, owner=NULL WHERE mission=? AND sol=? AND status=?',
+								[(PENDING, time.time(), m, sol, RUNNING) for m, sol in orphans])
+		return len(orphans)
+
+	# Sols of a mission with a given status, ascending.
+	def sols(self, mission, status=PENDING):
+		return [r[0] for r in self.db.execute('SELECT sol FROM queue WHERE mission=? AND status=? ORDER BY sol', (mission, status))]
+
+	# {mission : {status : count}}
+	def counts(self):
+		counts = {}
+		for mission, status, n in self.db.execute('SELECT mission, status, COUNT(*) FROM queue GROUP BY mission, status'):
+			counts.setdefault(mission, {})[status] = n
+		return counts
+
+	def close(self):
+		self.db.close()
+
+if __name__ == '__main__':
+	print("TESTING MODULE: work_queue.py")
+	import sys
+	import tempfile
+	import subprocess
+	import concurrent.futures
+	with tempfile.TemporaryDirectory() as tmp:
+		path = os.path.join(tmp, 'queue.sqlite')
+		q = WorkQueue(path)
+		q.enqueue('merb', [10, 11, 12])
+		q.enqueue('merb', [5000], priority=10)
+		print(q.counts())
+		print(q.claim('merb', limit=2))
+		# Our own claims are live, so they stay running
+		print(q.claim(['merb', 'msl'], limit=1, maxPriority=0) != [], q.requeueRunning('merb'), q.sols('merb', RUNNING))
+		# Claims of a process that has exited are taken back
+		dead = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'], capture_output=True, text=True).stdout.strip()
+		def orphan():
+			q.db.execute('UPDATE queue SET owner=? WHERE status=?', ('%s:%s' % (socket.gethostname(), dead), RUNNING))
+		orphan()
+		print(q.requeueRunning('merb'))
+		print(q.claim('merb', limit=2, exclude=[('merb', 5000)]))
+
+		# Re-queued while running: stays running (not claimable), then goes back to pending when the old claim finishes
+		q.enqueue('merb', [12])
+		print(q.sols('merb', RUNNING), q.claim('merb', limit=1))
+		q.finish('merb', 5000, 1, True)
+		q.finish('merb', 12, 1, True)
+		print(q.sols('merb'), q.sols('merb', DONE))
+
+		# Crash recovery, and failures
+		print(q.claim('merb'), orphan(), q.requeueRunning('merb'), q.sols('merb'))
+		for mission, sol, generation in q.claim():
+			q.finish(mission, sol, generation, sol != 11, None if sol != 11 else 'boom')
+		print(q.counts(), q.sols('merb', FAILED))
+
+		# Retries: not claimable during the backoff, then failed for good after maxAttempts
+		q.enqueue('merb', [11])
+		statuses = []
+		for attempt in range(3):
+			[(mission, sol, generation)] = q.claim('merb')
+			statuses.append(q.finish(mission, sol, generation, False, 'timeout', maxAttempts=3, backoff=60))
+			print(q.claim('merb'), end=' ')
+			q.db.execute('UPDATE queue SET not_before=NULL') # Skip the wait
+		print(statuses, q.sols('merb', FAILED))
+
+		# Concurrent claimers never get the same sol
+		q.enqueue('msl', range(200))
+		def claimAll(i):
+			wq = WorkQueue(path)
+			got = []
+			while True:
+				batch = wq.claim('msl', limit=7)
+				if not batch:
+					break
+				got.extend(sol for mission, sol, generation in batch)
+			wq.close()
+			return got
+		with concurrent.futures.ThreadPoolExecutor(4) as pool:
+			claimed = [sol for got in pool.map(claimAll, range(4)) for sol in got]
+		print(len(claimed), len(set(claimed)))
+		q.close()
+	print("DONE.")